@@ -0,0 +1,131 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import logging
+import os
+import socket
+
+LOG = logging.getLogger(__name__)
+
+SYS_CLASS_NET = '/sys/class/net'
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 1
+
+
+def open_link_socket():
+    """rtnetlink socket that receives the link events, None where
+    netlink is not available"""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_LINK))
+        sock.setblocking(False)
+    except (AttributeError, socket.error) as e:
+        LOG.info("No rtnetlink link events, checking %s instead: %s",
+                 SYS_CLASS_NET, e)
+        return None
+    return sock
+
+
+def read_sys_file(path):
+    try:
+        f = open(path)
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+
+class NicInventory(object):
+    """MAC address and ifindex of the NICs of the host.
+
+    The table is read from /sys/class/net and read again only after the
+    kernel sent an rtnetlink link event. Without netlink it is read again
+    when the interface names in /sys/class/net changed.
+    """
+
+    def __init__(self, path=SYS_CLASS_NET):
+        self.path = path
+        self._sock = open_link_socket()
+        self._names = None
+        # name -> (mac, ifindex, uplink)
+        self._nics = None
+
+    def _link_changed(self):
+        changed = False
+        while True:
+            try:
+                if not self._sock.recv(65536):
+                    break
+                changed = True
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                # ENOBUFS, events were lost
+                LOG.debug("rtnetlink socket error: %s", e)
+                return True
+        return changed
+
+    def is_uplink(self, name):
+        """Physical NICs and bonds, any naming scheme, and eth* as
+        before"""
+        return (os.path.exists(os.path.join(self.path, name, 'device')) or
+                os.path.exists(os.path.join(self.path, name, 'bonding')) or
+                name.startswith('eth'))
+
+    def _read(self, names):
+        nics = {}
+        for name in names:
+            mac = read_sys_file(os.path.join(self.path, name, 'address'))
+            ifindex = read_sys_file(os.path.join(self.path, name, 'ifindex'))
+            if mac is None or ifindex is None:
+                # removed while it was read
+                continue
+            nics[name] = (mac, int(ifindex), self.is_uplink(name))
+        LOG.debug("NIC inventory: %s", nics)
+        return nics
+
+    def refresh(self):
+        """Read the table again if the NICs changed since the last read"""
+        if self._nics is not None:
+            if self._sock is not None:
+                if not self._link_changed():
+                    return
+            else:
+                names = sorted(os.listdir(self.path))
+                if names == self._names:
+                    return
+        self._names = sorted(os.listdir(self.path))
+        self._nics = self._read(self._names)
+
+    def get_macs(self):
+        """{name: mac} of all NICs"""
+        self.refresh()
+        return dict((name, nic[0]) for name, nic in self._nics.iteritems())
+
+    def get_uplink_macs(self):
+        """{name: mac} of the physical NICs and bonds"""
+        self.refresh()
+        return dict((name, nic[0]) for name, nic in self._nics.iteritems()
+                    if nic[2])
+
+    def get_ifindex(self, name):
+        self.refresh()
+        nic = self._nics.get(name)
+        return nic and nic[1]
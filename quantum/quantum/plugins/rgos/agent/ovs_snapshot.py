@@ -0,0 +1,139 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import logging
+
+from quantum.agent.linux import ovs_lib
+from quantum.agent.linux import utils
+
+LOG = logging.getLogger(__name__)
+
+# (table, columns) listed by the one ovs-vsctl call of a snapshot
+SNAPSHOT_TABLES = (
+    ('Bridge', 'name,ports'),
+    ('Port', '_uuid,name'),
+    ('Interface', 'name,ofport,external_ids'),
+)
+
+
+def get_atom(value):
+    """Value of an ovsdb json atom, a uuid is given as ['uuid', id]"""
+    if (isinstance(value, list) and len(value) == 2 and
+            value[0] in ('uuid', 'named-uuid')):
+        return value[1]
+    return value
+
+
+def get_set(value):
+    """Values of an ovsdb json set, a set of one is given as the atom"""
+    if isinstance(value, list) and len(value) == 2 and value[0] == 'set':
+        return [get_atom(x) for x in value[1]]
+    return [get_atom(value)]
+
+
+def get_map(value):
+    if isinstance(value, list) and len(value) == 2 and value[0] == 'map':
+        return dict((get_atom(k), get_atom(v)) for k, v in value[1])
+    return {}
+
+
+def parse_tables(output):
+    """Split the concatenated json tables printed by ovs-vsctl into
+    lists of {column: value} rows"""
+    decoder = json.JSONDecoder()
+    tables = []
+    pos = 0
+    output = output.strip()
+    while pos < len(output):
+        table, pos = decoder.raw_decode(output, pos)
+        headings = table['headings']
+        tables.append([dict(zip(headings, row)) for row in table['data']])
+        while pos < len(output) and output[pos].isspace():
+            pos = pos + 1
+    return tables
+
+
+class BridgeSnapshot(object):
+    """Ports and interfaces of all bridges at one point in time.
+
+    Built from a single ovs-vsctl call, so a loop of the agent reads the
+    bridges once instead of once per port.
+    """
+
+    def __init__(self, bridges, interfaces):
+        # bridge name -> port names, without the bridge's own port
+        self.bridges = bridges
+        # interface name -> (ofport, external_ids)
+        self.interfaces = interfaces
+        # iface-id -> interface name, of the interfaces of vms
+        self.vifs = {}
+        for name, (ofport, external_ids) in interfaces.iteritems():
+            if 'iface-id' in external_ids and 'attached-mac' in external_ids:
+                self.vifs[external_ids['iface-id']] = name
+
+    def get_port_names(self, br_name):
+        """Port names of a bridge like list-ports, None if the bridge
+        does not exist"""
+        names = self.bridges.get(br_name)
+        if names is None:
+            return None
+        return list(names)
+
+    def get_external_ids(self, name):
+        return self.interfaces.get(name, (None, {}))[1]
+
+    def get_vif_port_set(self, br_name):
+        names = set(self.bridges.get(br_name, []))
+        return set(vif_id for vif_id, name in self.vifs.iteritems()
+                   if name in names)
+
+    def get_vif_port_by_id(self, bridge, port_id):
+        """ovs_lib.VifPort of port_id on bridge, None if it is not there"""
+        name = self.vifs.get(port_id)
+        if name is None or name not in self.bridges.get(bridge.br_name, []):
+            return None
+        ofport, external_ids = self.interfaces[name]
+        return ovs_lib.VifPort(name, ofport, port_id,
+                               external_ids['attached-mac'], bridge)
+
+
+def get_bridge_snapshot(root_helper):
+    """Read all bridges with one ovs-vsctl call, None if it failed"""
+    args = ['ovs-vsctl', '--timeout=2', '--format=json']
+    for table, columns in SNAPSHOT_TABLES:
+        args += ['--', '--columns=%s' % columns, 'list', table]
+    try:
+        bridge_rows, port_rows, interface_rows = parse_tables(
+            utils.execute(args, root_helper=root_helper))
+    except Exception as e:
+        LOG.error("Unable to read the bridges: %s", e)
+        return None
+
+    port_names = dict((get_atom(row['_uuid']), row['name'])
+                      for row in port_rows)
+    bridges = {}
+    for row in bridge_rows:
+        names = [port_names[uuid] for uuid in get_set(row['ports'])
+                 if uuid in port_names]
+        bridges[row['name']] = sorted(name for name in names
+                                      if name != row['name'])
+    interfaces = {}
+    for row in interface_rows:
+        ofport = get_set(row['ofport'])
+        interfaces[row['name']] = (ofport and ofport[0] or -1,
+                                   get_map(row['external_ids']))
+    return BridgeSnapshot(bridges, interfaces)
@@ -0,0 +1,120 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+import os
+import shlex
+import threading
+
+import eventlet
+from eventlet.green import subprocess
+
+LOG = logging.getLogger(__name__)
+
+# every vif plugged or unplugged adds, deletes or updates an Interface row
+MONITOR_TABLE = 'Interface'
+MONITOR_COLUMNS = 'name,ofport,external_ids'
+# seconds before a monitor that exited is started again
+RESTART_INTERVAL = 5
+
+
+class OvsdbMonitor(object):
+    """Tells the agent loop when the ovsdb Interface table changed.
+
+    A long running 'ovsdb-client monitor' prints a line for every change
+    of the table, a green thread reads them and sets the changed flag.
+    While the monitor is not running every wait reports a change, so the
+    agent falls back to polling.
+    """
+
+    def __init__(self, root_helper):
+        self.root_helper = root_helper
+        self._changed = threading.Event()
+        self._process = None
+        self._reader = None
+        self._stopped = True
+
+    def get_cmd(self):
+        cmd = ['ovsdb-client', 'monitor', MONITOR_TABLE, MONITOR_COLUMNS,
+               '--format=json']
+        if self.root_helper:
+            cmd = shlex.split(self.root_helper) + cmd
+        return cmd
+
+    def start(self):
+        self._stopped = False
+        self._reader = eventlet.spawn(self._run)
+
+    def stop(self):
+        self._stopped = True
+        process = self._process
+        if process is not None and process.poll() is None:
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+    def is_active(self):
+        process = self._process
+        return process is not None and process.poll() is None
+
+    def _run(self):
+        devnull = open(os.devnull, 'w')
+        try:
+            while not self._stopped:
+                self._monitor(devnull)
+                # a scan picks up what was missed while the monitor is down
+                self._changed.set()
+                if not self._stopped:
+                    eventlet.sleep(RESTART_INTERVAL)
+        finally:
+            devnull.close()
+
+    def _monitor(self, devnull):
+        try:
+            self._process = subprocess.Popen(self.get_cmd(),
+                                             stdout=subprocess.PIPE,
+                                             stderr=devnull,
+                                             close_fds=True)
+        except OSError as e:
+            LOG.error("Unable to start the ovsdb monitor: %s", e)
+            self._process = None
+            return
+        LOG.info("Monitoring the ovsdb %s table", MONITOR_TABLE)
+        try:
+            # the first lines are the current rows, then one per change
+            for line in iter(self._process.stdout.readline, ''):
+                if line.strip():
+                    self._changed.set()
+            self._process.wait()
+            if not self._stopped:
+                LOG.warning("The ovsdb monitor exited with %s",
+                            self._process.returncode)
+        finally:
+            self._process = None
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a change.
+
+        Returns True if the table changed, or if the monitor is not
+        running and the caller has to scan anyway.
+        """
+        if timeout > 0:
+            self._changed.wait(timeout)
+        if self._changed.is_set():
+            self._changed.clear()
+            return True
+        return not self.is_active()
@@ -35,13 +35,16 @@ from quantum.common import topics
 from quantum.openstack.common import cfg
 from quantum.openstack.common import context
 from quantum.openstack.common import rpc
+from quantum.openstack.common.rpc import common as rpc_common
 from quantum.openstack.common.rpc import dispatcher
 from quantum.plugins.rgos.common import config
+from quantum.plugins.rgos.agent import nic_inventory
+from quantum.plugins.rgos.agent import ovs_snapshot
+from quantum.plugins.rgos.agent import ovsdb_monitor
 from quantum.plugins.rgos.common import constants
 from quantum.db import models_v2
 import quantum.db.api as db
 from quantum.plugins.rgos.db import rgos_db
-from quantum.plugins.rgos.vlan import vlan_mgr as rgos_vlanmgr
 from quantum.plugins.rgos.switch import switch_driver
 from quantum.plugins.rgos.ssh import sshclient
 
@@ -53,6 +56,22 @@ LOG = logging.getLogger(__name__)
 # A placeholder for dead vlans.
 DEAD_VLAN_TAG = "4095"
 
+# remote error of a plugin that does not have an rpc of a newer version,
+# its dispatcher rejects the version before it looks for the method
+RPC_UNSUPPORTED = 'UnsupportedRpcVersion'
+
+
+def load_vm_eth_bindings(macs):
+    res = {}
+    for vif, mac in rgos_db.get_ruijie_vm_eth_bindings_bymacs(macs):
+        res.setdefault(mac, []).append(vif)
+    return res
+
+
+def load_vm_eth_binding(mac):
+    return [vif for vif, x in
+            rgos_db.get_ruijie_vm_eth_bindings_bymacs([mac])] or None
+
 # A class to represent a VIF (i.e., a port that has 'iface-id' and 'vif-mac'
 # attributes set).
 class LocalVLANMapping:
@@ -101,6 +120,33 @@ class Port(object):
         return hash(self.id)
 
 
+class RgosPluginApi(agent_rpc.PluginApi):
+    """Plugin rpc api with the batch calls of the rgos plugin"""
+
+    BATCH_RPC_API_VERSION = '1.1'
+    DOWN_RPC_API_VERSION = '1.2'
+
+    def get_devices_details_list(self, context, devices, agent_id,
+                                 agent_version=None):
+        return self.call(context,
+                         self.make_msg('get_devices_details_list',
+                                       devices=devices,
+                                       agent_id=agent_id,
+                                       agent_version=agent_version),
+                         topic=self.topic,
+                         version=self.BATCH_RPC_API_VERSION)
+
+    def update_devices_down_list(self, context, devices, agent_id,
+                                 agent_version=None):
+        return self.call(context,
+                         self.make_msg('update_devices_down_list',
+                                       devices=devices,
+                                       agent_id=agent_id,
+                                       agent_version=agent_version),
+                         topic=self.topic,
+                         version=self.DOWN_RPC_API_VERSION)
+
+
 class OVSQuantumAgent(object):
     '''Implements OVS-based VLANs networks.
 
@@ -125,12 +171,18 @@ class OVSQuantumAgent(object):
     # Upper bound on available vlans.
     MAX_VLAN_TAG = 4094
 
-    # Set RPC API version to 1.0 by default.
-    RPC_API_VERSION = '1.0'
+    # RPC API version history:
+    #   1.0 - initial version
+    #   1.1 - network_update
+    #   1.2 - casts on the '<topic>.<agent_id>' topics, the version is
+    #         told to the plugin in the batch calls
+    RPC_API_VERSION = '1.2'
 
     def __init__(self, integ_br, local_ip,
                  bridge_mappings, root_helper,
-                 polling_interval, reconnect_interval, lldp_timeout, rpc):
+                 polling_interval, reconnect_interval, lldp_timeout, rpc,
+                 use_ovsdb_monitor=False,
+                 full_resync_interval=60):
         '''Constructor.
 
         :param integ_br: name of the integration bridge.
@@ -140,6 +192,10 @@ class OVSQuantumAgent(object):
         :param polling_interval: interval (secs) to poll DB.
         :param reconnect_internal: retry interval (secs) on DB error.
         :param lldp_timeout: interval (minutes) to update lldp neighbors.
+        :param use_ovsdb_monitor: if True scan the bridges only when the
+            ovsdb Interface table changed.
+        :param full_resync_interval: interval (secs) to scan the bridges
+            even if no change was seen.
         :param rpc: if True use RPC interface to interface with plugin.
         '''
         self.root_helper = root_helper
@@ -153,6 +209,23 @@ class OVSQuantumAgent(object):
         self.reconnect_interval = reconnect_interval
         self.lldp_timeout = lldp_timeout
         self.local_ip = local_ip
+        self.full_resync_interval = full_resync_interval
+        self.nic_inventory = nic_inventory.NicInventory()
+        # (network_id, segmentation_id) casts waiting for the agent loop
+        self.network_updates = []
+        # vif -> mac of the nic it is bound to, kept by the agent loop
+        self.vm_eth_bindings = {}
+        # nic mac -> vifs of the vm eth bindings to the nics of this host,
+        # made again when the nics change
+        self.vm_eth_cache = None
+        # the bridges as read by the last scan of the agent loop
+        self.bridge_snapshot = None
+        self.ovsdb_monitor = None
+        if use_ovsdb_monitor:
+            self.ovsdb_monitor = ovsdb_monitor.OvsdbMonitor(root_helper)
+            self.ovsdb_monitor.start()
+        # switch vlan changes of one agent loop are sent together
+        self.switch_txn = None
 
         self.rpc = rpc
         if rpc:
@@ -162,7 +235,9 @@ class OVSQuantumAgent(object):
         mac = utils.get_interface_mac(integ_br)
         self.agent_id = '%s%s' % ('ovs', (mac.replace(":", "")))
         self.topic = topics.AGENT
-        self.plugin_rpc = agent_rpc.PluginApi(topics.PLUGIN)
+        self.plugin_rpc = RgosPluginApi(topics.PLUGIN)
+        # batch rpcs the plugin turned out not to have
+        self.unsupported_rpcs = set()
 
         # RPC network init
         self.context = context.RequestContext('quantum', 'quantum',
@@ -171,37 +246,43 @@ class OVSQuantumAgent(object):
         self.dispatcher = self.create_rpc_dispatcher()
         # Define the listening consumers for the agent
         consumers = [[topics.PORT, topics.UPDATE],
-                     [topics.NETWORK, topics.DELETE]]
-        self.connection = agent_rpc.create_consumers(self.dispatcher,
-                                                     self.topic,
-                                                     consumers)
+                     [topics.NETWORK, topics.DELETE],
+                     [topics.NETWORK, topics.UPDATE]]
+        self.connection = rpc.create_connection(new=True)
+        for table, operation in consumers:
+            topic_name = topics.get_topic_name(self.topic, table, operation)
+            self.connection.create_consumer(topic_name, self.dispatcher,
+                                            fanout=True)
+            # casts of the plugin aimed at the devices of this agent
+            self.connection.create_consumer('%s.%s' % (topic_name,
+                                                       self.agent_id),
+                                            self.dispatcher, fanout=False)
+        self.connection.consume_in_thread()
 
     # Used for get mac by linux vnic
     def get_interface_mac_list(self):
-        net = {}
-        f = open("/proc/net/dev")
-        lines = f.readlines()
-        f.close()
-        for line in lines[2:]:
-            con = line.split()
-            name = con[0].rstrip(":")
-            net[name] = utils.get_interface_mac(name)
-        
-        return net
+        return self.nic_inventory.get_macs()
     
-    # Used for get mac by ubuntu nic device
+    # Used for get mac by physical nic device
     def get_eth_mac_list(self):
-        net = {}
-        f = open("/proc/net/dev")
-        lines = f.readlines()
-        f.close()
-        for line in lines[2:]:
-            con = line.split()
-            name = con[0].rstrip(":")
-            if name[0:3] == "eth":
-                net[name] = utils.get_interface_mac(name)
-        
-        return net
+        return dict((name, rgos_db.normalize_mac(mac)) for name, mac in
+                    self.nic_inventory.get_uplink_macs().iteritems())
+
+    def get_vm_eth_bindings(self):
+        """Get {vif: mac} of the vm eth bindings in db to the nics of this
+        host, those of a vif that went away while the agent was down
+        included"""
+        macs = frozenset(self.get_eth_mac_list().values())
+        if self.vm_eth_cache is None or self.vm_eth_cache.keys != macs:
+            self.vm_eth_cache = rgos_db.ChangeLogCache(
+                constants.CHANGE_VM_ETH_BINDINGS,
+                lambda: load_vm_eth_bindings(macs),
+                load_vm_eth_binding, keys=macs)
+        res = {}
+        for mac, vifs in self.vm_eth_cache.refresh().iteritems():
+            for vif in vifs:
+                res[vif] = mac
+        return res
 
     def get_net_uuid(self, vif_id):
         for network_id, vlan_mapping in self.local_vlan_map.iteritems():
@@ -219,13 +300,24 @@ class OVSQuantumAgent(object):
         else:
             LOG.debug("Network %s not used on agent.", network_id)
 
+    def network_update(self, context, **kwargs):
+        network_id = kwargs.get('network_id')
+        network_type = kwargs.get('network_type')
+        segmentation_id = kwargs.get('segmentation_id')
+        LOG.debug("network_update received, %s segmentation id %s",
+                  network_id, segmentation_id)
+        if network_type != constants.TYPE_VLAN:
+            return
+        # applied by the agent loop, between its port changes
+        self.network_updates.append((network_id, segmentation_id))
+
     def port_update(self, context, **kwargs):
         LOG.debug("port_update received")
         port = kwargs.get('port')
         network_type = kwargs.get('network_type')
         segmentation_id = kwargs.get('segmentation_id')
         physical_network = kwargs.get('physical_network')
-        vif_port = self.int_br.get_vif_port_by_id(port['id'])
+        vif_port = self.get_vif_port(port['id'])
         self.treat_vif_port(vif_port, port['id'], port['network_id'],
                             network_type, physical_network,
                             segmentation_id, port['admin_state_up'])
@@ -358,34 +450,24 @@ class OVSQuantumAgent(object):
         LOG.debug('update ruijie vlan vif %s net_id %s seg_id %s', vif, net_uuid, old_seg_id) 
         switch_driver.update_ruijie_vlan(vif, net_uuid, old_seg_id)
 
-    def update_vlan(self, old_net_bindings, vm_eth_bindings):
-        new_net_bindings = rgos_vlanmgr.get_network_bindings()
-        vif_ids = set(vm_eth_bindings.keys())
-        vif_net_bindings = dict((vif_id, self.get_net_uuid(vif_id)) for vif_id in vif_ids)
-        LOG.debug('old_net_bindings %s', old_net_bindings) 
-        LOG.debug('new_net_bindings %s', new_net_bindings) 
-        LOG.debug('vif_ids %s', vif_ids) 
-        LOG.debug('vif_net_bindings %s', vif_net_bindings) 
-        
-        # update vm flows rules
-        for net_id, bind in new_net_bindings.items():
-            if net_id in old_net_bindings:
-                if bind.segmentation_id == old_net_bindings[net_id].segmentation_id:
-                    continue
-                if bind.network_type != constants.TYPE_VLAN:
-                    continue
-                self.update_vm_vlan(net_id, bind.segmentation_id)
-        
-        # update ruijie vlan 
-        for vif, vif_net_id in vif_net_bindings.items():
-            if vif_net_id in new_net_bindings and vif_net_id in old_net_bindings:
-                new_vid = new_net_bindings[vif_net_id].segmentation_id
-                old_vid = old_net_bindings[vif_net_id].segmentation_id
-                if new_vid != old_vid:
-                    self.update_ruijie_vlan(vif, vif_net_id, old_vid)
-
-                
-        return new_net_bindings
+    def update_vlan(self):
+        """Apply the segmentation id changes cast by the plugin"""
+        updates = self.network_updates
+        self.network_updates = []
+        for net_id, new_seg_id in updates:
+            lvm = self.local_vlan_map.get(net_id)
+            if lvm is None:
+                LOG.debug("Network %s not used on agent.", net_id)
+                continue
+            old_seg_id = lvm.segmentation_id
+            if old_seg_id == new_seg_id:
+                continue
+            # update vm flows rules
+            self.update_vm_vlan(net_id, new_seg_id)
+            # update ruijie vlan of the vifs bound to a nic
+            for vif in lvm.vif_ports:
+                if vif in self.vm_eth_bindings:
+                    self.update_ruijie_vlan(vif, net_id, old_seg_id)
             
     def port_bound(self, port, net_uuid,
                    network_type, physical_network, segmentation_id):
@@ -512,66 +594,36 @@ class OVSQuantumAgent(object):
         rgos_db.add_ruijie_vm_eth_binding(vif, eth_mac)
 
         # update Ruijie switch
-        switch_binding = rgos_db.get_ruijie_switch_eth_binding(eth_mac)
-        if switch_binding == []:
-            return;
-        ip = switch_binding[0].ip_address
-        ifx = switch_binding[0].port_id
-        ovs_binding = rgos_vlanmgr.get_network_binding(None, net_uuid)
-        if ovs_binding == None:
-            return
-        vlan = ovs_binding.segmentation_id
-        LOG.info("the switch ip is %s, ifx is %s, vlan is %s" 
-                 % (ip, ifx, vlan))
-        ruijie_vlan_binding = rgos_db.get_ruijie_vlan_binding(ip, ifx, vlan)
-        if ruijie_vlan_binding == []:
-            LOG.info("to set the vlan of ruijie switch now")
-            switch_driver.set_switch_vlan(ip, 22, ifx, vlan)
-        rgos_db.add_ruijie_vlan_binding(ip, ifx, vlan, vif)
+        self.set_ruijie_vlan(vif, net_uuid)
 
     def vm_eth_unbind(self, vif, eth_mac):
         LOG.debug('del vm eth binding, vif: %s eth_mac: %s', vif, eth_mac)
         net_uuid = self.get_net_uuid(vif)
+
+        # update Ruijie switch, while the vif still resolves to its port
+        self.unset_ruijie_vlan(vif, net_uuid)
         rgos_db.remove_ruijie_vm_eth_binding(vif, eth_mac)
 
-        # update Ruijie switch
-        switch_binding = rgos_db.get_ruijie_switch_eth_binding(eth_mac)
-        if switch_binding == []:
-            return;
-        ip = switch_binding[0].ip_address
-        ifx = switch_binding[0].port_id
-        ovs_binding = rgos_vlanmgr.get_network_binding(None, net_uuid)
-        if ovs_binding == None:
-            return
-        vlan = ovs_binding.segmentation_id
-        LOG.info("the switch ip is %s, ifx is %s, vlan is %s" 
-                 % (ip, ifx, vlan))
-        rgos_db.remove_ruijie_vlan_binding(ip, ifx, vlan, vif)
-        ruijie_vlan_binding = rgos_db.get_ruijie_vlan_binding(ip, ifx, vlan)
-        if ruijie_vlan_binding == []:
-            LOG.info("to set the vlan of ruijie switch now")
-            switch_driver.unset_switch_vlan(ip, 22, ifx, vlan)
-
-    def vm_eth_binding(self, old_bindings):
-        vifs = self.int_br.get_vif_port_set()
+    def vm_eth_binding(self, old_bindings, snapshot):
+        vifs = snapshot.get_vif_port_set(self.int_br.br_name)
         eths_mac = self.get_eth_mac_list()
         new_bindings = {}
         port_names = []
 
         # get eth in first physical network bridge
         for physical_network in self.phys_brs:
-            port_names = self.phys_brs[physical_network].get_port_name_list()
+            port_names = snapshot.get_port_names(
+                self.phys_brs[physical_network].br_name)
             if port_names != None:
                 break;
             # get eth in integration bridge
             else:
-                port_names = self.int_br.get_port_name_list() # ['eth1']
+                port_names = snapshot.get_port_names(self.int_br.br_name)
+        port_names = port_names or []
 
         # remove VM interface form port_names
-        for name in port_names:
-            external_ids = self.int_br.db_get_map("Interface", name, "external_ids")
-            if "attached-mac" in external_ids:
-                port_names.remove(name)
+        port_names = [name for name in port_names
+                      if "attached-mac" not in snapshot.get_external_ids(name)]
 
         # find Physical Ethernet card in OVS Bridge build new vm eth bindings
         for name in port_names:
@@ -610,15 +662,25 @@ class OVSQuantumAgent(object):
 
     def set_ruijie_vlan(self, vif_id, net_id):
         LOG.debug('Try to set ruijie vlan, vif_id %s, net_id %s', vif_id, net_id)
-        switch_driver.set_ruijie_vlan(vif_id, net_id)
+        switch_driver.set_ruijie_vlan(vif_id, net_id, self.switch_txn)
         
     def unset_ruijie_vlan(self, vif_id, net_id):
         LOG.debug('Try to unset ruijie vlan, vif_id %s, net_id %s', vif_id, net_id)
-        switch_driver.unset_ruijie_vlan(vif_id, net_id)
+        switch_driver.unset_ruijie_vlan(vif_id, net_id, self.switch_txn)
+
 
+    def get_vif_port(self, port_id):
+        """VifPort of port_id on the integration bridge, taken from the
+        last bridge snapshot when the port is in it"""
+        snapshot = self.bridge_snapshot
+        if snapshot is not None:
+            vif_port = snapshot.get_vif_port_by_id(self.int_br, port_id)
+            if vif_port is not None:
+                return vif_port
+        return self.int_br.get_vif_port_by_id(port_id)
 
-    def update_ports(self, registered_ports):
-        ports = self.int_br.get_vif_port_set()
+    def update_ports(self, registered_ports, snapshot):
+        ports = snapshot.get_vif_port_set(self.int_br.br_name)
         if ports == registered_ports:
             return
         added = ports - registered_ports
@@ -638,19 +700,50 @@ class OVSQuantumAgent(object):
         else:
             LOG.debug("No VIF port for port %s defined on agent.", port_id)
 
+    def call_batch_rpc(self, method, devices):
+        """Call a batch rpc of the plugin, None when the plugin only has
+        the per device call"""
+        if method in self.unsupported_rpcs:
+            return None
+        try:
+            return getattr(self.plugin_rpc, method)(self.context, devices,
+                                                    self.agent_id,
+                                                    self.RPC_API_VERSION)
+        except rpc_common.RemoteError as e:
+            if e.exc_type != RPC_UNSUPPORTED:
+                LOG.error("Plugin %s failed: %s %s", method, e.exc_type,
+                          e.value)
+                raise
+            LOG.info("Plugin has no %s, falling back to the per device rpc",
+                     method)
+            self.unsupported_rpcs.add(method)
+            return None
+
     def treat_devices_added(self, devices):
         resync = False
-        for device in devices:
+        try:
+            devices_details = self.call_batch_rpc('get_devices_details_list',
+                                                  list(devices))
+        except Exception as e:
+            LOG.debug("Unable to get port details for %s: %s", devices, e)
+            return True
+        if devices_details is None:
+            devices_details = []
+            for device in devices:
+                try:
+                    details = self.plugin_rpc.get_device_details(self.context,
+                                                                 device,
+                                                                 self.agent_id)
+                except Exception as e:
+                    LOG.debug("Unable to get port details for %s: %s",
+                              device, e)
+                    resync = True
+                    continue
+                devices_details.append(details)
+        for details in devices_details:
+            device = details['device']
             LOG.info("Port %s added", device)
-            try:
-                details = self.plugin_rpc.get_device_details(self.context,
-                                                             device,
-                                                             self.agent_id)
-            except Exception as e:
-                LOG.debug("Unable to get port details for %s: %s", device, e)
-                resync = True
-                continue
-            port = self.int_br.get_vif_port_by_id(details['device'])
+            port = self.get_vif_port(device)
             if 'port_id' in details:
                 LOG.info("Port %s updated. Details: %s", device, details)
                 self.treat_vif_port(port, details['port_id'],
@@ -667,32 +760,58 @@ class OVSQuantumAgent(object):
 
     def treat_devices_removed(self, devices):
         resync = False
-        for device in devices:
+        try:
+            devices_details = self.call_batch_rpc('update_devices_down_list',
+                                                  list(devices))
+        except Exception as e:
+            LOG.debug("port_removed failed for %s: %s", devices, e)
+            return True
+        if devices_details is None:
+            devices_details = []
+            for device in devices:
+                try:
+                    details = self.plugin_rpc.update_device_down(self.context,
+                                                                 device,
+                                                                 self.agent_id)
+                except Exception as e:
+                    LOG.debug("port_removed failed for %s: %s", device, e)
+                    resync = True
+                    continue
+                devices_details.append(details)
+        missing = []
+        for details in devices_details:
+            device = details['device']
             LOG.info("Attachment %s removed", device)
-            try:
-                details = self.plugin_rpc.update_device_down(self.context,
-                                                             device,
-                                                             self.agent_id)
-            except Exception as e:
-                LOG.debug("port_removed failed for %s: %s", device, e)
-                resync = True
             if details['exists']:
                 LOG.info("Port %s updated.", device)
                 # Nothing to do regarding local networking
             else:
                 LOG.debug("Device %s not defined on plugin", device)
-                self.port_unbound(device)
+                missing.append(device)
+        for device in missing:
+            self.port_unbound(device)
         return resync
 
     def process_network_ports(self, port_info):
         resync_a = False
         resync_b = False
-        if 'added' in port_info:
-            resync_a = self.treat_devices_added(port_info['added'])
-        if 'removed' in port_info:
-            resync_b = self.treat_devices_removed(port_info['removed'])
+        resync_c = False
+        self.switch_txn = switch_driver.SwitchVlanTransaction()
+        try:
+            if 'added' in port_info:
+                resync_a = self.treat_devices_added(port_info['added'])
+            if 'removed' in port_info:
+                resync_b = self.treat_devices_removed(port_info['removed'])
+        finally:
+            # push the ruijie switch vlan changes of all devices at once
+            txn = self.switch_txn
+            self.switch_txn = None
+            for intent, ok in txn.commit():
+                if not ok:
+                    # the next commit sends the failed change again
+                    resync_c = True
         # If one of the above opertaions fails => resync with plugin
-        return (resync_a | resync_b)
+        return (resync_a | resync_b | resync_c)
 
     def update_lldp_neighbor(self):
         resync = False
@@ -704,13 +823,20 @@ class OVSQuantumAgent(object):
         return (resync)
 
 
+    def wait_for_changes(self, timeout):
+        """Sleep up to timeout seconds, True if the bridges have to be
+        scanned"""
+        if self.ovsdb_monitor is None:
+            if timeout > 0:
+                time.sleep(timeout)
+            return True
+        return self.ovsdb_monitor.wait(timeout)
+
     def rpc_loop(self):
         sync = True
-        cnt = 0
+        changed = True
         ports = set()
-        vm_eth_bindings = {}
-        old_net_bindings = {}
-        scan = (self.lldp_timeout * 60)/self.polling_interval
+        last_lldp = last_resync = time.time()
 
         while True:
             start = time.time()
@@ -718,15 +844,35 @@ class OVSQuantumAgent(object):
                 LOG.info("Agent out of sync with plugin!")
                 ports.clear()
                 sync = False
-            
+                changed = True
+            if start - last_resync >= self.full_resync_interval:
+                changed = True
+            # read the bridges once for all scans of this iteration
+            scanned = False
+            if changed:
+                snapshot = ovs_snapshot.get_bridge_snapshot(self.root_helper)
+                if snapshot is not None:
+                    self.bridge_snapshot = snapshot
+                    last_resync = start
+                    scanned = True
+
             # update vm eth binding
-            LOG.debug('update vm eth bindings in rpc_roop') 
-            vm_eth_bindings = self.vm_eth_binding(vm_eth_bindings)
+            if scanned:
+                LOG.debug('update vm eth bindings in rpc_roop')
+                try:
+                    old_bindings = self.get_vm_eth_bindings()
+                except Exception as e:
+                    LOG.error("Unable to read the vm eth bindings: %s", e)
+                    old_bindings = self.vm_eth_bindings
+                self.vm_eth_bindings = self.vm_eth_binding(old_bindings,
+                                                           snapshot)
             
             # update vlan
-            old_net_bindings = self.update_vlan(old_net_bindings, vm_eth_bindings)
+            self.update_vlan()
 
-            port_info = self.update_ports(ports)
+            port_info = None
+            if scanned:
+                port_info = self.update_ports(ports, snapshot)
             # notify plugin about port deltas
             if port_info:
                 LOG.debug("Agent loop has new devices!")
@@ -735,20 +881,21 @@ class OVSQuantumAgent(object):
                 ports = port_info['current']
             
             # update lldp neighbor info between kvm and switch
-            if cnt >= scan:
+            if start - last_lldp >= self.lldp_timeout * 60:
                 LOG.debug("Agent loop start update lldp info !")
                 self.update_lldp_neighbor()
-                cnt = 0
-            else:
-                cnt = cnt +1
+                last_lldp = start
+
             
-            # sleep till end of polling interval
+            # sleep till end of polling interval, or till the ovsdb
+            # monitor sees a vif change
             elapsed = (time.time() - start)
-            if (elapsed < self.polling_interval):
-                time.sleep(self.polling_interval - elapsed)
-            else:
+            if (elapsed >= self.polling_interval):
                 LOG.debug("Loop iteration exceeded interval (%s vs. %s)!",
                           self.polling_interval, elapsed)
+            # a scan that could not read the bridges is retried
+            changed = (self.wait_for_changes(self.polling_interval - elapsed)
+                       or (changed and not scanned))
 
 
     def daemon_loop(self, db_connection_url):
@@ -770,6 +917,8 @@ def main():
     rpc = cfg.CONF.AGENT.rpc
     local_ip = cfg.CONF.RGOS.local_ip
     lldp_timeout = cfg.CONF.AGENT.lldp_timeout
+    use_ovsdb_monitor = cfg.CONF.AGENT.ovsdb_monitor
+    full_resync_interval = cfg.CONF.AGENT.full_resync_interval
     
     options = {"sql_connection": db_connection_url}
     options.update({"sql_max_retries": -1})
@@ -791,7 +940,8 @@ def main():
 
     plugin = OVSQuantumAgent(integ_br, local_ip, bridge_mappings,
                              root_helper, polling_interval, 
-                             reconnect_interval, lldp_timeout, rpc)
+                             reconnect_interval, lldp_timeout, rpc,
+                             use_ovsdb_monitor, full_resync_interval)
 
     # Start everything.
     plugin.daemon_loop(db_connection_url)
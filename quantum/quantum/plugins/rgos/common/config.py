@@ -40,6 +40,24 @@ rgos_opts = [
                 default=DEFAULT_VLAN_RANGES,
                 help="List of <physical_network>:<vlan_min>:<vlan_max> "
                 "or <physical_network>"),
+    cfg.FloatOpt('port_status_flush_window', default=0.5,
+                 help="Seconds port status changes reported by the agents "
+                 "are kept before they are written together, 0 writes "
+                 "them at once"),
+    cfg.IntOpt('port_status_flush_max', default=200,
+               help="Number of kept port status changes that are written "
+               "before the window ends"),
+    cfg.IntOpt('change_log_keep', default=10000,
+               help="Number of newest changes kept in the ruijie change "
+               "log when it is compacted"),
+    cfg.IntOpt('change_log_compact_interval', default=600,
+               help="Interval (secs) to compact the ruijie change log, "
+               "0 never compacts it"),
+    cfg.StrOpt('reconcile_mode', default='off',
+               help="Switch vlan reconciliation run by the plugin (off, "
+               "dry_run or enforce)"),
+    cfg.IntOpt('reconcile_interval', default=5,
+               help="Interval (minutes) to reconcile switch vlans"),
 ]
 
 switch_opts = [
@@ -47,11 +65,28 @@ switch_opts = [
                 help="List of <index>:<username>:<password>:<server>:<port>; "),
     cfg.IntOpt('ssh_max_retries', default=-1),
     cfg.IntOpt('reconnect_interval', default=2),
+    cfg.IntOpt('ssh_idle_timeout', default=300,
+               help="Seconds an idle switch ssh session is kept for reuse, "
+               "0 closes it after every use"),
+    cfg.IntOpt('ssh_cli_timeout', default=30,
+               help="Seconds to wait for the switch prompt after a cli"),
+    cfg.IntOpt('switch_inventory_ttl', default=60,
+               help="Seconds the switch ssh host and user config is "
+               "cached before it is read from the db again"),
+    cfg.StrOpt('lldp_scan_mode', default='detail',
+               help="LLDP scan (detail, or summary to read the details "
+               "only of ports whose neighbors changed)"),
 ]
 
 agent_opts = [
     cfg.IntOpt('polling_interval', default=2),
     cfg.IntOpt('lldp_timeout', default=2),
+    cfg.BoolOpt('ovsdb_monitor', default=True,
+                help="Scan the bridges only when ovsdb-client monitor "
+                "reports an interface change"),
+    cfg.IntOpt('full_resync_interval', default=60,
+               help="Interval (secs) to scan the bridges even if no "
+               "interface change was reported"),
     cfg.StrOpt('root_helper', default='sudo'),
     cfg.BoolOpt('rpc', default=True),
 ]
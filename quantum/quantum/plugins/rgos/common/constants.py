@@ -23,3 +23,16 @@ TYPE_NONE = 'none'
 # with the physical bridge for a physical network
 VETH_INTEGRATION_PREFIX = 'int-'
 VETH_PHYSICAL_PREFIX = 'phy-'
+
+# Tables and operations recorded in the ruijie change log
+CHANGE_SWITCH_ETH_BINDINGS = 'switch_eth_bindings'
+CHANGE_VM_ETH_BINDINGS = 'vm_eth_bindings'
+CHANGE_VLAN_BINDINGS = 'vlan_bindings'
+CHANGE_NETWORK_BINDINGS = 'network_bindings'
+CHANGE_VLAN_ALLOCATIONS = 'vlan_allocations'
+CHANGE_VLAN_RANGES = 'vlan_free_ranges'
+CHANGE_LLDP_FINGERPRINTS = 'lldp_fingerprints'
+CHANGE_SWITCH_CFG = 'switch_cfg'
+OP_ADD = 'add'
+OP_REMOVE = 'remove'
+OP_UPDATE = 'update'
@@ -0,0 +1,132 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time the ruijie binding lookups on the old and the typed, indexed layout.
+
+The tables are built from the models on an in-memory sqlite database,
+the old layout from the same tables with every column a String(255)
+and no secondary index, and the lookups are those of rgos_db, so it
+needs no database server.
+
+python -m quantum.plugins.rgos.db.bench_bindings [rows]
+"""
+
+import random
+import sys
+import time
+
+from sqlalchemy import Column, MetaData, String, Table
+
+import quantum.db.api as db
+from quantum.db import models_v2
+from quantum.plugins.rgos.db import rgos_db
+from quantum.plugins.rgos.db import rgos_models
+
+INSERT_CHUNK = 1000
+# (name, rgos_db lookup, number of lookups)
+LOOKUPS = (
+    ('switch eth mac', rgos_db.get_ruijie_switch_eth_binding, 2000),
+    ('switch eth ip', rgos_db.get_ruijie_switch_eth_binding_byhost, 2000),
+    ('vlan binding', rgos_db.get_ruijie_vlan_binding, 2000),
+    ('vm eth vif', rgos_db.get_ruijie_vm_eth_binding, 2000),
+    ('vm eth mac', rgos_db.get_ruijie_vm_eth_bindings_bymacs, 2000),
+)
+
+
+def get_old_table(table):
+    """The table as it was before the columns were typed and indexed"""
+
+    return Table(table.name, MetaData(),
+                 *[Column(c.name, String(255), primary_key=c.primary_key)
+                   for c in table.columns])
+
+
+def get_rows(count):
+    eth_rows = []
+    vlan_rows = []
+    vm_eth_rows = []
+    for i in xrange(count):
+        ip = '10.0.%d.%d' % (i // 48 // 250, i // 48 % 250)
+        mac = '00:50:%02x:%02x:%02x:%02x' % (i >> 24 & 255, i >> 16 & 255,
+                                             i >> 8 & 255, i & 255)
+        port = 'GigabitEthernet 0/%d' % (i % 48)
+        vif = '%08x-0000-0000-0000-%012x' % (i, i)
+        eth_rows.append({'ip_address': ip, 'mac_address': mac,
+                         'port_id': port})
+        vlan_rows.append({'ip_address': ip, 'port_id': port,
+                          'vlan_id': i % 4000 + 1, 'intf_uuid': vif})
+        vm_eth_rows.append({'intf_uuid': vif, 'mac_address': mac})
+    return eth_rows, vlan_rows, vm_eth_rows
+
+
+def load_tables(engine, tables, rows):
+    for table, table_rows in zip(tables, rows):
+        table.drop(bind=engine, checkfirst=True)
+        table.create(bind=engine)
+        for i in xrange(0, len(table_rows), INSERT_CHUNK):
+            engine.execute(table.insert(), table_rows[i:i + INSERT_CHUNK])
+
+
+def time_lookups(lookup, args):
+    """Mean time of one lookup in microseconds"""
+
+    start = time.time()
+    for arg in args:
+        lookup(*arg)
+    return (time.time() - start) / len(args) * 1e6
+
+
+def main(argv):
+    count = len(argv) > 1 and int(argv[1]) or 100000
+    db.configure_db({'sql_connection': 'sqlite://',
+                     'base': models_v2.model_base.BASEV2})
+    engine = db.get_session().bind
+    rows = get_rows(count)
+    eth_rows, vlan_rows, vm_eth_rows = rows
+    sample = random.Random(1).sample(xrange(count), 2000)
+    args = {
+        'switch eth mac': [(eth_rows[i]['mac_address'],) for i in sample],
+        'switch eth ip': [(eth_rows[i]['ip_address'],) for i in sample],
+        'vlan binding': [(vlan_rows[i]['ip_address'],
+                          vlan_rows[i]['port_id'],
+                          vlan_rows[i]['vlan_id']) for i in sample],
+        'vm eth vif': [(vm_eth_rows[i]['intf_uuid'],) for i in sample],
+        'vm eth mac': [([vm_eth_rows[i]['mac_address']],) for i in sample],
+    }
+    # in the order of the rows
+    tables = [rgos_models.RuijieSwitchEthBinding.__table__,
+              rgos_models.RuijieVlanBinding.__table__,
+              rgos_models.RuijieVmEthBinding.__table__]
+    # the old layout stored every value as a string
+    old_rows = [[dict((k, str(v)) for k, v in row.iteritems())
+                 for row in table_rows] for table_rows in rows]
+    layouts = (('old', [get_old_table(t) for t in tables], old_rows),
+               ('new', tables, rows))
+    results = {}
+    for layout, layout_tables, layout_rows in layouts:
+        load_tables(engine, layout_tables, layout_rows)
+        for name, lookup, lookups in LOOKUPS:
+            results[(layout, name)] = time_lookups(lookup,
+                                                   args[name][:lookups])
+    print '%d rows per table, mean lookup time' % count
+    for name, lookup, lookups in LOOKUPS:
+        print '%-16s %10.1fus -> %8.1fus' % (name, results[('old', name)],
+                                             results[('new', name)])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
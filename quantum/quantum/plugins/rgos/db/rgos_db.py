@@ -16,15 +16,29 @@
 #
 # @author: Shifu Miao, Ruijie Networks, Inc.
 import logging
+import time
+from sqlalchemy import and_, func, or_
+from sqlalchemy import exc as sa_exc
 from sqlalchemy.orm import exc
 import quantum.db.api as db
 from quantum.openstack.common import cfg
 from quantum.db import models_v2
+from quantum.plugins.rgos.common import constants
+from quantum.plugins.rgos.db import rgos_migration
 from quantum.plugins.rgos.db import rgos_models
 
 logging.basicConfig()
 LOG = logging.getLogger(__name__)
 
+# rows per set based statement, keeps the bound parameters of one
+# statement below the limits of the database drivers
+BULK_CHUNK = 250
+# seconds a seq missing from the change log is looked for again, its
+# transaction may still commit
+CHANGE_GAP_TIMEOUT = 300
+# seqs before the last one checked for gaps when a table is read in full
+CHANGE_GAP_WINDOW = 1000
+
 def initialize():
     options = {"sql_connection": "%s" % cfg.CONF.DATABASE.sql_connection}
     options.update({"sql_max_retries": cfg.CONF.DATABASE.sql_max_retries})
@@ -32,7 +46,151 @@ def initialize():
                    cfg.CONF.DATABASE.reconnect_interval})
     options.update({"base": models_v2.model_base.BASEV2})
     db.configure_db(options)
+    rgos_migration.upgrade(db.get_session().bind)
+
+
+def log_change(session, table, key, op):
+    """Append a write of table to the change log, it is committed with
+    the transaction of session"""
+    session.add(rgos_models.RuijieChange(table, key, op))
+
+def log_changes(session, table, keys, op):
+    rows = [{'table_name': table, 'key': key, 'op': op}
+            for key in sorted(set(keys))]
+    for i in xrange(0, len(rows), BULK_CHUNK):
+        session.execute(rgos_models.RuijieChange.__table__.insert(),
+                        rows[i:i + BULK_CHUNK])
+
+def get_change_seq():
+    """Get the seq of the last change, 0 when there is none"""
+    session = db.get_session()
+    return session.query(func.max(rgos_models.RuijieChange.seq)).scalar() or 0
+
+def changes_since(seq, tables=None, gaps=()):
+    """Get (last seq, [(seq, table, key, op)], missing seqs) of the
+    changes after seq and of the changes in gaps.
 
+    A seq is taken when a change is added, so a change of a transaction
+    that is still open is not in the log yet while newer ones are. The
+    missing seqs up to last are returned, pass them as gaps to read them
+    once they are committed.
+
+    Returns None when the log was compacted past seq or a gap, the
+    caller has to read the tables in full then.
+    """
+    model = rgos_models.RuijieChange
+    gaps = set(gaps)
+    session = db.get_session()
+    first, last = session.query(func.min(model.seq), func.max(model.seq)).one()
+    if last is None or (last <= seq and not gaps):
+        return (seq, [], gaps)
+    if min(gaps or [seq + 1]) < first or seq < first - 1:
+        return None
+    last = max(last, seq)
+    query = (session.query(model.seq, model.table_name, model.key, model.op).
+             filter(model.seq <= last))
+    if gaps:
+        query = query.filter(or_(model.seq > seq,
+                                 model.seq.in_(sorted(gaps))))
+    else:
+        query = query.filter(model.seq > seq)
+    rows = query.order_by(model.seq).all()
+    missing = (gaps | set(xrange(seq + 1, last + 1))) - set(x.seq for x in rows)
+    return (last, [(x.seq, x.table_name, x.key, x.op) for x in rows
+                   if not tables or x.table_name in tables], missing)
+
+def get_change_gaps(seq, window=CHANGE_GAP_WINDOW):
+    """Get the seqs up to seq, at most window back, missing from the
+    change log"""
+    model = rgos_models.RuijieChange
+    session = db.get_session()
+    first = session.query(func.min(model.seq)).scalar()
+    if first is None:
+        return set()
+    start = max(seq - window, first - 1)
+    rows = (session.query(model.seq).
+            filter(model.seq > start).filter(model.seq <= seq).all())
+    return set(xrange(start + 1, seq + 1)) - set(x.seq for x in rows)
+
+def compact_changes(keep):
+    """Drop all but the newest keep changes, returns how many were
+    dropped"""
+    model = rgos_models.RuijieChange
+    session = db.get_session()
+    with session.begin(subtransactions=True):
+        last = session.query(func.max(model.seq)).scalar()
+        if last is None:
+            return 0
+        # the newest change always stays, so seq never goes back
+        return (session.query(model).
+                filter(model.seq <= last - max(keep, 1)).
+                delete(synchronize_session=False))
+
+
+class ChangeLogCache(object):
+    """Rows of a ruijie table kept up to date from the change log.
+
+    load_all() returns {key: value} of the whole table and load_key(key)
+    the value of one key, None once it is gone. refresh() reads again
+    only the keys changed since the last refresh, of those in keys when
+    it is given, load_all() then only loads those too. Seqs missing from the
+    log, of transactions still open, are looked for again by every
+    refresh for gap_timeout seconds. The whole table is read the first
+    time, when the log was compacted past the cache, and every
+    full_interval seconds.
+    """
+
+    def __init__(self, table, load_all, load_key, full_interval=3600,
+                 gap_timeout=CHANGE_GAP_TIMEOUT, keys=None):
+        self.table = table
+        self.keys = keys
+        self.load_all = load_all
+        self.load_key = load_key
+        self.full_interval = full_interval
+        self.gap_timeout = gap_timeout
+        self.rows = {}
+        self.seq = None
+        # seq -> time it was first missed
+        self.gaps = {}
+        self.loaded = 0
+
+    def refresh(self):
+        now = time.time()
+        if self.seq is not None and now - self.loaded < self.full_interval:
+            for seq, since in self.gaps.items():
+                if now - since > self.gap_timeout:
+                    # rolled back, the seq never shows up
+                    del self.gaps[seq]
+            res = changes_since(self.seq, [self.table], self.gaps.keys())
+            if res is not None:
+                last, changes, missing = res
+                for key in set(x[2] for x in changes):
+                    if self.keys is not None and key not in self.keys:
+                        continue
+                    value = self.load_key(key)
+                    if value is None:
+                        self.rows.pop(key, None)
+                    else:
+                        self.rows[key] = value
+                self.gaps = dict((seq, self.gaps.get(seq, now))
+                                 for seq in missing)
+                self.seq = last
+                return self.rows
+        seq = get_change_seq()
+        gaps = get_change_gaps(seq)
+        self.rows = self.load_all()
+        self.seq = seq
+        self.gaps = dict((x, now) for x in gaps)
+        self.loaded = now
+        return self.rows
+
+
+def normalize_mac(mac):
+    """The macs are stored lower case, the joins of the vm eth and switch
+    eth bindings compare them as they are"""
+    if mac is None:
+        return None
+    return mac.strip().lower()
 
 def get_ruijie_switch_eth_bindings():
     session = db.get_session()
@@ -49,7 +207,7 @@ def get_ruijie_switch_eth_bindings():
 def get_ruijie_switch_eth_binding(mac):
     session = db.get_session()
     return (session.query(rgos_models.RuijieSwitchEthBinding).
-            filter_by(mac_address=mac).
+            filter_by(mac_address=normalize_mac(mac)).
             all())
 
 def get_ruijie_switch_eth_binding_byhost(ip):
@@ -66,17 +224,21 @@ def get_ruijie_switch_eth_binding_byhost(ip):
     
 
 def remove_ruijie_switch_eth_binding(ip, mac, port):
+    mac = normalize_mac(mac)
     session = db.get_session()
     try:
         binding = (session.query(rgos_models.RuijieSwitchEthBinding).
                    filter_by(ip_address=ip, mac_address=mac, port_id=port).
                    one())
         session.delete(binding)
+        log_change(session, constants.CHANGE_SWITCH_ETH_BINDINGS, ip,
+                   constants.OP_REMOVE)
     except exc.NoResultFound:
             pass
     session.flush()
 
 def add_ruijie_switch_eth_binding(ip, mac, port):
+    mac = normalize_mac(mac)
     session = db.get_session()
     binding = (session.query(rgos_models.RuijieSwitchEthBinding).
                    filter_by(ip_address=ip, mac_address=mac).
@@ -85,9 +247,81 @@ def add_ruijie_switch_eth_binding(ip, mac, port):
         return
     binding = rgos_models.RuijieSwitchEthBinding(ip, mac, port)
     session.add(binding)
+    log_change(session, constants.CHANGE_SWITCH_ETH_BINDINGS, ip,
+               constants.OP_ADD)
     session.flush()
     return
 
+def bulk_add_switch_eth_bindings(bindings):
+    """Add (ip, mac, port) bindings in one transaction.
+
+    A mac that is already bound to a switch port is skipped, like in
+    add_ruijie_switch_eth_binding. Returns the bindings added.
+    """
+    model = rgos_models.RuijieSwitchEthBinding
+    bindings = [(ip, normalize_mac(mac), port) for ip, mac, port in bindings]
+    added = []
+    session = db.get_session()
+    with session.begin(subtransactions=True):
+        existing = set()
+        for i in xrange(0, len(bindings), BULK_CHUNK):
+            macs = set(x[1] for x in bindings[i:i + BULK_CHUNK])
+            rows = (session.query(model.mac_address).
+                    filter(model.mac_address.in_(macs)).all())
+            existing.update(x.mac_address for x in rows)
+        for ip, mac, port in bindings:
+            if mac in existing:
+                LOG.debug("bulk_add_switch_eth_bindings mac %s already "
+                          "existed", mac)
+                continue
+            existing.add(mac)
+            added.append((ip, mac, port))
+        for i in xrange(0, len(added), BULK_CHUNK):
+            session.execute(model.__table__.insert(),
+                            [{'ip_address': ip, 'mac_address': mac,
+                              'port_id': port}
+                             for ip, mac, port in added[i:i + BULK_CHUNK]])
+        log_changes(session, constants.CHANGE_SWITCH_ETH_BINDINGS,
+                    [x[0] for x in added], constants.OP_ADD)
+    return added
+
+def bulk_remove_switch_eth_bindings(bindings):
+    """Remove (ip, mac, port) bindings in one transaction"""
+    model = rgos_models.RuijieSwitchEthBinding
+    bindings = [(ip, normalize_mac(mac), port) for ip, mac, port in bindings]
+    session = db.get_session()
+    with session.begin(subtransactions=True):
+        for i in xrange(0, len(bindings), BULK_CHUNK):
+            match = [and_(model.ip_address == ip, model.mac_address == mac,
+                          model.port_id == port)
+                     for ip, mac, port in bindings[i:i + BULK_CHUNK]]
+            (session.query(model).filter(or_(*match)).
+             delete(synchronize_session=False))
+        log_changes(session, constants.CHANGE_SWITCH_ETH_BINDINGS,
+                    [x[0] for x in bindings], constants.OP_REMOVE)
+
+def get_ruijie_lldp_fingerprint(ip):
+    session = db.get_session()
+    try:
+        binding = (session.query(rgos_models.RuijieLldpFingerprint).
+                   filter_by(ip_address=ip).one())
+    except exc.NoResultFound:
+        return None
+    return binding.fingerprint
+
+def set_ruijie_lldp_fingerprint(ip, fingerprint):
+    session = db.get_session()
+    with session.begin(subtransactions=True):
+        try:
+            binding = (session.query(rgos_models.RuijieLldpFingerprint).
+                       filter_by(ip_address=ip).one())
+            binding.fingerprint = fingerprint
+        except exc.NoResultFound:
+            binding = rgos_models.RuijieLldpFingerprint(ip, fingerprint)
+            session.add(binding)
+        log_change(session, constants.CHANGE_LLDP_FINGERPRINTS, ip,
+                   constants.OP_UPDATE)
+
 def get_ruijie_vm_eth_bindings():
     session = db.get_session()
     try:
@@ -100,6 +334,19 @@ def get_ruijie_vm_eth_bindings():
         res.append((x.intf_uuid, x.mac_address))
     return res
 
+def get_ruijie_vm_eth_bindings_bymacs(macs):
+    """Get (vif, mac) of the vm eth bindings to the given macs"""
+    model = rgos_models.RuijieVmEthBinding
+    macs = sorted(set(normalize_mac(mac) for mac in macs))
+    session = db.get_session()
+    res = []
+    for i in xrange(0, len(macs), BULK_CHUNK):
+        rows = (session.query(model).
+                filter(model.mac_address.in_(macs[i:i + BULK_CHUNK])).
+                all())
+        res.extend((x.intf_uuid, x.mac_address) for x in rows)
+    return res
+
 def get_ruijie_vm_eth_binding(id):
     session = db.get_session()
     return (session.query(rgos_models.RuijieVmEthBinding).
@@ -107,17 +354,22 @@ def get_ruijie_vm_eth_binding(id):
             all())
 
 def remove_ruijie_vm_eth_binding(id, mac):
+    mac = normalize_mac(mac)
     session = db.get_session()
     try:
         binding = (session.query(rgos_models.RuijieVmEthBinding).
                    filter_by(intf_uuid=id, mac_address=mac).
                    one())
         session.delete(binding)
+        # keyed by the nic, each agent only follows its own
+        log_change(session, constants.CHANGE_VM_ETH_BINDINGS, mac,
+                   constants.OP_REMOVE)
     except exc.NoResultFound:
             pass
     session.flush()
     
 def add_ruijie_vm_eth_binding(id, mac):
+    mac = normalize_mac(mac)
     session = db.get_session()
     binding = (session.query(rgos_models.RuijieVmEthBinding).
                    filter_by(intf_uuid=id, mac_address=mac).
@@ -126,6 +378,8 @@ def add_ruijie_vm_eth_binding(id, mac):
         return
     binding = rgos_models.RuijieVmEthBinding(id, mac)
     session.add(binding)
+    log_change(session, constants.CHANGE_VM_ETH_BINDINGS, mac,
+               constants.OP_ADD)
     session.flush()
     return
 
@@ -141,51 +395,218 @@ def get_ruijie_vlan_bindings():
         res.append((x.ip_address, x.port_id, x.vlan_id, x.intf_uuid))
     return res
 
+def get_ruijie_vlan_bindings_byhost(ip):
+    session = db.get_session()
+    bindings = (session.query(rgos_models.RuijieVlanBinding).
+                filter_by(ip_address=ip).all())
+    return [(x.ip_address, x.port_id, x.vlan_id, x.intf_uuid)
+            for x in bindings]
+
 def get_ruijie_vlan_binding(ip, port, vlan):
     session = db.get_session()
     return (session.query(rgos_models.RuijieVlanBinding).
-            filter_by(ip_address=ip, port_id=port, vlan_id=vlan).
+            filter_by(ip_address=ip, port_id=port, vlan_id=int(vlan)).
             all())
 
+def get_ruijie_port_vlans(ip, port):
+    """Get the set of vlans bound on one switch port"""
+    session = db.get_session()
+    bindings = (session.query(rgos_models.RuijieVlanBinding.vlan_id).
+                filter_by(ip_address=ip, port_id=port).
+                distinct().all())
+    return set(int(x.vlan_id) for x in bindings)
+
+def get_ruijie_vlan_port_users(ip, port, vlan):
+    """Get the number of vifs using a vlan on a switch port.
+
+    The port reference and the vlan bindings are read in one
+    transaction, the larger of the two counts is returned. Nothing stays
+    locked, see claim_ruijie_vlan_ports() to remove a vlan.
+    """
+    session = db.get_session()
+    with session.begin(subtransactions=True):
+        refs = (session.query(rgos_models.RuijieVlanPortRef.refs).
+                filter_by(ip_address=ip, port_id=port, vlan_id=int(vlan)).
+                scalar())
+        bound = (session.query(rgos_models.RuijieVlanBinding).
+                 filter_by(ip_address=ip, port_id=port, vlan_id=int(vlan)).
+                 count())
+    return max(refs or 0, bound)
+
+def claim_ruijie_vlan_ports(ports, func):
+    """Call func with the vlans of ports no vif uses, keeping them locked.
+
+    ports is a list of (ip, port, vlan). The port ref of each one is
+    locked, a row with refs 0 is added for the ones without, and
+    func(free) is called inside the same transaction with the set of
+    ports whose refs and bindings are 0. An agent binding a vif to one of
+    them meanwhile waits for the row until func returned, so its switch
+    add comes after the remove func sends. Returns what func returns.
+    """
+    model = rgos_models.RuijieVlanPortRef
+    session = db.get_session()
+    with session.begin(subtransactions=True):
+        free = set()
+        # always lock in the same order, agents claim their removes too
+        for ip, port, vlan in sorted(set(ports)):
+            query = (session.query(model).
+                     filter_by(ip_address=ip, port_id=port, vlan_id=int(vlan)))
+            if query.with_lockmode('update').first() is None:
+                try:
+                    with session.begin_nested():
+                        session.add(model(ip, port, int(vlan), 0))
+                except sa_exc.IntegrityError:
+                    pass
+            refs = (session.query(model.refs).
+                    filter_by(ip_address=ip, port_id=port, vlan_id=int(vlan)).
+                    with_lockmode('update').scalar())
+            bound = (session.query(rgos_models.RuijieVlanBinding).
+                     filter_by(ip_address=ip, port_id=port, vlan_id=int(vlan)).
+                     count())
+            if not refs and bound == 0:
+                free.add((ip, port, int(vlan)))
+        res = func(free)
+        for ip, port, vlan in free:
+            (session.query(model).
+             filter_by(ip_address=ip, port_id=port, vlan_id=vlan, refs=0).
+             delete(synchronize_session=False))
+    return res
+
+def change_ruijie_vlan_port_refs(session, ip, port, vlan, delta):
+    """Atomically add delta to the vifs using a vlan on a switch port.
+
+    Runs as UPDATE ... SET refs = refs + delta inside the transaction of
+    session, which keeps the row locked until it ends, so concurrent
+    agents see every transition. The vlan binding of the change must
+    already be added or removed in session. Returns the refs after the
+    change.
+    """
+    model = rgos_models.RuijieVlanPortRef
+    query = (session.query(model).
+             filter_by(ip_address=ip, port_id=port, vlan_id=vlan))
+    updated = (query.filter(model.refs + delta >= 0).
+               update({'refs': model.refs + delta},
+                      synchronize_session=False))
+    if updated == 0:
+        # no row, or one that would drop below zero: the refs are not
+        # known, count them again from the vlan bindings
+        refs = (session.query(rgos_models.RuijieVlanBinding).
+                filter_by(ip_address=ip, port_id=port, vlan_id=vlan).
+                count())
+        LOG.warning("vlan %s port refs of %s %s unknown, counted %d",
+                    vlan, ip, port, refs)
+        if query.update({'refs': refs}, synchronize_session=False) == 0:
+            if refs == 0:
+                return 0
+            try:
+                with session.begin_nested():
+                    session.add(model(ip, port, vlan, refs))
+                return refs
+            except sa_exc.IntegrityError:
+                # another agent added the row meanwhile, update it
+                return change_ruijie_vlan_port_refs(session, ip, port, vlan,
+                                                    delta)
+    refs = (session.query(model.refs).
+            filter_by(ip_address=ip, port_id=port, vlan_id=vlan).
+            scalar())
+    if refs == 0:
+        query.delete(synchronize_session=False)
+    return refs
+
 def remove_ruijie_vlan_binding(ip, port, vlan, uuid):
+    """Remove the vlan binding of a vif and release its port reference.
+
+    Returns the refs of the vlan on the port after the change, 0 when
+    the vlan is no longer used there, or None when the vif was not bound.
+    """
     session = db.get_session()
-    try:
-        binding = (session.query(rgos_models.RuijieVlanBinding).
-                   filter_by(ip_address=ip, port_id=port, vlan_id=vlan
-                             ,intf_uuid=uuid).one())
-        session.delete(binding)
-    except exc.NoResultFound:
-            pass
-    session.flush()
+    with session.begin(subtransactions=True):
+        removed = (session.query(rgos_models.RuijieVlanBinding).
+                   filter_by(ip_address=ip, port_id=port, vlan_id=int(vlan),
+                             intf_uuid=uuid).
+                   delete(synchronize_session=False))
+        if removed == 0:
+            return None
+        log_change(session, constants.CHANGE_VLAN_BINDINGS, ip,
+                   constants.OP_REMOVE)
+        return change_ruijie_vlan_port_refs(session, ip, port, int(vlan), -1)
 
 def add_ruijie_vlan_binding(ip, port, vlan, uuid):
+    """Add the vlan binding of a vif and take a port reference.
+
+    Returns the refs of the vlan on the port after the change, 1 when
+    the vif is its first user, or None when the vif was already bound.
+    """
     session = db.get_session()
-    binding = (session.query(rgos_models.RuijieVlanBinding).
-                   filter_by(ip_address=ip, port_id=port, vlan_id=vlan
-                             ,intf_uuid=uuid).all())
-    if binding != []:
-        return
-    binding = rgos_models.RuijieVlanBinding(ip, port, vlan, uuid)
-    session.add(binding)
-    session.flush()
-    return 
+    with session.begin(subtransactions=True):
+        binding = (session.query(rgos_models.RuijieVlanBinding).
+                   filter_by(ip_address=ip, port_id=port, vlan_id=int(vlan),
+                             intf_uuid=uuid).all())
+        if binding != []:
+            return None
+        binding = rgos_models.RuijieVlanBinding(ip, port, int(vlan), uuid)
+        session.add(binding)
+        log_change(session, constants.CHANGE_VLAN_BINDINGS, ip,
+                   constants.OP_ADD)
+        session.flush()
+        return change_ruijie_vlan_port_refs(session, ip, port, int(vlan), 1)
+
+
+def resolve_ruijie_vif_ports(vif_nets):
+    """Resolve vifs to the switch port and vlan of their network.
+
+    vif_nets is a dict of vif id to network id. Runs one joined query of
+    vm eth, switch eth, network and vlan bindings and returns a dict of
+    vif id to (switch ip, ifx, segmentation id, refcount) for the vifs on
+    vlan networks behind a switch port. refcount is the number of vifs
+    using that vlan on the port.
+    """
+    vm_eth = rgos_models.RuijieVmEthBinding
+    switch_eth = rgos_models.RuijieSwitchEthBinding
+    network = rgos_models.RuijieNetworkBinding
+    port_ref = rgos_models.RuijieVlanPortRef
+    session = db.get_session()
+    refcount = (session.query(port_ref.refs).
+                filter(port_ref.ip_address == switch_eth.ip_address,
+                       port_ref.port_id == switch_eth.port_id,
+                       port_ref.vlan_id == network.segmentation_id).
+                correlate(switch_eth, network).
+                as_scalar())
+    pairs = [(vif_id, net_id) for vif_id, net_id in vif_nets.iteritems()
+             if net_id]
+    res = {}
+    for i in xrange(0, len(pairs), BULK_CHUNK):
+        match = [and_(vm_eth.intf_uuid == vif_id, network.network_id == net_id)
+                 for vif_id, net_id in pairs[i:i + BULK_CHUNK]]
+        rows = (session.query(vm_eth.intf_uuid, switch_eth.ip_address,
+                              switch_eth.port_id, network.segmentation_id,
+                              refcount).
+                join((switch_eth,
+                      switch_eth.mac_address == vm_eth.mac_address)).
+                filter(network.network_type == constants.TYPE_VLAN).
+                filter(or_(*match)).
+                all())
+        for vif_id, ip, port, segmentation_id, refs in rows:
+            res[vif_id] = (ip, port, segmentation_id, refs or 0)
+    return res
 
+def resolve_ruijie_vif_port(vif_id, net_id):
+    """resolve_ruijie_vif_ports for one vif, None if it is not resolved"""
+    return resolve_ruijie_vif_ports({vif_id: net_id}).get(vif_id)
 
 def get_ruijie_attached_ip(vif_id, net_id):
     LOG.info("get_ruijie_attached_ip, vif id is %s, net id is %s" 
              % (vif_id, net_id))
-    ip = ''
-    vm_eth_binding = get_ruijie_vm_eth_binding(vif_id)
-    if vm_eth_binding == []:
-        return ip;
-    mac_address = vm_eth_binding[0].mac_address
-    LOG.info("get_ruijie_attached_ip mac_address = %s " % mac_address)
-    switch_binding = get_ruijie_switch_eth_binding(mac_address)
-    if switch_binding == []:
-        return ip;
-    ip = switch_binding[0].ip_address
-
-    return ip
+    session = db.get_session()
+    switch_eth = rgos_models.RuijieSwitchEthBinding
+    vm_eth = rgos_models.RuijieVmEthBinding
+    binding = (session.query(switch_eth.ip_address).
+               join((vm_eth, vm_eth.mac_address == switch_eth.mac_address)).
+               filter(vm_eth.intf_uuid == vif_id).
+               first())
+    if binding is None:
+        return ''
+    return binding.ip_address
 
 
 def get_port(port_id):
@@ -208,6 +629,104 @@ def set_port_status(port_id, status):
         raise q_exc.PortNotFound(port_id=port_id)
 
 
+def get_ports_with_bindings(port_ids):
+    """Get {port id: (port, network binding)} of many ports in one query,
+    the binding is None for a network without one"""
+    port = models_v2.Port
+    binding = rgos_models.RuijieNetworkBinding
+    port_ids = list(set(port_ids))
+    session = db.get_session()
+    res = {}
+    for i in xrange(0, len(port_ids), BULK_CHUNK):
+        rows = (session.query(port, binding).
+                outerjoin((binding, binding.network_id == port.network_id)).
+                filter(port.id.in_(port_ids[i:i + BULK_CHUNK])).
+                all())
+        for port_db, binding_db in rows:
+            res[port_db['id']] = (port_db, binding_db)
+    return res
+
+
+def get_ports_status(port_ids):
+    """Get {port id: status} of the given ports that are in the db"""
+    port = models_v2.Port
+    port_ids = list(set(port_ids))
+    session = db.get_session()
+    res = {}
+    for i in xrange(0, len(port_ids), BULK_CHUNK):
+        rows = (session.query(port.id, port.status).
+                filter(port.id.in_(port_ids[i:i + BULK_CHUNK])).
+                all())
+        res.update((x.id, x.status) for x in rows)
+    return res
+
+
+def set_ports_status(port_ids, status):
+    """Set the status of many ports with one update, ports that already
+    have the status are not written"""
+    port = models_v2.Port
+    port_ids = list(set(port_ids))
+    session = db.get_session()
+    with session.begin(subtransactions=True):
+        for i in xrange(0, len(port_ids), BULK_CHUNK):
+            (session.query(port).
+             filter(port.id.in_(port_ids[i:i + BULK_CHUNK])).
+             filter(port.status != status).
+             update({'status': status}, synchronize_session=False))
+
+
+def get_device_agents():
+    """Get {port id: agent id} of the ports reported up by the agents"""
+    session = db.get_session()
+    rows = session.query(rgos_models.RuijieDeviceAgent).all()
+    return dict((x.port_id, x.agent_id) for x in rows)
+
+
+def get_network_agents():
+    """Get {network id: set(agent ids)} of the agents with ports reported
+    up on each network"""
+    model = rgos_models.RuijieDeviceAgent
+    port = models_v2.Port
+    session = db.get_session()
+    rows = (session.query(port.network_id, model.agent_id).
+            join((model, model.port_id == port.id)).
+            distinct().all())
+    res = {}
+    for network_id, agent_id in rows:
+        res.setdefault(network_id, set()).add(agent_id)
+    return res
+
+
+def set_device_agents(agent_id, port_ids):
+    """Record agent_id as the agent of the ports"""
+    model = rgos_models.RuijieDeviceAgent
+    port_ids = sorted(set(port_ids))
+    session = db.get_session()
+    with session.begin(subtransactions=True):
+        for i in xrange(0, len(port_ids), BULK_CHUNK):
+            chunk = port_ids[i:i + BULK_CHUNK]
+            (session.query(model).
+             filter(model.port_id.in_(chunk)).
+             delete(synchronize_session=False))
+            session.execute(model.__table__.insert(),
+                            [{'port_id': port_id, 'agent_id': agent_id}
+                             for port_id in chunk])
+
+
+def remove_device_agents(agent_id, port_ids):
+    """Forget the ports reported down by agent_id, unless another agent
+    reported them up meanwhile"""
+    model = rgos_models.RuijieDeviceAgent
+    port_ids = sorted(set(port_ids))
+    session = db.get_session()
+    with session.begin(subtransactions=True):
+        for i in xrange(0, len(port_ids), BULK_CHUNK):
+            (session.query(model).
+             filter(model.port_id.in_(port_ids[i:i + BULK_CHUNK])).
+             filter_by(agent_id=agent_id).
+             delete(synchronize_session=False))
+
+
 def set_ruijie_switch_host_cfg(index, ip, port, retry, reconnect):
     session = db.get_session()
     binding = (session.query(rgos_models.RuijieSwitchSshHostConfig).
@@ -217,6 +736,8 @@ def set_ruijie_switch_host_cfg(index, ip, port, retry, reconnect):
         return
     binding = rgos_models.RuijieSwitchSshHostConfig(index, ip, port, retry, reconnect)
     session.add(binding)
+    log_change(session, constants.CHANGE_SWITCH_CFG, str(index),
+               constants.OP_ADD)
     session.flush()
     return
 
@@ -227,6 +748,8 @@ def remove_ruijie_switch_host_cfg(index):
                    filter_by(host_id=index).
                    one())
         session.delete(binding)
+        log_change(session, constants.CHANGE_SWITCH_CFG, str(index),
+                   constants.OP_REMOVE)
     except exc.NoResultFound:
             pass
     session.flush()
@@ -250,6 +773,8 @@ def set_ruijie_switch_user_cfg(index, user, passwd):
         return
     binding = rgos_models.RuijieSwitchSshAuthConfig(index, user, passwd)
     session.add(binding)
+    log_change(session, constants.CHANGE_SWITCH_CFG, str(index),
+               constants.OP_ADD)
     session.flush()
     return
 
@@ -260,10 +785,16 @@ def remove_ruijie_switch_user_cfg(index):
                    filter_by(host_id=index).
                    one())
         session.delete(binding)
+        log_change(session, constants.CHANGE_SWITCH_CFG, str(index),
+                   constants.OP_REMOVE)
     except exc.NoResultFound:
             pass
     session.flush()
 
+def get_ruijie_switch_alluser_cfg():
+    session = db.get_session()
+    return (session.query(rgos_models.RuijieSwitchSshAuthConfig).all())
+
 def get_ruijie_switch_user_cfg( index ):
     session = db.get_session()
     return (session.query(rgos_models.RuijieSwitchSshAuthConfig).
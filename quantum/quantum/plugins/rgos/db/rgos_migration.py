@@ -0,0 +1,204 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright 2012 Ruijie network, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+
+from sqlalchemy import MetaData, Table, and_, func, select
+from sqlalchemy import exc
+from sqlalchemy.engine import reflection
+from sqlalchemy.types import Integer, String
+
+from quantum.plugins.rgos.db import rgos_models
+
+LOG = logging.getLogger(__name__)
+
+# tables whose columns were narrowed and typed, existing rows are copied
+# into the new layout
+TYPED_MODELS = (
+    rgos_models.RuijieSwitchEthBinding,
+    rgos_models.RuijieVmEthBinding,
+    rgos_models.RuijieVlanBinding,
+)
+# tables that only gained secondary indexes
+INDEXED_MODELS = TYPED_MODELS + (
+    rgos_models.RuijieSwitchSshHostConfig,
+)
+COPY_CHUNK = 1000
+
+
+def is_current(inspector, table):
+    """Check if the table in the db has the column types of the model"""
+
+    columns = dict((c['name'], c['type'])
+                   for c in inspector.get_columns(table.name))
+    for column in table.columns:
+        current = columns.get(column.name)
+        if current is None:
+            return False
+        if isinstance(column.type, Integer):
+            if not isinstance(current, Integer):
+                return False
+        elif isinstance(column.type, String):
+            if getattr(current, 'length', None) != column.type.length:
+                return False
+    return True
+
+
+def convert_row(table, row):
+    """Convert an old row to the typed columns, None if it does not fit"""
+
+    new_row = {}
+    for column in table.columns:
+        val = row[column.name]
+        if isinstance(column.type, Integer):
+            try:
+                val = int(val)
+            except (TypeError, ValueError):
+                return None
+        elif isinstance(column.type, String) and val is not None:
+            val = val.strip()
+            if column.name == 'mac_address':
+                # the way rgos_db.normalize_mac writes them
+                val = val.lower()
+            if len(val) > column.type.length:
+                return None
+        new_row[column.name] = val
+    return new_row
+
+
+def convert_table(engine, table, tables=()):
+    """Move the rows of an old table into the typed layout of the model.
+
+    tables are the table names in the db. When the old table is still
+    there as <name>_old, a migration that stopped half way is finished:
+    the typed table is created if it is missing and the rows it does
+    not have yet are copied.
+    """
+
+    old_name = table.name + '_old'
+    resume = old_name in tables
+    if resume:
+        LOG.warning("resuming the migration of %s from %s", table.name,
+                    old_name)
+    else:
+        LOG.info("migrating %s to typed columns", table.name)
+        engine.execute('ALTER TABLE %s RENAME TO %s' % (table.name, old_name))
+    old_table = Table(old_name, MetaData(), autoload=True,
+                      autoload_with=engine)
+    keys = [c.name for c in table.primary_key.columns]
+    seen = set()
+    if resume and table.name in tables:
+        key_columns = [table.c[k] for k in keys]
+        seen.update(tuple(row) for row in
+                    engine.execute(select(key_columns)))
+    else:
+        # the renamed table keeps its index names on some databases
+        for index in old_table.indexes:
+            index.drop(bind=engine)
+        table.create(bind=engine)
+
+    rows = []
+    skipped = 0
+    for row in engine.execute(old_table.select()):
+        new_row = convert_row(table, row)
+        if new_row is None:
+            LOG.warning("migrating %s drops row %s", table.name, dict(row))
+            skipped = skipped + 1
+            continue
+        key = tuple(new_row[k] for k in keys)
+        if key in seen:
+            continue
+        seen.add(key)
+        rows.append(new_row)
+
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        for i in xrange(0, len(rows), COPY_CHUNK):
+            conn.execute(table.insert(), rows[i:i + COPY_CHUNK])
+        trans.commit()
+    except Exception:
+        trans.rollback()
+        LOG.error("migrating %s failed, the old rows are kept in %s",
+                  table.name, old_name)
+        raise
+    finally:
+        conn.close()
+    old_table.drop(bind=engine)
+    LOG.info("migrated %d rows of %s, dropped %d", len(rows), table.name,
+             skipped)
+
+
+def create_missing_indexes(engine, inspector, table):
+    names = set(i['name'] for i in inspector.get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in names:
+            LOG.info("creating index %s", index.name)
+            index.create(bind=engine)
+
+
+def create_vlan_port_refs(engine):
+    """Count the vlan bindings of every (ip, port, vlan) that has no refs
+    row yet into the refs table"""
+
+    refs = rgos_models.RuijieVlanPortRef.__table__
+    bindings = rgos_models.RuijieVlanBinding.__table__
+    columns = [bindings.c.ip_address, bindings.c.port_id, bindings.c.vlan_id]
+    join = bindings.outerjoin(refs, and_(
+        refs.c.ip_address == bindings.c.ip_address,
+        refs.c.port_id == bindings.c.port_id,
+        refs.c.vlan_id == bindings.c.vlan_id))
+    rows = engine.execute(select(columns + [func.count()], from_obj=[join]).
+                          where(refs.c.refs == None).
+                          group_by(*columns)).fetchall()
+    if rows == []:
+        return
+    LOG.info("counting %d vlan port refs from the vlan bindings", len(rows))
+    values = [{'ip_address': ip, 'port_id': port, 'vlan_id': vlan,
+               'refs': count} for ip, port, vlan, count in rows]
+    try:
+        engine.execute(refs.insert(), values)
+    except exc.IntegrityError:
+        # an agent took a reference meanwhile, keep the rows it added
+        for value in values:
+            try:
+                engine.execute(refs.insert(), value)
+            except exc.IntegrityError:
+                pass
+
+
+def upgrade(engine):
+    """Bring the ruijie_* tables of an older schema up to the models.
+
+    Tables missing in the db are left to create_all. Running it on an
+    up to date schema does nothing.
+    """
+
+    inspector = reflection.Inspector.from_engine(engine)
+    tables = inspector.get_table_names()
+    for model in INDEXED_MODELS:
+        table = model.__table__
+        if model in TYPED_MODELS and table.name + '_old' in tables:
+            convert_table(engine, table, tables)
+            continue
+        if table.name not in tables:
+            continue
+        if model in TYPED_MODELS and not is_current(inspector, table):
+            convert_table(engine, table, tables)
+            continue
+        create_missing_indexes(engine, inspector, table)
+    if rgos_models.RuijieVlanPortRef.__table__.name in tables:
+        create_vlan_port_refs(engine)
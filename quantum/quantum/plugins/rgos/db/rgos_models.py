@@ -25,7 +25,10 @@ from quantum.db.model_base import BASEV2
 
 
 class RuijieVlanAllocation(model_base.BASEV2):
-    """Represents allocation state of vlan_id on physical network"""
+    """Represents an allocated vlan_id on physical network.
+
+    Free vlans of the pool are kept as RuijieVlanFreeRange rows.
+    """
     __tablename__ = 'ruijie_vlan_allocations'
 
     physical_network = Column(String(64), nullable=False, primary_key=True)
@@ -43,6 +46,25 @@ class RuijieVlanAllocation(model_base.BASEV2):
                                                self.vlan_id, self.allocated)
 
 
+class RuijieVlanFreeRange(model_base.BASEV2):
+    """Represents a range of unallocated vlans of the pool on physical network"""
+    __tablename__ = 'ruijie_vlan_free_ranges'
+
+    physical_network = Column(String(64), nullable=False, primary_key=True)
+    vlan_max = Column(Integer, nullable=False, primary_key=True,
+                      autoincrement=False)
+    vlan_min = Column(Integer, nullable=False)
+
+    def __init__(self, physical_network, vlan_min, vlan_max):
+        self.physical_network = physical_network
+        self.vlan_min = vlan_min
+        self.vlan_max = vlan_max
+
+    def __repr__(self):
+        return "<VlanFreeRange(%s,%d,%d)>" % (self.physical_network,
+                                              self.vlan_min, self.vlan_max)
+
+
 class RuijieNetworkBinding(model_base.BASEV2):
     """Represents binding of virtual network to physical realization"""
     __tablename__ = 'ruijie_network_bindings'
@@ -74,9 +96,9 @@ class RuijieSwitchEthBinding(BASEV2):
     __tablename__ = 'ruijie_switch_eth_bindings'
     __table_args__ = {'extend_existing':True}
 
-    ip_address = Column(String(255), primary_key=True)
-    mac_address = Column(String(255), primary_key=True)
-    port_id = Column(String(255), primary_key=True)
+    ip_address = Column(String(64), primary_key=True)
+    mac_address = Column(String(17), primary_key=True, index=True)
+    port_id = Column(String(64), primary_key=True)
 
     def __init__(self, ip, mac, port):
         self.ip_address = ip
@@ -87,13 +109,30 @@ class RuijieSwitchEthBinding(BASEV2):
         return "<RuijieSwitchEthBinding(%s,%s,%s)>" % (self.ip_address, self.mac_address
                                                     , self.port_id)
 
+class RuijieLldpFingerprint(BASEV2):
+    """Represents the digest of the lldp neighbors last synced for a switch"""
+    __tablename__ = 'ruijie_lldp_fingerprints'
+    __table_args__ = {'extend_existing':True}
+
+    ip_address = Column(String(64), primary_key=True)
+    fingerprint = Column(String(40), nullable=False)
+
+    def __init__(self, ip, fingerprint):
+        self.ip_address = ip
+        self.fingerprint = fingerprint
+
+    def __repr__(self):
+        return "<RuijieLldpFingerprint(%s,%s)>" % (self.ip_address,
+                                                   self.fingerprint)
+
 class RuijieVmEthBinding(BASEV2):
     """Represents a binding of vm and network card"""
     __tablename__ = 'ruijie_vm_eth_bindings'
     __table_args__ = {'extend_existing':True}
 
-    intf_uuid = Column(String(255), primary_key=True)
-    mac_address = Column(String(255), primary_key=True)
+    intf_uuid = Column(String(36), primary_key=True)
+    # each agent reads the bindings of its own nics
+    mac_address = Column(String(17), primary_key=True, index=True)
 
     def __init__(self, id, mac):
         self.intf_uuid = id
@@ -107,10 +146,10 @@ class RuijieVlanBinding(BASEV2):
     __tablename__ = 'ruijie_vlan_bindings'
     __table_args__ = {'extend_existing':True}
 
-    ip_address = Column(String(255), primary_key=True)
-    port_id = Column(String(255), primary_key=True)
-    vlan_id = Column(String(255), primary_key=True)
-    intf_uuid = Column(String(255), primary_key=True)
+    ip_address = Column(String(64), primary_key=True)
+    port_id = Column(String(64), primary_key=True)
+    vlan_id = Column(Integer, primary_key=True, autoincrement=False)
+    intf_uuid = Column(String(36), primary_key=True, index=True)
 
     def __init__(self, ip, port, vlan, uuid):
         self.ip_address = ip
@@ -122,13 +161,69 @@ class RuijieVlanBinding(BASEV2):
         return "<RuijieVlanBinding(%s,%s,%s,%s)>" % (self.ip_address, self.port_id
                                                   , self.vlan_id, self.intf_uuid)
         
+class RuijieVlanPortRef(BASEV2):
+    """Represents how many vifs use a vlan on a Ruijie switch port"""
+    __tablename__ = 'ruijie_vlan_port_refs'
+    __table_args__ = {'extend_existing':True}
+
+    ip_address = Column(String(64), primary_key=True)
+    port_id = Column(String(64), primary_key=True)
+    vlan_id = Column(Integer, primary_key=True, autoincrement=False)
+    refs = Column(Integer, nullable=False)
+
+    def __init__(self, ip, port, vlan, refs):
+        self.ip_address = ip
+        self.port_id = port
+        self.vlan_id = vlan
+        self.refs = refs
+
+    def __repr__(self):
+        return "<RuijieVlanPortRef(%s,%s,%s,%s)>" % (self.ip_address,
+                                                     self.port_id,
+                                                     self.vlan_id, self.refs)
+
+class RuijieDeviceAgent(BASEV2):
+    """Represents the agent a port was last reported up on"""
+    __tablename__ = 'ruijie_device_agents'
+
+    port_id = Column(String(36),
+                     ForeignKey('ports.id', ondelete="CASCADE"),
+                     primary_key=True)
+    agent_id = Column(String(255), nullable=False)
+
+    def __init__(self, port_id, agent_id):
+        self.port_id = port_id
+        self.agent_id = agent_id
+
+    def __repr__(self):
+        return "<RuijieDeviceAgent(%s,%s)>" % (self.port_id, self.agent_id)
+
+class RuijieChange(BASEV2):
+    """Represents one write to a ruijie table, in the order of seq"""
+    __tablename__ = 'ruijie_changes'
+    __table_args__ = {'extend_existing':True}
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String(64), nullable=False)
+    key = Column(String(255), nullable=False)
+    op = Column(String(16), nullable=False)
+
+    def __init__(self, table, key, op):
+        self.table_name = table
+        self.key = key
+        self.op = op
+
+    def __repr__(self):
+        return "<RuijieChange(%s,%s,%s,%s)>" % (self.seq, self.table_name,
+                                                self.key, self.op)
+
 class RuijieSwitchSshHostConfig(BASEV2):
     """Represents a config of Ruijie switch ssh server info and user info """
     __tablename__ = 'ruijie_switch_ssh_host_config'
     __table_args__ = {'extend_existing':True}
 
     host_id = Column(Integer, primary_key=True)
-    ip_address = Column(String(255), primary_key=True)
+    ip_address = Column(String(255), primary_key=True, index=True)
     port_id = Column(String(255), primary_key=True)
     retry_times = Column(Integer)
     reconnect_time = Column(Integer)
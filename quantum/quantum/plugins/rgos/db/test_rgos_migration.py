@@ -0,0 +1,112 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import sqlalchemy
+from sqlalchemy.types import Integer, String
+
+from quantum.plugins.rgos.db import rgos_migration
+from quantum.plugins.rgos.db import rgos_models
+
+VLAN_BINDINGS = rgos_models.RuijieVlanBinding.__table__
+
+
+class FakeInspector(object):
+    """Answers get_columns like a reflection.Inspector of one table"""
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def get_columns(self, table_name):
+        return [{'name': name, 'type': column_type}
+                for name, column_type in self.columns]
+
+
+def test_is_current():
+    inspector = FakeInspector([('ip_address', String(64)),
+                               ('port_id', String(64)),
+                               ('vlan_id', Integer()),
+                               ('intf_uuid', String(36))])
+    assert rgos_migration.is_current(inspector, VLAN_BINDINGS)
+
+
+def test_is_current_old_layout():
+    inspector = FakeInspector([('ip_address', String(255)),
+                               ('port_id', String(255)),
+                               ('vlan_id', String(255)),
+                               ('intf_uuid', String(255))])
+    assert not rgos_migration.is_current(inspector, VLAN_BINDINGS)
+
+
+def test_is_current_string_vlan():
+    inspector = FakeInspector([('ip_address', String(64)),
+                               ('port_id', String(64)),
+                               ('vlan_id', String(64)),
+                               ('intf_uuid', String(36))])
+    assert not rgos_migration.is_current(inspector, VLAN_BINDINGS)
+
+
+def test_is_current_missing_column():
+    inspector = FakeInspector([('ip_address', String(64)),
+                               ('port_id', String(64)),
+                               ('vlan_id', Integer())])
+    assert not rgos_migration.is_current(inspector, VLAN_BINDINGS)
+
+
+def test_convert_row():
+    row = {'ip_address': '192.168.21.35', 'port_id': 'GigabitEthernet 0/1',
+           'vlan_id': ' 100', 'intf_uuid': '0' * 36}
+    assert rgos_migration.convert_row(VLAN_BINDINGS, row) == {
+        'ip_address': '192.168.21.35', 'port_id': 'GigabitEthernet 0/1',
+        'vlan_id': 100, 'intf_uuid': '0' * 36}
+
+
+def test_convert_row_mac():
+    table = rgos_models.RuijieVmEthBinding.__table__
+    row = {'intf_uuid': '0' * 36, 'mac_address': 'FA:16:3E:00:00:01 '}
+    assert (rgos_migration.convert_row(table, row)['mac_address'] ==
+            'fa:16:3e:00:00:01')
+
+
+def test_convert_row_does_not_fit():
+    row = {'ip_address': '192.168.21.35', 'port_id': 'GigabitEthernet 0/1',
+           'vlan_id': 'x', 'intf_uuid': '0' * 36}
+    assert rgos_migration.convert_row(VLAN_BINDINGS, row) is None
+    row['vlan_id'] = '100'
+    row['intf_uuid'] = '0' * 37
+    assert rgos_migration.convert_row(VLAN_BINDINGS, row) is None
+
+
+def test_upgrade_resumes_stopped_migration():
+    engine = sqlalchemy.create_engine('sqlite://')
+    # stopped after the rename, and after the typed table was created
+    engine.execute('CREATE TABLE %s_old (ip_address VARCHAR(255), '
+                   'port_id VARCHAR(255), vlan_id VARCHAR(255), '
+                   'intf_uuid VARCHAR(255))' % VLAN_BINDINGS.name)
+    for vlan in ('100', '101'):
+        engine.execute('INSERT INTO %s_old VALUES (?, ?, ?, ?)' %
+                       VLAN_BINDINGS.name,
+                       '192.168.21.35', 'Gi0/1', vlan, '0' * 36)
+    VLAN_BINDINGS.create(bind=engine)
+    engine.execute(VLAN_BINDINGS.insert(),
+                   {'ip_address': '192.168.21.35', 'port_id': 'Gi0/1',
+                    'vlan_id': 100, 'intf_uuid': '0' * 36})
+
+    rgos_migration.upgrade(engine)
+    rows = engine.execute(sqlalchemy.select([VLAN_BINDINGS.c.vlan_id]).
+                          order_by(VLAN_BINDINGS.c.vlan_id)).fetchall()
+    assert [row[0] for row in rows] == [100, 101]
+    assert (VLAN_BINDINGS.name + '_old' not in
+            engine.table_names())
@@ -16,9 +16,12 @@
 
 # @author: Paul liu, Ruijie Networks, Inc.
 
+import atexit
 import logging
 import os
 import sys
+import threading
+import time
 
 from quantum.api.v2 import attributes
 from quantum.common import constants as q_const
@@ -31,6 +34,7 @@ from quantum.extensions import providernet as provider
 from quantum.openstack.common import context
 from quantum.openstack.common import cfg
 from quantum.openstack.common import rpc
+from quantum.openstack.common.rpc import common as rpc_common
 from quantum.openstack.common.rpc import dispatcher
 from quantum.openstack.common.rpc import proxy
 from quantum import policy
@@ -38,20 +42,226 @@ from quantum.plugins.rgos.common import config
 from quantum.plugins.rgos.common import constants
 from quantum.plugins.rgos.db import rgos_db
 from quantum.plugins.rgos.vlan import vlan_mgr as rgos_vlanmgr
-from quantum.plugins.rgos.ssh import sshclient
+from quantum.plugins.rgos.switch import switch_api
 from quantum.plugins.rgos.switch import switch_driver
+from quantum.plugins.rgos.switch import switch_reconciler
 
 LOG = logging.getLogger(__name__)
 
 
+class PortStatusCoalescer(object):
+    """Write behind buffer of the port status changes of the agents.
+
+    A change to the status a port already has is dropped. The others are
+    kept for window seconds, or until max_pending ports wait, and written
+    with one update per status. What is still kept when the process exits
+    is written by an exit handler, the timers are daemon threads.
+    """
+
+    def __init__(self, window, max_pending):
+        self.window = window
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        # serializes the flushes, taken before _lock
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        # the changes the running flush is writing
+        self._flushing = {}
+        self._timer = None
+        self.stats = {'queued': 0, 'avoided': 0, 'written': 0,
+                      'flushes': 0, 'errors': 0,
+                      'flush_time': 0.0, 'flush_time_max': 0.0}
+        atexit.register(self.flush)
+
+    def _schedule(self):
+        # called with the lock held
+        if self._timer is None and self._pending and self.window > 0:
+            self._timer = threading.Timer(self.window, self.flush)
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+    def update(self, port_id, status, current=None):
+        """Queue a status change, current is the status of the port in
+        the db if the caller read it"""
+        with self._lock:
+            known = self._pending.get(port_id,
+                                      self._flushing.get(port_id, current))
+            if known == status:
+                self.stats['avoided'] += 1
+                return
+            if current == status and port_id not in self._flushing:
+                # the queued change was not written yet, the db already
+                # has the status
+                del self._pending[port_id]
+                self.stats['avoided'] += 1
+                return
+            self._pending[port_id] = status
+            self.stats['queued'] += 1
+            flush_now = (self.window <= 0 or
+                         len(self._pending) >= self.max_pending)
+            if not flush_now:
+                self._schedule()
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """Write the queued status changes.
+
+        Flushes run one at a time, so an older change is never written
+        over a newer one. The changes being written stay visible to
+        update() until they are in the db.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+                self._flushing = pending
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not pending:
+                return
+            by_status = {}
+            for port_id, status in pending.iteritems():
+                by_status.setdefault(status, []).append(port_id)
+            start = time.time()
+            try:
+                for status, port_ids in by_status.iteritems():
+                    rgos_db.set_ports_status(port_ids, status)
+            except Exception as e:
+                LOG.error("Writing the status of %d ports failed: %s",
+                          len(pending), e)
+                with self._lock:
+                    self._flushing = {}
+                    # keep them unless a newer change came in meanwhile
+                    for port_id, status in pending.iteritems():
+                        self._pending.setdefault(port_id, status)
+                    self.stats['errors'] += 1
+                    self._schedule()
+                return
+            elapsed = time.time() - start
+            with self._lock:
+                self._flushing = {}
+                self.stats['written'] += len(pending)
+                self.stats['flushes'] += 1
+                self.stats['flush_time'] += elapsed
+                self.stats['flush_time_max'] = max(
+                    self.stats['flush_time_max'], elapsed)
+        LOG.debug("Wrote the status of %d ports in %.3fs, %d changes "
+                  "avoided so far", len(pending), elapsed,
+                  self.stats['avoided'])
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['pending'] = len(self._pending)
+        if stats['flushes']:
+            stats['flush_time_avg'] = stats['flush_time'] / stats['flushes']
+        else:
+            stats['flush_time_avg'] = 0.0
+        return stats
+
+
+class DeviceAgentMap(object):
+    """Which agent each device is on, as reported by the agents.
+
+    Filled by the device details requests and kept in the
+    ruijie_device_agents table, so it is read back after a plugin restart.
+    The agents that had devices on a network are kept until it is deleted.
+    An agent tells its rpc version in the batch requests, only those of
+    TOPIC_RPC_API_VERSION consume the '<topic>.<agent_id>' topics.
+    """
+
+    # agents of 1.2 consume the casts on their own topics
+    TOPIC_RPC_API_VERSION = '1.2'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # device -> agent_id
+        self._devices = rgos_db.get_device_agents()
+        # network_id -> set of agent_id
+        self._networks = rgos_db.get_network_agents()
+        # agents that told a version with the topics
+        self._topic_agents = set()
+
+    def set_agent_version(self, agent_id, version):
+        topics = (version is not None and
+                  rpc_common.version_is_compatible(version,
+                                                   self.TOPIC_RPC_API_VERSION))
+        with self._lock:
+            if topics:
+                self._topic_agents.add(agent_id)
+            else:
+                self._topic_agents.discard(agent_id)
+
+    def devices_up(self, agent_id, devices, network_ids=()):
+        with self._lock:
+            for network_id in network_ids:
+                self._networks.setdefault(network_id, set()).add(agent_id)
+            moved = [device for device in devices
+                     if self._devices.get(device) != agent_id]
+            for device in moved:
+                self._devices[device] = agent_id
+        if not moved:
+            return
+        try:
+            rgos_db.set_device_agents(agent_id, moved)
+        except Exception as e:
+            LOG.error("Recording the agent of %d devices failed: %s",
+                      len(moved), e)
+
+    def devices_down(self, agent_id, devices):
+        with self._lock:
+            # a device may have moved to another agent meanwhile
+            gone = [device for device in devices
+                    if self._devices.get(device) == agent_id]
+            for device in gone:
+                del self._devices[device]
+        if not gone:
+            return
+        try:
+            rgos_db.remove_device_agents(agent_id, gone)
+        except Exception as e:
+            LOG.error("Forgetting the agent of %d devices failed: %s",
+                      len(gone), e)
+
+    def get_device_agent(self, device):
+        with self._lock:
+            return self._devices.get(device)
+
+    def get_cast_agent(self, device):
+        """The agent of the device if it consumes its topic, else None"""
+        with self._lock:
+            agent_id = self._devices.get(device)
+            if agent_id in self._topic_agents:
+                return agent_id
+        return None
+
+    def pop_network_cast_agents(self, network_id):
+        """Forget the agents of a deleted network. Returns them when all
+        consume their topics, else None"""
+        with self._lock:
+            agents = self._networks.pop(network_id, None)
+            if agents and agents <= self._topic_agents:
+                return sorted(agents)
+        return None
+
+
 class RgosRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin):
 
-    # Set RPC API version to 1.0 by default.
-    RPC_API_VERSION = '1.0'
+    # RPC API version history:
+    #   1.0 - initial version
+    #   1.1 - get_devices_details_list
+    #   1.2 - update_devices_down_list
+    RPC_API_VERSION = '1.2'
 
-    def __init__(self, rpc_context, notifier):
+    def __init__(self, rpc_context, notifier, device_agents):
         self.rpc_context = rpc_context
         self.notifier = notifier
+        self.device_agents = device_agents
+        self.port_status = PortStatusCoalescer(
+            cfg.CONF.RGOS.port_status_flush_window,
+            cfg.CONF.RGOS.port_status_flush_max)
 
     def create_rpc_dispatcher(self):
         '''Get the rpc dispatcher for this manager.
@@ -61,27 +271,69 @@ class RgosRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin):
         '''
         return dispatcher.RpcDispatcher([self])
 
+    def _get_devices_details(self, agent_id, devices):
+        """Get the details of devices with one joined query and queue the
+        found ports to be set ACTIVE"""
+        ports = rgos_db.get_ports_with_bindings(devices)
+        entries = []
+        found = []
+        network_ids = set()
+        for device in devices:
+            port, binding = ports.get(device, (None, None))
+            if port and binding:
+                entry = {'device': device,
+                         'network_id': port['network_id'],
+                         'port_id': port['id'],
+                         'admin_state_up': port['admin_state_up'],
+                         'network_type': binding.network_type,
+                         'segmentation_id': binding.segmentation_id,
+                         'physical_network': binding.physical_network}
+                found.append(device)
+                network_ids.add(port['network_id'])
+                # Set the port status to UP
+                self.port_status.update(port['id'],
+                                        q_const.PORT_STATUS_ACTIVE,
+                                        port['status'])
+            else:
+                entry = {'device': device}
+                LOG.debug("%s can not be found in database", device)
+            entries.append(entry)
+        self.device_agents.devices_up(agent_id, found, network_ids)
+        return entries
+
     def get_device_details(self, rpc_context, **kwargs):
         """Agent requests device details"""
         agent_id = kwargs.get('agent_id')
         device = kwargs.get('device')
         LOG.debug("Device %s details requested from %s", device, agent_id)
-        port = rgos_db.get_port(device)
-        if port:
-            binding = rgos_vlanmgr.get_network_binding(None, port['network_id'])
-            entry = {'device': device,
-                     'network_id': port['network_id'],
-                     'port_id': port['id'],
-                     'admin_state_up': port['admin_state_up'],
-                     'network_type': binding.network_type,
-                     'segmentation_id': binding.segmentation_id,
-                     'physical_network': binding.physical_network}
-            # Set the port status to UP
-            rgos_db.set_port_status(port['id'], q_const.PORT_STATUS_ACTIVE)
-        else:
-            entry = {'device': device}
-            LOG.debug("%s can not be found in database", device)
-        return entry
+        return self._get_devices_details(agent_id, [device])[0]
+
+    def get_devices_details_list(self, rpc_context, **kwargs):
+        """Agent requests the details of many devices at once"""
+        agent_id = kwargs.get('agent_id')
+        devices = kwargs.get('devices') or []
+        LOG.debug("Details of %d devices requested from %s", len(devices),
+                  agent_id)
+        self.device_agents.set_agent_version(agent_id,
+                                             kwargs.get('agent_version'))
+        return self._get_devices_details(agent_id, devices)
+
+    def _update_devices_down(self, agent_id, devices):
+        """Queue the ports of devices to be set DOWN and tell which of
+        them exist"""
+        existing = rgos_db.get_ports_status(devices)
+        self.device_agents.devices_down(agent_id, devices)
+        entries = []
+        for device in devices:
+            if device in existing:
+                # Set port status to DOWN
+                self.port_status.update(device, q_const.PORT_STATUS_DOWN,
+                                        existing[device])
+            else:
+                LOG.debug("%s can not be found in database", device)
+            entries.append({'device': device,
+                            'exists': device in existing})
+        return entries
 
     def update_device_down(self, rpc_context, **kwargs):
         """Device no longer exists on agent"""
@@ -89,50 +341,82 @@ class RgosRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin):
         agent_id = kwargs.get('agent_id')
         device = kwargs.get('device')
         LOG.debug("Device %s no longer exists on %s", device, agent_id)
-        port = rgos_db.get_port(device)
-        if port:
-            entry = {'device': device,
-                     'exists': True}
-            # Set port status to DOWN
-            rgos_db.set_port_status(port['id'], q_const.PORT_STATUS_DOWN)
-        else:
-            entry = {'device': device,
-                     'exists': False}
-            LOG.debug("%s can not be found in database", device)
-        return entry
+        return self._update_devices_down(agent_id, [device])[0]
+
+    def update_devices_down_list(self, rpc_context, **kwargs):
+        """Devices no longer exist on agent"""
+        agent_id = kwargs.get('agent_id')
+        devices = kwargs.get('devices') or []
+        LOG.debug("%d devices no longer exist on %s", len(devices), agent_id)
+        self.device_agents.set_agent_version(agent_id,
+                                             kwargs.get('agent_version'))
+        return self._update_devices_down(agent_id, devices)
 
 
 class AgentNotifierApi(proxy.RpcProxy):
+    """Casts to the agents.
 
+    A port update goes to the topic of the agent known to have the port,
+    '<topic>.<agent_id>', a network delete to the topics of the agents
+    known to have had ports on the network. They go to all agents when
+    no agent is known or one of them does not consume its topic. Network
+    updates always go to all agents.
+    """
 
     BASE_RPC_API_VERSION = '1.0'
+    # agents of 1.1 have network_update
+    NETWORK_UPDATE_RPC_API_VERSION = '1.1'
 
-    def __init__(self, topic):
+    def __init__(self, topic, device_agents):
         super(AgentNotifierApi, self).__init__(
             topic=topic, default_version=self.BASE_RPC_API_VERSION)
+        self.device_agents = device_agents
         self.topic_network_delete = topics.get_topic_name(topic,
                                                           topics.NETWORK,
                                                           topics.DELETE)
         self.topic_port_update = topics.get_topic_name(topic,
                                                        topics.PORT,
                                                        topics.UPDATE)
-
+        self.topic_network_update = topics.get_topic_name(topic,
+                                                          topics.NETWORK,
+                                                          topics.UPDATE)
 
     def network_delete(self, context, network_id):
+        msg = self.make_msg('network_delete', network_id=network_id)
+        agents = self.device_agents.pop_network_cast_agents(network_id)
+        if agents is None:
+            self.fanout_cast(context, msg, topic=self.topic_network_delete)
+            return
+        for agent_id in agents:
+            self.cast(context, msg,
+                      topic='%s.%s' % (self.topic_network_delete, agent_id))
+
+    def network_update(self, context, network_id, network_type,
+                       segmentation_id, physical_network):
+        # every agent may have ports of the network, also those that did
+        # not ask for them since the plugin started
         self.fanout_cast(context,
-                         self.make_msg('network_delete',
-                                       network_id=network_id),
-                         topic=self.topic_network_delete)
-
-    def port_update(self, context, port, network_type, segmentation_id,
-                    physical_network):
-        self.fanout_cast(context,
-                         self.make_msg('port_update',
-                                       port=port,
+                         self.make_msg('network_update',
+                                       network_id=network_id,
                                        network_type=network_type,
                                        segmentation_id=segmentation_id,
                                        physical_network=physical_network),
-                         topic=self.topic_port_update)
+                         topic=self.topic_network_update,
+                         version=self.NETWORK_UPDATE_RPC_API_VERSION)
+
+    def port_update(self, context, port, network_type, segmentation_id,
+                    physical_network):
+        msg = self.make_msg('port_update',
+                            port=port,
+                            network_type=network_type,
+                            segmentation_id=segmentation_id,
+                            physical_network=physical_network)
+        agent_id = self.device_agents.get_cast_agent(port['id'])
+        if agent_id is None:
+            self.fanout_cast(context, msg, topic=self.topic_port_update)
+        else:
+            self.cast(context, msg,
+                      topic='%s.%s' % (self.topic_port_update, agent_id))
 
 
 
@@ -146,9 +430,12 @@ class RgosQuantumPlugin(db_base_plugin_v2.QuantumDbPluginV2,
     supported_extension_aliases = ["provider", "router"]
 
     def __init__(self, configfile=None):
+        start = time.time()
         rgos_db.initialize()
+        phase = self._log_startup_phase('db initialize', start)
         self._parse_network_vlan_ranges()
         rgos_vlanmgr.sync_vlan_allocations(self.network_vlan_ranges)
+        phase = self._log_startup_phase('vlan allocations sync', phase)
         self.tenant_network_type = cfg.CONF.RGOS.tenant_network_type
         if self.tenant_network_type not in [constants.TYPE_LOCAL,
                                             constants.TYPE_VLAN,
@@ -158,8 +445,51 @@ class RgosQuantumPlugin(db_base_plugin_v2.QuantumDbPluginV2,
             sys.exit(1)
         self.agent_rpc = cfg.CONF.AGENT.rpc
         self.setup_rpc()
+        phase = self._log_startup_phase('rpc setup', phase)
         self._parse_remote_switch_conf()
         self._init_rgos_remote()
+        self._log_startup_phase('switch lldp scan', phase)
+        self._schedule_change_log_compaction()
+        self._schedule_switch_reconcile()
+        LOG.info("Plugin started in %.3fs", time.time() - start)
+
+    def _schedule_change_log_compaction(self):
+        interval = cfg.CONF.RGOS.change_log_compact_interval
+        if interval <= 0:
+            return
+        timer = threading.Timer(interval, self._compact_change_log)
+        timer.setDaemon(True)
+        timer.start()
+
+    def _compact_change_log(self):
+        try:
+            dropped = rgos_db.compact_changes(cfg.CONF.RGOS.change_log_keep)
+            LOG.debug("Change log compaction dropped %d changes", dropped)
+        except Exception as e:
+            LOG.error("Change log compaction failed: %s", e)
+        self._schedule_change_log_compaction()
+
+    def _schedule_switch_reconcile(self):
+        # one reconciler for all switches, the agents do not run it
+        if cfg.CONF.RGOS.reconcile_mode == switch_reconciler.MODE_OFF:
+            return
+        timer = threading.Timer(cfg.CONF.RGOS.reconcile_interval * 60,
+                                self._reconcile_switch_vlans)
+        timer.setDaemon(True)
+        timer.start()
+
+    def _reconcile_switch_vlans(self):
+        try:
+            switch_reconciler.reconcile_switch_vlans(
+                cfg.CONF.RGOS.reconcile_mode)
+        except Exception as e:
+            LOG.error("Reconcile switch vlans failed: %s", e)
+        self._schedule_switch_reconcile()
+
+    def _log_startup_phase(self, name, since):
+        now = time.time()
+        LOG.info("Plugin startup: %s took %.3fs", name, now - since)
+        return now
 
     def _init_rgos_remote(self):
         #init the RGOS remote conf
@@ -170,28 +500,24 @@ class RgosQuantumPlugin(db_base_plugin_v2.QuantumDbPluginV2,
             ssh_port = int(x.port_id)
             retry_maxtimes = int(x.retry_times)
             reconnect_interval = int(x.reconnect_time)
-            # get user info from db by host
-            username = switch_driver.get_sshserver_username(ssh_host)
-            passwd = switch_driver.get_sshserver_password(ssh_host)
 
             LOG.debug("Init remote ssh_host ip: %s" % ssh_host)
             LOG.debug("Init retry_maxtimes: %s" % retry_maxtimes)
             LOG.debug("Init reconnect_interval: %s" % reconnect_interval)
             LOG.debug("Init ssh_port: %s" % ssh_port)
-            LOG.debug("Init remote_switch_user: %s" % username)
-            LOG.debug("Init remote_switch_pass: %s" % passwd)
             hostinfo_t = (ssh_host, ssh_port, retry_maxtimes, reconnect_interval)
-            t = sshclient.ssh_connect(username, passwd, ssh_host, ssh_port)
-            if t == -1:
-                LOG.debug("Ssh connect failed t == -1 " )
-            else:
-                chan = sshclient.ssh_channel(t)
-                if chan == -1:
-                    LOG.debug("Ssh channel create failed chan == -1 " )
-                else:
-                    #pass
-                    switch_driver.scan_server_lldp(chan, hostinfo_t)
-                sshclient.ssh_close(chan, t)
+            session = switch_driver.open_switch_session(ssh_host)
+            if session == -1:
+                LOG.debug("Ssh session open failed session == -1 " )
+                continue
+            reuse = False
+            try:
+                switch_driver.scan_server_lldp(session, hostinfo_t)
+                reuse = True
+            except switch_api.CliIncomplete as e:
+                LOG.error("Init lldp scan of %s incomplete: %s", ssh_host, e)
+            finally:
+                switch_driver.close_switch_session(session, reuse)
             LOG.debug("Ssh connect end ! " )
 
     def setup_rpc(self):
@@ -200,8 +526,10 @@ class RgosQuantumPlugin(db_base_plugin_v2.QuantumDbPluginV2,
         self.rpc_context = context.RequestContext('quantum', 'quantum',
                                                   is_admin=False)
         self.conn = rpc.create_connection(new=True)
-        self.notifier = AgentNotifierApi(topics.AGENT)
-        self.callbacks = RgosRpcCallbacks(self.rpc_context, self.notifier)
+        self.device_agents = DeviceAgentMap()
+        self.notifier = AgentNotifierApi(topics.AGENT, self.device_agents)
+        self.callbacks = RgosRpcCallbacks(self.rpc_context, self.notifier,
+                                          self.device_agents)
         self.dispatcher = self.callbacks.create_rpc_dispatcher()
         self.conn.create_consumer(self.topic, self.dispatcher,
                                   fanout=False)
@@ -399,9 +727,11 @@ class RgosQuantumPlugin(db_base_plugin_v2.QuantumDbPluginV2,
         segmentation_id =  network['network']['segmentation_id']
         LOG.debug("update_network: segmentation id = %s", segmentation_id)
         session = context.session
+        old_segmentation_id = None
         with session.begin(subtransactions=True):
             binding = rgos_vlanmgr.get_network_binding(session, id)
             if binding.network_type == constants.TYPE_VLAN:
+                old_segmentation_id = binding.segmentation_id
                 rgos_vlanmgr.release_vlan(session, binding.physical_network,
                                        binding.segmentation_id,
                                        self.network_vlan_ranges)
@@ -419,6 +749,12 @@ class RgosQuantumPlugin(db_base_plugin_v2.QuantumDbPluginV2,
             self._process_l3_update(context, network['network'], id)
             self._extend_network_dict_provider(context, net)
             self._extend_network_dict_l3(context, net)
+        if (self.agent_rpc and old_segmentation_id is not None and
+                old_segmentation_id != segmentation_id):
+            self.notifier.network_update(self.rpc_context, id,
+                                         binding.network_type,
+                                         segmentation_id,
+                                         binding.physical_network)
         return net
 
     def delete_network(self, context, id):
@@ -432,6 +768,8 @@ class RgosQuantumPlugin(db_base_plugin_v2.QuantumDbPluginV2,
                                        self.network_vlan_ranges)
             # the network_binding record is deleted via cascade from
             # the network record, so explicit removal is not necessary
+            rgos_db.log_change(session, constants.CHANGE_NETWORK_BINDINGS,
+                               id, constants.OP_REMOVE)
         if self.agent_rpc:
             self.notifier.network_delete(self.rpc_context, id)
 
@@ -0,0 +1,159 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+import threading
+import time
+
+from quantum.openstack.common import cfg
+from quantum.plugins.rgos.common import config
+from quantum.plugins.rgos.ssh import sshclient
+
+LOG = logging.getLogger(__name__)
+
+
+class SshSession(object):
+    """A long-lived ssh transport and shell channel to one switch.
+
+    prompt keeps the switch cli prompt learned on the first use of the
+    channel, so later users do not have to wait for it again. It is None
+    until then and '' when the hostname could not be parsed.
+    """
+
+    def __init__(self, host, transport, chan):
+        self.host = host
+        self.transport = transport
+        self.chan = chan
+        self.prompt = None
+        self.last_used = time.time()
+
+    def is_alive(self):
+        if self.chan.closed or not self.transport.is_active():
+            return False
+        try:
+            # cheap round trip free probe, fails on a dead socket
+            self.transport.send_ignore()
+        except Exception, e:
+            LOG.debug("ssh session to %s is dead: %s", self.host, str(e))
+            return False
+        return True
+
+    def flush(self):
+        """Drop any output left on the channel by the previous user"""
+        while self.chan.recv_ready():
+            if len(self.chan.recv(1024)) == 0:
+                break
+
+    def close(self):
+        try:
+            sshclient.ssh_close(self.chan, self.transport)
+        except Exception, e:
+            LOG.debug("ssh session to %s close failed: %s", self.host, str(e))
+
+
+class SshSessionPool(object):
+    """Keeps idle ssh sessions per switch ip for reuse.
+
+    Sessions are handed out to one user at a time, health checked before
+    reuse and closed once they stay idle longer than idle_timeout seconds.
+    """
+
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host, port, user, passwd):
+        self.evict_idle()
+        while True:
+            self._lock.acquire()
+            try:
+                sessions = self._idle.get(host)
+                session = sessions and sessions.pop() or None
+            finally:
+                self._lock.release()
+            if session is None:
+                break
+            if session.is_alive():
+                session.flush()
+                LOG.debug("reuse ssh session to %s", host)
+                return session
+            LOG.debug("drop dead ssh session to %s", host)
+            session.close()
+
+        t = sshclient.ssh_connect(user, passwd, host, port)
+        if t == -1 or t is None:
+            LOG.error("ssh connect to %s failed", host)
+            return -1
+        chan = sshclient.ssh_channel(t)
+        if chan == -1 or chan is None:
+            LOG.error("ssh channel to %s create failed", host)
+            return -1
+        LOG.debug("new ssh session to %s", host)
+        return SshSession(host, t, chan)
+
+    def release(self, session, reuse=True):
+        """Give a session back, or close it when it must not be reused"""
+        if session == -1 or session is None:
+            return
+        if not reuse or self.idle_timeout <= 0:
+            session.close()
+            return
+        session.last_used = time.time()
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(session.host, []).append(session)
+        finally:
+            self._lock.release()
+
+    def evict_idle(self):
+        expired = []
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for host, sessions in self._idle.items():
+                alive = [s for s in sessions
+                         if now - s.last_used < self.idle_timeout]
+                expired.extend(s for s in sessions if s not in alive)
+                if alive:
+                    self._idle[host] = alive
+                else:
+                    del self._idle[host]
+        finally:
+            self._lock.release()
+        for session in expired:
+            LOG.debug("evict idle ssh session to %s", session.host)
+            session.close()
+
+    def close_all(self):
+        self._lock.acquire()
+        try:
+            sessions = [s for l in self._idle.values() for s in l]
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for session in sessions:
+            session.close()
+
+
+_POOL = None
+
+
+def get_pool():
+    global _POOL
+    if _POOL is None:
+        _POOL = SshSessionPool(cfg.CONF.SWITCHAGENT.ssh_idle_timeout)
+    return _POOL
@@ -0,0 +1,62 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time the lldp neighbor parsers on synthetic switch output.
+
+python -m quantum.plugins.rgos.switch.bench_lldp [neighbors ...]
+"""
+
+import sys
+import time
+
+from quantum.plugins.rgos.switch import switch_driver
+from quantum.plugins.rgos.switch import test_switch_driver
+
+DEFAULT_COUNTS = (384, 1536, 3072)
+REPEAT = 5
+
+
+def time_call(func, arg):
+    """Best of REPEAT runs in seconds, and the result of the last one"""
+
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        result = func(arg)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main(argv):
+    counts = [int(x) for x in argv[1:]] or DEFAULT_COUNTS
+    print '%10s %10s %12s %10s' % ('neighbors', 'lines', 'detail', 'us/nb')
+    for count in counts:
+        output = test_switch_driver.get_lldp_detail_output(count)
+        elapsed, neighbors = time_call(
+            switch_driver.get_neighbor_list_details, output)
+        if len(neighbors) != count:
+            print 'parsed %d of %d neighbors' % (len(neighbors), count)
+            return 1
+        print '%10d %10d %10.1fms %10.1f' % (
+            count, output.count('\n'), elapsed * 1000,
+            elapsed * 1e6 / count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
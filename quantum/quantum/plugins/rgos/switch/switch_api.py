@@ -17,26 +17,159 @@
 # @author: Paul liu, Ruijie Networks, Inc.
 
 import logging
+import re
 import socket
 import string
+from quantum.openstack.common import cfg
+from quantum.plugins.rgos.common import config
 from quantum.plugins.rgos.ssh import sshclient
 from quantum.plugins.rgos.db import rgos_db
 
 LOG = logging.getLogger(__name__)
 
-def get_switchinfo_climode(chan, switch_mode_info):
+# prompt of any cli mode, e.g. 'Ruijie#', 'Ruijie(config)#' or
+# 'Ruijie(config-if-GigabitEthernet 0/1)#'
+PROMPT_ANY = r'[\w\.\-]+(\([^)\r\n]*\))?[#>] ?$'
+PROMPT_HOST = r'(\([^)\r\n]*\))?[#>] ?$'
+MORE = '--More--'
+SWITCHPORT_MODES = ('ACCESS', 'TRUNK', 'UPLINK')
+VLAN_MIN = 1
+VLAN_MAX = 4094
+# longest cli line the switch takes
+CLI_LINE_MAX = 200
+# interface name, e.g. 'Gi0/1' or 'GigabitEthernet 0/1'
+IFX_RE = re.compile(r'\s*([A-Za-z]+)\s*(\d+(?:[/:.]\d+)*)\s*$')
+# a wrapped part of the 'VLAN lists' column on a line of its own
+VLAN_LIST_RE = re.compile(r'^[\d,\-]*\d[\d,\-]*$')
+
+
+def get_prompt_hostname(switch_mode_info):
+    """Get the switch hostname out of a cli prompt"""
+
+    lines = switch_mode_info.strip().splitlines()
+    if lines == []:
+        return ''
+    prompt = lines[-1].strip()
+    match = re.match(r'([\w\.\-]+)(\(|#|>)', prompt)
+    if match is None:
+        LOG.debug("get_prompt_hostname can not parse prompt %s", prompt)
+        return ''
+    return match.group(1)
+
+
+def get_prompt_pattern(hostname):
+    """Get the pattern matching every cli mode prompt of the switch"""
+
+    if hostname == '':
+        return re.compile(PROMPT_ANY)
+    return re.compile(re.escape(hostname) + PROMPT_HOST)
+
+
+class CliIncomplete(socket.timeout):
+    """The switch stopped sending, or closed the channel, before its cli
+    prompt came back. The output read so far is not complete and the
+    session must not be reused, the rest of the output may still come.
+    """
+
 
+def recv_cli_data(chan, timeout, name):
+    """Receive the next output of the switch, raise CliIncomplete when
+    nothing arrives for timeout seconds or on EOF"""
+
+    chan.settimeout(timeout)
+    try:
+        data = chan.recv(4096)
+    except socket.timeout:
+        LOG.warning("%s no output for %s seconds before the prompt",
+                    name, timeout)
+        raise CliIncomplete("no output for %s seconds" % timeout)
+    if len(data) == 0:
+        LOG.warning("%s EOF before the prompt", name)
+        raise CliIncomplete("EOF before the prompt")
+    return data
+
+
+def read_until_prompt(chan, prompt_re, timeout=None):
+    """Read the switch output until the cli prompt shows up again.
+
+    The prompt ends the read as soon as it is seen. timeout (seconds) is
+    an idle timeout, it starts again with every output received, so a
+    long output is read as long as the switch keeps sending it.
+    """
+
+    if timeout is None:
+        timeout = cfg.CONF.SWITCHAGENT.ssh_cli_timeout
+    chunks = []
+    tail = ''
     while True:
-        try:
-            switch_mode_info = chan.recv(1024)
-            LOG.debug("get_switchinfo_climode recive switch_mode_info = %s ", switch_mode_info)
-            if len(switch_mode_info) == 0:
-                LOG.debug("\r\n get_switchinfo_climode *** EOF\r\n")
+        data = recv_cli_data(chan, timeout, 'read_until_prompt')
+        tail = tail + data
+        if tail.find(MORE) != -1:
+            # paged output, ask the switch for the next page
+            LOG.debug("read_until_prompt recv more, send space continue ...")
+            chan.send(' ')
+            data = data.replace(MORE, '')
+            tail = tail.replace(MORE, '')
+        chunks.append(data)
+        tail = tail[-256:]
+        line = tail.replace('\x08', '').rsplit('\n', 1)[-1]
+        if prompt_re.match(line.strip()):
             break
-        except socket.timeout:
+
+    return ''.join(chunks).replace('\x08', '')
+
+
+def iter_cli_lines(chan, cli, prompt_re, timeout=None):
+    """Send one cli and yield its output lines while they arrive.
+
+    Only the unfinished last line is kept between channel reads, so the
+    caller can work on each line before the switch sends the rest. The
+    echo of the cli and the final prompt are not yielded. timeout is an
+    idle timeout as in read_until_prompt, CliIncomplete is raised after
+    the lines read so far when the prompt does not come back.
+    """
+
+    if timeout is None:
+        timeout = cfg.CONF.SWITCHAGENT.ssh_cli_timeout
+    LOG.debug("iter_cli_lines cli = %s", cli.strip())
+    chan.send(cli)
+    pending = ''
+    echo = True
+    while True:
+        data = recv_cli_data(chan, timeout, 'iter_cli_lines')
+        pending = pending + data.replace('\x08', '')
+        if pending.find(MORE) != -1:
+            # paged output, ask the switch for the next page
+            chan.send(' ')
+            pending = pending.replace(MORE, '')
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            if echo:
+                echo = False
+                continue
+            yield line.rstrip('\r')
+        if not echo and prompt_re.match(pending.strip()):
             break
 
-    return switch_mode_info
+
+def exec_switch_cli(chan, cli, prompt_re, timeout=None):
+    """Send one cli and return its output without the echo and prompt"""
+
+    return ''.join(line + '\r\n' for line in
+                   iter_cli_lines(chan, cli, prompt_re, timeout))
+
+
+def get_switchinfo_climode(chan, switch_mode_info):
+
+    switch_mode_info = read_until_prompt(chan, re.compile(PROMPT_ANY))
+    LOG.debug("get_switchinfo_climode recive switch_mode_info = %s ", switch_mode_info)
+    lines = switch_mode_info.strip().splitlines()
+    if lines == []:
+        LOG.debug("\r\n get_switchinfo_climode *** EOF\r\n")
+        return ''
+
+    return lines[-1].strip()
 
 def send_switch_cli(chan, cli):
 
@@ -76,35 +209,10 @@ def get_send2switch_cli(chan, switch_cli):
 
 def get_switchinfo_cliexecut(chan,switch_mode_info):
 
-    switch_cli_return = ''
-    recv_buf = 120
-    recv_times = 1
-    while True:
-        try:
-            # recive the switch cli return info
-            y = ''
-            more = '--More--'
-            enter = '\r\n'
-            y = chan.recv(recv_buf)
-            if len(y) != len(switch_mode_info):
-                # cli return not completed countine recive!
-                if y.find(more,0,) == -1:
-                    switch_cli_return = switch_cli_return + y
-                    continue
-                else:
-                    # when recv the 'more' message ,auto send space and enter command ,contuine recive show
-                    LOG.debug("recv switch cli return info is too much, send space continue recive ...")
-                    switch_cli_more = ' '
-                    send_switch_cli(chan, switch_cli_more)
-                    continue
-            else:
-                # cli return message is recviced complete!
-                LOG.debug("recv switch_cli len(y) = switch_mode_info %d quit recv !\r\n", len(switch_mode_info))
-                break
-
-            LOG.debug("recv switch cli return info is completed ! ")
-        except socket.timeout:
-            break
+    # recive the switch cli return info until the prompt is back
+    hostname = get_prompt_hostname(switch_mode_info)
+    switch_cli_return = read_until_prompt(chan, get_prompt_pattern(hostname))
+    LOG.debug("recv switch cli return info is completed ! ")
 
     return switch_cli_return
 
@@ -163,3 +271,186 @@ def get_switchport_mode(recv_info, ifx):
 
     LOG.debug("get_switchport_mode error can not find ifx !")
     return portmode
+
+
+def get_ifx_key(ifx):
+    """Key of a port that is the same for 'Gi0/1' and 'GigabitEthernet 0/1'.
+
+    Returns None when ifx does not look like an interface name.
+    """
+
+    m = IFX_RE.match(ifx)
+    if m is None:
+        return None
+    return (m.group(1)[:2].lower(), m.group(2))
+
+
+def split_table_row(line, starts):
+    """Cut a table row at the column offsets of its header line.
+
+    A cell that runs into the next column ends at the next blank.
+    """
+
+    cells = []
+    begin = 0
+    for start in starts[1:]:
+        end = max(start, begin)
+        while end < len(line) and not line[end - 1].isspace():
+            end = end + 1
+        cells.append(line[begin:end].strip())
+        begin = end
+    cells.append(line[begin:].strip())
+    return cells
+
+
+def get_switchport_table(recv_info):
+    """Parse 'show interfaces switchport' output of any number of ports.
+
+    Returns a dict of get_ifx_key(interface) to {'ifx': ..., 'mode': ...,
+    'vlans': ...}, where vlans is the raw 'VLAN lists' column. A long vlan
+    list is wrapped by the switch onto the following lines, they are
+    joined back to it.
+    """
+
+    table = {}
+    row = None
+    for line in recv_info.splitlines():
+        tokens = line.split()
+        if row is not None and VLAN_LIST_RE.match(line.strip()):
+            row['vlans'] = row['vlans'] + line.strip()
+            continue
+        row = None
+        for i in range(1, len(tokens)):
+            if tokens[i] in SWITCHPORT_MODES:
+                break
+        else:
+            continue
+        # the 'Switchport' column is in front of the mode
+        ifx = ' '.join(tokens[:i - 1])
+        key = get_ifx_key(ifx)
+        if key is None:
+            continue
+        row = {'ifx': ifx, 'mode': tokens[i], 'vlans': tokens[-1]}
+        table[key] = row
+    return table
+
+
+def get_cli_error(output):
+    """Get the first error line the switch printed for a cli, or ''"""
+
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith('%'):
+            return line
+    return ''
+
+
+def parse_vlan_list(vlan_list):
+    """Parse a vlan list like 'ALL' or '1,10-20', None if it is not one"""
+
+    if vlan_list.upper() == 'ALL':
+        return set(xrange(VLAN_MIN, VLAN_MAX + 1))
+    vlans = set()
+    try:
+        for item in vlan_list.split(','):
+            if item == '':
+                continue
+            if '-' in item:
+                first, last = item.split('-')
+                vlans |= set(xrange(int(first), int(last) + 1))
+            else:
+                vlans.add(int(item))
+    except ValueError:
+        LOG.debug("parse_vlan_list can not parse %s", vlan_list)
+        return None
+    return vlans
+
+
+def compress_vlan_list(vlans):
+    """Compress vlans into ranges, [10, 12, 13, 14, 100] gives
+    ['10', '12-14', '100']"""
+
+    ranges = []
+    for vlan in sorted(set(vlans)):
+        if ranges and vlan == ranges[-1][1] + 1:
+            ranges[-1][1] = vlan
+        else:
+            ranges.append([vlan, vlan])
+    return [first == last and str(first) or '%d-%d' % (first, last)
+            for first, last in ranges]
+
+
+def get_vlan_list_lines(vlans, max_len):
+    """Pack the compressed vlan list into as few lists of at most
+    max_len characters as possible, e.g. ['10,12-40,100']"""
+
+    lines = []
+    line = ''
+    for item in compress_vlan_list(vlans):
+        if line == '':
+            line = item
+        elif len(line) + 1 + len(item) <= max_len:
+            line = line + ',' + item
+        else:
+            lines.append(line)
+            line = item
+    if line != '':
+        lines.append(line)
+    return lines
+
+
+def get_allowed_vlan_clis(cli_head, vlans):
+    """Build the fewest 'cli_head <vlan list>' lines for the vlans"""
+
+    max_len = CLI_LINE_MAX - len(cli_head) - 1
+    return [cli_head + ' ' + line + '\r\n'
+            for line in get_vlan_list_lines(vlans, max_len)]
+
+
+def get_switchport_vlan_clis(ifx, portmode, add_vlans, remove_vlans,
+                             current_vlans=None, port_vlans=None):
+    """Build the cli lines adding and removing vlans on one port.
+
+    current_vlans is the allowed vlan set the switch reported for the
+    port, None if unknown. Only the vlans really missing or present are
+    sent then. port_vlans is the set of vlans the port has to carry after
+    the change, it is used when an access port becomes an uplink.
+
+    Returns None when the port mode is unknown.
+    """
+
+    vlanall = '1-4094'
+    add_cli = 'switchport trunk allowed vlan add'
+    remove_cli = 'switchport trunk allowed vlan remove'
+    clis = []
+    if portmode == 'ACCESS':
+        if add_vlans:
+            # the access port becomes an uplink carrying all its vlans
+            vlans = set(add_vlans)
+            if port_vlans is not None:
+                vlans |= set(port_vlans)
+            vlans -= set(remove_vlans)
+            clis.append('interface ' + ifx + '\r\n')
+            clis.append('switchport mode UPLINK\r\n')
+            clis.append(remove_cli + ' ' + vlanall + '\r\n')
+            clis.extend(get_allowed_vlan_clis(add_cli, vlans))
+            clis.append('exit\r\n')
+        else:
+            for vlan in remove_vlans:
+                clis.append('vlan ' + str(vlan) + '\r\n')
+                clis.append('no add interface ' + ifx + '\r\n')
+                clis.append('exit\r\n')
+    elif portmode == 'TRUNK' or portmode == 'UPLINK':
+        add_vlans = set(add_vlans)
+        remove_vlans = set(remove_vlans)
+        if current_vlans is not None:
+            add_vlans -= current_vlans
+            remove_vlans &= current_vlans
+        if add_vlans or remove_vlans:
+            clis.append('interface ' + ifx + '\r\n')
+            clis.extend(get_allowed_vlan_clis(add_cli, add_vlans))
+            clis.extend(get_allowed_vlan_clis(remove_cli, remove_vlans))
+            clis.append('exit\r\n')
+    else:
+        return None
+    return clis
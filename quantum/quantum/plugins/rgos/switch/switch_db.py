@@ -25,7 +25,7 @@ LOG = logging.getLogger(__name__)
 def mac_converter(mac):
     '''
     Conversion MAC, for example:
-    mac: '1234.5678.9abc'
+    mac: '1234.5678.9ABC'
     return 12:34:56:78:9a:bc
     '''
     tmp = []
@@ -36,7 +36,7 @@ def mac_converter(mac):
     tmp.append(mac[10:12])
     tmp.append(mac[12:14])
     sign = ':'
-    return sign.join(tmp)
+    return sign.join(tmp).lower()
 
 def get_all_port_neighbors():
     """Lists all the switch:port and neighbors data """
@@ -53,42 +53,22 @@ def get_port_neighbors(svi, ifx):
 def add_port_neighbors(neighbor_list):
     """Adds a switch:port and neighbors data"""
 
-    mac = ''
-    switch_bings = []
-    
-    # set the port and mac  
-    for i in neighbor_list:
-        neighbor_tuple = i
-        ip = neighbor_tuple[0]
-        mac = neighbor_tuple[1]
-        port = neighbor_tuple[2]
-        # set switch port neighbors info to local db
-        switch_bings = rgos_db.get_ruijie_switch_eth_binding(mac)
-        if switch_bings == []:
-            rgos_db.add_ruijie_switch_eth_binding(ip, mac, port)
-        else:
-            LOG.debug("add_port_neighbors failed the mac already existed \r\n")
+    if neighbor_list == []:
+        return []
+    # a mac already bound to a switch port is skipped
+    added = rgos_db.bulk_add_switch_eth_bindings(neighbor_list)
+    if len(added) != len(neighbor_list):
+        LOG.debug("add_port_neighbors %d of %d macs already existed \r\n",
+                  len(neighbor_list) - len(added), len(neighbor_list))
+    return added
 
 
 def remove_port_neighbors(neighbor_list):
     """Removes a switch:port and neighbors data"""
-    mac = ''
-    switch_bings = []
-    
-    # set the port and mac  
-    for i in neighbor_list:
-        neighbor_tuple = i
-        ip = neighbor_tuple[0]
-        mac = neighbor_tuple[1]
-        port = neighbor_tuple[2]
-        # set switch port neighbors info to local db
-        switch_bings = rgos_db.get_ruijie_switch_eth_binding(mac)
-        if switch_bings == []:
-            LOG.debug("remove_port_neighbors failed the record not existed \r\n")
-        else:
-            rgos_db.remove_ruijie_switch_eth_binding(ip, mac, port)
-    
-    pass
+
+    if neighbor_list == []:
+        return
+    rgos_db.bulk_remove_switch_eth_bindings(neighbor_list)
 
 
 def update_port_neighbors(svi, neighbor_list):
@@ -15,10 +15,16 @@
 #
 # @author: Paul liu, Ruijie Networks, Inc.
 
+import hashlib
 import socket
 import string
 import logging
-from quantum.plugins.rgos.ssh import sshclient
+import threading
+import time
+from quantum.openstack.common import cfg
+from quantum.plugins.rgos.common import config
+from quantum.plugins.rgos.common import constants
+from quantum.plugins.rgos.ssh import sshpool
 from quantum.plugins.rgos.switch import switch_db
 from quantum.plugins.rgos.switch import switch_api
 from quantum.plugins.rgos.db import rgos_db
@@ -26,6 +32,65 @@ from quantum.plugins.rgos.vlan import vlan_mgr
 
 LOG = logging.getLogger(__name__)
 
+VLAN_ADD = 'add'
+VLAN_REMOVE = 'remove'
+
+# 'show lldp neighbors detail' output
+LLDP_PORT_HEAD = 'LLDP neighbor-information of port ['
+LLDP_NEIGHBOR_HEAD = 'Neighbor index'
+LLDP_UNIT_END = 'Maximum frame Size'
+LLDP_DETAIL_FIELDS = {
+    'Chassis ID type': 'chassis_id_type',
+    'Chassis ID': 'chassis_id',
+    'System name': 'system_name',
+    'Port ID type': 'port_id_type',
+    'Port ID': 'port_id',
+    'Port VLAN ID': 'port_vlan_id',
+}
+# 'show lldp neighbors' table header
+LLDP_SUMMARY_COLUMNS = (
+    ('System Name', 'system_name'),
+    ('Local Intf', 'ifx'),
+    ('Port ID', 'port_id'),
+    ('Capability', 'capability'),
+    ('Aging-time', 'aging_time'),
+)
+LLDP_SCAN_DETAIL = 'detail'
+LLDP_SCAN_SUMMARY = 'summary'
+
+# per switch ip: the neighbor table of the last summary scan, as
+# {port key: [(system name, port id)]}, and the detail neighbor tuples
+# behind it, as {port key: [neighbor tuple]}
+_LLDP_SUMMARY = {}
+_LLDP_DETAILS = {}
+# per switch ip: digest of the lldp neighbors last synced to the db
+_LLDP_FINGERPRINTS = {}
+_LLDP_STATS = {'synced': 0, 'unchanged': 0}
+
+
+def group_by_host(bindings):
+    res = {}
+    for binding in bindings:
+        res.setdefault(binding[0], []).append(binding)
+    return res
+
+
+def load_host_eth_bindings(ip):
+    return rgos_db.get_ruijie_switch_eth_binding_byhost(ip) or None
+
+
+# switch ip -> [(ip, mac, port)], refreshed from the change log
+_ETH_BINDINGS = rgos_db.ChangeLogCache(
+    constants.CHANGE_SWITCH_ETH_BINDINGS,
+    lambda: group_by_host(rgos_db.get_ruijie_switch_eth_bindings()),
+    load_host_eth_bindings)
+
+
+def get_switch_eth_bindings():
+    """Get {switch ip: [(ip, mac, port)]} of the lldp neighbors in db"""
+
+    return _ETH_BINDINGS.refresh()
+
 def parse_recived_message(recv_str, cli, host_info):
 
     if len(recv_str) == 0:
@@ -56,71 +121,119 @@ def parse_recived_message(recv_str, cli, host_info):
     return 0
 
 
-def scan_server_lldp(chan, host_info):
+def scan_server_lldp(session, host_info):
 
     LOG.debug("scan_server_lldp Start !" )
 
     try:
         ret = 0
-        chan.settimeout(1.0)
-        # get switch cli mode info via ssh
-        switch_mode_info = ''
-        switch_mode_info = switch_api.get_switchinfo_climode(chan, switch_mode_info)
-        # send cli command to switch via ssh
-        switch_cli = 'show lldp neighbors detail \r\n'
-        LOG.debug("can_server_lldp send start switch_cli = %s " ,switch_cli)
-        switch_api.send_switch_cli(chan, switch_cli)
-        # recive the cli return info via ssh
-        switch_cli_return = ''
-        switch_cli_return = switch_api.get_switchinfo_cliexecut(chan, switch_mode_info)
-        LOG.debug("scan_server_lldp switch_cli_return =\r\n %s \r\n" ,switch_cli_return)
-        # analyse the swirch return message 
-        ret = parse_recived_message(switch_cli_return, switch_cli, host_info)
-        if ret == -1:
-            LOG.error("scan_server_lldp parse_recived_message erro!")
+        host = host_info[0]
+        # get switch cli prompt via ssh
+        prompt_re = get_switch_prompt(session)
+        if cfg.CONF.SWITCHAGENT.lldp_scan_mode == LLDP_SCAN_SUMMARY:
+            neighbors = scan_lldp_changes(session, host, prompt_re)
         else:
-            LOG.debug("scan_server_lldp parse_recived_message success!" )
+            # send cli command to switch via ssh and recive the return info
+            switch_cli = 'show lldp neighbors detail \r\n'
+            LOG.debug("can_server_lldp send start switch_cli = %s " ,switch_cli)
+            # parse the neighbors while the switch is still sending them,
+            # all of them are read before the db sync
+            lines = switch_api.iter_cli_lines(session.chan, switch_cli, prompt_re)
+            neighbors = list(iter_neighbor_tuples(
+                iter_lldp_neighbor_details(lines)))
+        ret = update_lldp_neighbor(host, neighbors)
+        LOG.debug("scan_server_lldp %s lldp neighbors: %d", host, ret)
+
+    except switch_api.CliIncomplete:
+        # a truncated scan would delete the bindings of the ports not read
+        # yet, keep the db and the fingerprint, read all details next time
+        LOG.error("scan_server_lldp %s lldp output incomplete, "
+                  "bindings not synced", host)
+        _LLDP_SUMMARY.pop(host, None)
+        _LLDP_DETAILS.pop(host, None)
+        raise
 
     finally:
         LOG.debug("scan_server_lldp end !" )
 
+def scan_lldp_changes(session, host, prompt_re):
+    """Read the lldp neighbor table and the details of changed ports only.
+
+    The first scan of a switch reads the details of all ports. Returns
+    the neighbor tuples of the whole switch. The cache is only updated
+    once every output was read to the prompt, CliIncomplete leaves it
+    as it was.
+    """
+
+    switch_cli = 'show lldp neighbors \r\n'
+    output = switch_api.exec_switch_cli(session.chan, switch_cli, prompt_re)
+    summary = {}
+    names = {}
+    for row in iter_lldp_neighbor_summary(output.splitlines()):
+        key = switch_api.get_ifx_key(row['ifx'])
+        summary.setdefault(key, []).append((row['system_name'], row['port_id']))
+        names[key] = row['ifx']
+    for neighbors in summary.values():
+        neighbors.sort()
+    if len(summary) == 0:
+        # nothing to compare against, the next scan reads all details
+        _LLDP_SUMMARY.pop(host, None)
+        _LLDP_DETAILS.pop(host, None)
+        return []
+
+    old_summary = _LLDP_SUMMARY.get(host)
+    details = {}
+    if old_summary is None:
+        switch_cli = 'show lldp neighbors detail \r\n'
+        lines = switch_api.iter_cli_lines(session.chan, switch_cli, prompt_re)
+        for x in iter_neighbor_tuples(iter_lldp_neighbor_details(lines)):
+            details.setdefault(switch_api.get_ifx_key(x[0]), []).append(x)
+    else:
+        old_details = _LLDP_DETAILS.get(host, {})
+        for key, neighbors in summary.items():
+            if old_summary.get(key) == neighbors and key in old_details:
+                details[key] = old_details[key]
+                continue
+            LOG.debug("scan_lldp_changes %s port %s neighbors changed",
+                      host, names[key])
+            switch_cli = 'show lldp neighbors interface %s detail \r\n' % names[key]
+            lines = switch_api.iter_cli_lines(session.chan, switch_cli, prompt_re)
+            details[key] = list(iter_neighbor_tuples(
+                iter_lldp_neighbor_details(lines)))
+
+    _LLDP_SUMMARY[host] = summary
+    _LLDP_DETAILS[host] = details
+    return [x for neighbors in details.values() for x in neighbors]
+
 def update_server_lldp():
     ret = -1
     
-    h_allconfig = get_sshserver_hostinfo()
-    if h_allconfig == []:
+    h_allconfig = get_inventory().get_switches()
+    if h_allconfig == {}:
         ret = -1
         return ret
     
-    for x in h_allconfig:
-        ssh_host = x.ip_address
-        ssh_port = int(x.port_id)
-        retry_maxtimes = int(x.retry_times)
-        reconnect_interval = int(x.reconnect_time)
-        # get user info from db by host
-        username = get_sshserver_username(ssh_host)
-        passwd = get_sshserver_password(ssh_host)
-
+    for ssh_host in sorted(h_allconfig):
+        hostinfo_t = h_allconfig[ssh_host][:4]
         LOG.debug("scan remote ssh_host ip: %s" % ssh_host)
-        LOG.debug("scan retry_maxtimes: %s" % retry_maxtimes)
-        LOG.debug("scan reconnect_interval: %s" % reconnect_interval)
-        LOG.debug("scan ssh_port: %s" % ssh_port)
-        LOG.debug("scan remote_switch_user: %s" % username)
-        LOG.debug("scan remote_switch_pass: %s" % passwd)
-        hostinfo_t = (ssh_host, ssh_port, retry_maxtimes, reconnect_interval)
-        t = sshclient.ssh_connect(username, passwd, ssh_host, ssh_port)
-        if t == -1:
-            LOG.debug("Ssh connect failed t == -1 " )
-        else:
-            chan = sshclient.ssh_channel(t)
-            if chan == -1:
-                LOG.debug("Ssh channel create failed chan == -1 " )
-            else:
-                #pass
-                scan_server_lldp(chan, hostinfo_t)
-            sshclient.ssh_close(chan, t)
-            LOG.debug("Ssh connect end ! " )
+        LOG.debug("scan retry_maxtimes: %s" % hostinfo_t[2])
+        LOG.debug("scan reconnect_interval: %s" % hostinfo_t[3])
+        LOG.debug("scan ssh_port: %s" % hostinfo_t[1])
+        session = open_switch_session(ssh_host)
+        if session == -1:
+            LOG.debug("Ssh session open failed session == -1 " )
+            continue
+        reuse = False
+        try:
+            scan_server_lldp(session, hostinfo_t)
+            reuse = True
+        except switch_api.CliIncomplete as e:
+            LOG.error("update_server_lldp %s scan incomplete: %s", ssh_host, e)
+        finally:
+            close_switch_session(session, reuse)
+        LOG.debug("Ssh connect end ! " )
         
+    LOG.debug("update_server_lldp scans %s", get_lldp_scan_stats())
     ret = 0
     return ret
 
@@ -148,258 +261,375 @@ def get_server_lldpneighbors(chan):
     finally:
         LOG.debug("get_server_lldpneighbors end !" )
 
-def set_switch_vlan(ssh_host, ifx, vlan):
-    
-    # paramater check is here
-    
-    # create cli command
-    sshhost = ssh_host
-    host_t = ''
-    switch_port_mode = 'access'
-    switch_ifx = ifx
-    switch_vlan = str(vlan)
-    vlanall =  '1-4094'
-    vlanlist = vlanall
-    access = 'ACCESS'
-    trunk = 'TRUNK'
-    uplink = 'UPLINK'
-    portmode = ''
-    return_switchport_info = ''
-    
-    # first step into vlan mode 
-    cli_confmode = 'configure\r\n'
-    cli_show_ifx_mode = 'show interfaces ' + switch_ifx + ' switchport\r\n'
-    cli_vlanmode = 'vlan ' + switch_vlan + '\r\n'
-    #print 'set_switch_vlan cli_vlanmode = %s \r\n' % cli_vlanmode,
-    cli_ifx_mode = 'interface ' + switch_ifx +  '\r\n'
-    # bug for eth1 native 1 will not get dhcp ip
-    portmode = trunk
-    cli_ifx_set_trunkmode = 'switchport mode '+ portmode +'\r\n'
-    portmode = uplink
-    cli_ifx_set_uplinkmode = 'switchport mode '+ portmode +'\r\n'
-    cli_ifx_remove_vlan = 'switchport tru allow vlan r '+ vlanlist + '\r\n'
-    vlanlist = switch_vlan
-    cli_ifx_add_vlan = 'switchport tru allow vlan add ' + vlanlist + '\r\n'
-    cli_exit = 'exit\r\n'
-    cli_conf_exit = 'exit\r\n'
-    
-    # create ssh connect by host
-    host_t = get_sshserver_hostinfo_byhost( ssh_host )
-    sshport = int(host_t[1])
-    user = get_sshserver_username(sshhost)
-    password = get_sshserver_password(sshhost)
-    
-    t= sshclient.ssh_connect(user, password, sshhost, sshport)
-    if t == -1:
-        LOG.error("Set_switch_vlan ssh connect failed t == -1")
-        return -1
-    
-    chan = sshclient.ssh_channel(t)
-    if chan == -1:
-        LOG.error("Set_switch_vlan ssh channel create failed chan == -1")
+class SwitchInventory(object):
+    """Ssh host and user config of all switches, loaded in two queries.
+
+    Every switch is (ip, ssh port, retry times, reconnect time, username,
+    password). The config is read again after ttl seconds, or on the next
+    lookup after invalidate().
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._switches = None
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._lock.acquire()
+        try:
+            self._switches = None
+        finally:
+            self._lock.release()
+
+    def load(self):
+        users = dict((x.host_id, x)
+                     for x in rgos_db.get_ruijie_switch_alluser_cfg())
+        switches = {}
+        for x in rgos_db.get_ruijie_switch_allhost_cfg():
+            user = users.get(x.host_id)
+            if user is None:
+                LOG.warning("switch %s has no ssh user config", x.ip_address)
+                continue
+            switches[x.ip_address] = (x.ip_address, int(x.port_id),
+                                      int(x.retry_times),
+                                      int(x.reconnect_time),
+                                      user.username, user.password)
+        LOG.debug("switch inventory loaded %d switches", len(switches))
+        return switches
+
+    def get_switches(self):
+        """Get a dict of switch ip to switch"""
+        self._lock.acquire()
+        try:
+            if (self._switches is None or
+                    time.time() - self._loaded >= self.ttl):
+                self._switches = self.load()
+                self._loaded = time.time()
+            return self._switches
+        finally:
+            self._lock.release()
+
+    def get_switch(self, ip):
+        return self.get_switches().get(ip)
+
+
+_INVENTORY = None
+
+
+def get_inventory():
+    global _INVENTORY
+    if _INVENTORY is None:
+        _INVENTORY = SwitchInventory(cfg.CONF.SWITCHAGENT.switch_inventory_ttl)
+    return _INVENTORY
+
+def open_switch_session(ssh_host):
+    """Get a pooled ssh session to the switch, -1 on failure"""
+
+    switch = get_inventory().get_switch(ssh_host)
+    if switch is None:
+        LOG.error("open_switch_session %s is not a configured switch",
+                  ssh_host)
         return -1
-    
-    # send the cli to switch
-    
+    return sshpool.get_pool().acquire(ssh_host, switch[1], switch[4],
+                                      switch[5])
+
+def close_switch_session(session, reuse=True):
+    """Hand the session back to the pool, close it if it is not reusable"""
+
+    sshpool.get_pool().release(session, reuse)
+
+def get_switch_prompt(session):
+    """Get the switch cli prompt pattern, it is learned once per session"""
+
+    if session.prompt is None:
+        switch_mode_info = switch_api.get_switchinfo_climode(session.chan, '')
+        # an unparsed hostname is kept as '', the prompt was consumed and
+        # reading it again would only wait for the cli timeout
+        session.prompt = switch_api.get_prompt_hostname(switch_mode_info)
+        LOG.debug("get_switch_prompt %s hostname = %s", session.host, session.prompt)
+        if session.prompt == '':
+            LOG.warning("get_switch_prompt %s hostname unknown, matching "
+                        "any prompt", session.host)
+    return switch_api.get_prompt_pattern(session.prompt)
+
+# (ssh_host, ifx, vlan) -> op of the switch vlan changes that failed,
+# they are sent again by the next SwitchVlanTransaction.commit()
+_FAILED_VLANS = {}
+_FAILED_VLANS_LOCK = threading.Lock()
+
+
+def get_failed_vlan_intents():
+    """Get the intents to send again for the vlan changes that failed.
+
+    The port refs are read again: an add is only retried while the vlan
+    still has users on the port, a remove only while it has none, the
+    others are dropped.
+    """
+
+    with _FAILED_VLANS_LOCK:
+        failed = _FAILED_VLANS.items()
+    intents = []
+    for (ssh_host, ifx, vlan), op in failed:
+        users = rgos_db.get_ruijie_vlan_port_users(ssh_host, ifx, vlan)
+        if (users > 0) == (op == VLAN_ADD):
+            intents.append((ssh_host, ifx, vlan, op, None))
+            continue
+        with _FAILED_VLANS_LOCK:
+            if _FAILED_VLANS.get((ssh_host, ifx, vlan)) == op:
+                del _FAILED_VLANS[(ssh_host, ifx, vlan)]
+    return intents
+
+
+class SwitchVlanTransaction(object):
+    """Collects vlan changes on switch ports and applies them together.
+
+    Every intent is (ssh_host, ifx, vlan, op, vif_id). commit() groups the
+    intents per switch and per interface and sends each switch's changes
+    in one configure session, then reports the result of every intent.
+    The bindings and port refs are kept when the switch did not take a
+    change, the change is remembered and sent again, in front of the new
+    intents, by the next commit(). The port refs of the vlans to remove
+    stay locked while a switch is changed, a remove of a vlan some vif
+    uses by then is dropped.
+    """
+
+    def __init__(self):
+        self.intents = []
+
+    def add_vlan(self, ssh_host, ifx, vlan, vif_id=None):
+        self.intents.append((ssh_host, ifx, int(vlan), VLAN_ADD, vif_id))
+
+    def remove_vlan(self, ssh_host, ifx, vlan, vif_id=None):
+        self.intents.append((ssh_host, ifx, int(vlan), VLAN_REMOVE, vif_id))
+
+    def commit(self):
+        """Apply all intents, return a list of (intent, success)"""
+
+        results = []
+        hosts = {}
+        for intent in get_failed_vlan_intents() + self.intents:
+            hosts.setdefault(intent[0], []).append(intent)
+        self.intents = []
+
+        for ssh_host, intents in hosts.items():
+            removes = [i[:3] for i in intents if i[3] == VLAN_REMOVE]
+            if removes:
+                results.extend(rgos_db.claim_ruijie_vlan_ports(
+                    removes,
+                    lambda free: self.apply_intents(ssh_host, intents, free)))
+            else:
+                results.extend(self.apply_intents(ssh_host, intents))
+        return results
+
+    def apply_intents(self, ssh_host, intents, free=None):
+        """Apply the intents of one switch, the removes only for the
+        (ssh_host, ifx, vlan) in free when it is given"""
+
+        if free is not None:
+            kept = []
+            for intent in intents:
+                if intent[3] == VLAN_REMOVE and intent[:3] not in free:
+                    LOG.info("switch vlan %s %s %d is used by vifs, "
+                             "not removed", ssh_host, intent[1], intent[2])
+                    with _FAILED_VLANS_LOCK:
+                        if _FAILED_VLANS.get(intent[:3]) == VLAN_REMOVE:
+                            del _FAILED_VLANS[intent[:3]]
+                    continue
+                kept.append(intent)
+            intents = kept
+        if not intents:
+            return []
+
+        results = []
+        failed = apply_switch_vlans(ssh_host, intents)
+        for intent in intents:
+            ok = intent[1] not in failed
+            results.append((intent, ok))
+            with _FAILED_VLANS_LOCK:
+                if ok:
+                    _FAILED_VLANS.pop(intent[:3], None)
+                else:
+                    _FAILED_VLANS[intent[:3]] = intent[3]
+            if not ok:
+                LOG.error("switch vlan %s failed: %s", intent[3], intent)
+        return results
+
+def apply_switch_vlans(ssh_host, intents):
+    """Send the vlan intents of one switch in one configure session.
+
+    Returns the set of interfaces whose changes were not applied.
+    """
+
+    # the last intent on a (port, vlan) wins
+    ifx_vlans = {}
+    ifx_order = []
+    for intent in intents:
+        ifx = intent[1]
+        if ifx not in ifx_vlans:
+            ifx_vlans[ifx] = {}
+            ifx_order.append(ifx)
+        ifx_vlans[ifx][intent[2]] = intent[3]
+    failed = set(ifx_order)
+
+    # get ssh session by host
+    session = open_switch_session(ssh_host)
+    if session == -1:
+        LOG.error("apply_switch_vlans ssh session open failed session == -1")
+        return failed
+    chan = session.chan
+
+    reuse = False
     try:
-        chan.settimeout(5.0)
-        # get switch cli mode info via ssh
-        switch_mode_info = ''
-        switch_mode_info = switch_api.get_switchinfo_climode(chan, switch_mode_info)
-        
-        # send 'conf' cli command to switch via ssh
-        switch_api.send_switch_cli(chan, cli_confmode)
-        switch_cli_return = ''
-        switch_mode_info = switch_api.get_switchinfo_climode(chan, switch_cli_return)
-        LOG.debug("set_switch_vlan cli_confmode return = %s \r\n" ,switch_mode_info)
-        # send 'vlan xx ' cli command to switch via ssh Create or Set vlan
-        switch_api.send_switch_cli(chan, cli_vlanmode)
-        # send cli command exit vlan mode
-        switch_api.send_switch_cli(chan, cli_exit)
-        
-        # Check interface mode
-        switch_api.send_switch_cli(chan, cli_show_ifx_mode)
-        # Get the interface mode info
-        return_switchport_info = switch_api.get_switchinfo_cliexecut(chan,switch_mode_info)
-        LOG.debug("set_switch_vlan cli_confmode return_switchport_info = \r\n%s \r\n" ,return_switchport_info)
-        # Parse the interface mode info
-        switch_port_mode = switch_api.get_switchport_mode(return_switchport_info, switch_ifx)
-        LOG.debug("set_switch_vlan cli_confmode switch_port_mode = %s \r\n" ,switch_port_mode)
-        #into interface mode
-        switch_api.send_switch_cli(chan, cli_ifx_mode)
-        #if the ifx is access mode should switch to trunnk then remova all vlan ,finally set vlan 
-        if switch_port_mode == access:
-            LOG.debug("set_switch_vlan switch_port_mode is access!")
-            # change portmode into trunk
-            #send_switch_cli(chan, cli_ifx_set_trunkmode)
-            #print 'set_switch_vlan cli_ifx_set_trunkmode send! \r\n'
-            # change portmode into uplink
-            switch_api.send_switch_cli(chan, cli_ifx_set_uplinkmode)
-
-            # remova all vlan list
-            switch_api.send_switch_cli(chan, cli_ifx_remove_vlan)
-            LOG.debug("set_switch_vlan cli_ifx_remove_vlan send!")
-
-            # add vlan into allow vlan list
-            switch_api.send_switch_cli(chan, cli_ifx_add_vlan)
-            LOG.debug("set_switch_vlan cli_ifx_add_vlan send!")
-        elif switch_port_mode == trunk:
-            LOG.debug("set_switch_vlan switch_port_mode is trunk!")
-            # add vlan into trunk allow vlan list
-            switch_api.send_switch_cli(chan, cli_ifx_add_vlan)
-        elif switch_port_mode == uplink:
-            LOG.debug("set_switch_vlan switch_port_mode is uplink!")
-            # add vlan into trunk allow vlan list
-            switch_api.send_switch_cli(chan, cli_ifx_add_vlan)
-        else:
-            LOG.error("set_switch_vlan err : port mode error")
-
-        # send cli command exit interface mode and config mode
-        switch_api.send_switch_cli(chan, cli_exit)
-        switch_api.send_switch_cli(chan, cli_conf_exit)
+        # get switch cli prompt via ssh
+        prompt_re = get_switch_prompt(session)
+        switch_api.exec_switch_cli(chan, 'configure\r\n', prompt_re)
+
+        # create or set every vlan to add
+        new_vlans = set()
+        for vlans in ifx_vlans.values():
+            new_vlans |= set(v for v, op in vlans.items() if op == VLAN_ADD)
+        bad_vlans = set()
+        for vlan in sorted(new_vlans):
+            output = switch_api.exec_switch_cli(chan, 'vlan ' + str(vlan) + '\r\n', prompt_re)
+            output = output + switch_api.exec_switch_cli(chan, 'exit\r\n', prompt_re)
+            error = switch_api.get_cli_error(output)
+            if error != '':
+                LOG.error("apply_switch_vlans %s vlan %s: %s",
+                          ssh_host, vlan, error)
+                bad_vlans.add(vlan)
+
+        # one show gets the mode of every port of the switch
+        switchport_info = switch_api.exec_switch_cli(chan, 'show interfaces switchport\r\n', prompt_re)
+        switchport_table = switch_api.get_switchport_table(switchport_info)
+
+        for ifx in ifx_order:
+            vlans = ifx_vlans[ifx]
+            add_vlans = sorted(v for v, op in vlans.items() if op == VLAN_ADD)
+            remove_vlans = sorted(v for v, op in vlans.items() if op == VLAN_REMOVE)
+            if bad_vlans.intersection(add_vlans):
+                # the port stays failed, its changes are all sent again
+                LOG.error("apply_switch_vlans %s %s vlans %s not created",
+                          ssh_host, ifx, sorted(bad_vlans.intersection(add_vlans)))
+                continue
+            port = switchport_table.get(switch_api.get_ifx_key(ifx), {})
+            portmode = port.get('mode', '')
+            current_vlans = switch_api.parse_vlan_list(port.get('vlans', ''))
+            port_vlans = None
+            if portmode == 'ACCESS' and add_vlans:
+                port_vlans = rgos_db.get_ruijie_port_vlans(ssh_host, ifx)
+            LOG.debug("apply_switch_vlans %s %s mode %s add %s remove %s",
+                      ssh_host, ifx, portmode, add_vlans, remove_vlans)
+            clis = switch_api.get_switchport_vlan_clis(ifx, portmode,
+                                                       add_vlans, remove_vlans,
+                                                       current_vlans, port_vlans)
+            if clis is None:
+                LOG.error("apply_switch_vlans %s port mode error", ifx)
+                continue
+            error = ''
+            for cli in clis:
+                output = switch_api.exec_switch_cli(chan, cli, prompt_re)
+                error = error or switch_api.get_cli_error(output)
+            if error != '':
+                LOG.error("apply_switch_vlans %s %s: %s", ssh_host, ifx, error)
+                continue
+            failed.discard(ifx)
+
+        # exit config mode
+        switch_api.exec_switch_cli(chan, 'exit\r\n', prompt_re)
+        reuse = True
+    except Exception, e:
+        LOG.error("apply_switch_vlans %s failed: %s", ssh_host, str(e))
 
     finally:
-        LOG.debug("set_switch_vlan end !")
+        # give the ssh session back to the pool
+        close_switch_session(session, reuse)
 
-    # close the ssh conect with switch
-    sshclient.ssh_close(chan, t)
+    return failed
 
+def set_switch_vlan(ssh_host, ifx, vlan):
+
+    txn = SwitchVlanTransaction()
+    txn.add_vlan(ssh_host, ifx, vlan)
+    for intent, ok in txn.commit():
+        if not ok:
+            return -1
     return 0
 
 def unset_switch_vlan(ssh_host, ifx, vlan):
-    # send cli to switch by ssh connet
-
-    # paramater check is here
 
-    # create cli command
+    txn = SwitchVlanTransaction()
+    txn.remove_vlan(ssh_host, ifx, vlan)
+    for intent, ok in txn.commit():
+        if not ok:
+            return -1
+    return 0
 
-    sshhost = ssh_host
-    switch_ifx = ifx
-    switch_vlan = str(vlan)
 
-    # first step into vlan mode 
-    cli_confmode = 'configure\r\n'
-    cli_vlanmode = 'vlan ' + switch_vlan + '\r\n'
+def get_lldp_fingerprint(bindings):
+    """Digest of a set of (host, mac, port) bindings, independent of order"""
 
-    cli_vlan_noaddifx = 'no add interface ' + switch_ifx + '\r\n'
+    text = '\n'.join(sorted(' '.join(x) for x in bindings))
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
 
-    cli_exit = 'exit\r\n'
-    cli_conf_exit = 'exit\r\n'
-	
-    # create ssh connect by host
-    host_t = get_sshserver_hostinfo_byhost( ssh_host )
-    sshport = int(host_t[1])
-    user = get_sshserver_username(sshhost)
-    password = get_sshserver_password(sshhost)
-    
-    t= sshclient.ssh_connect(user, password, sshhost, sshport)
-    if t == -1:
-        LOG.error("unset_switch_vlan ssh connect failed t == -1")
-        return -1
-    
-    chan = sshclient.ssh_channel(t)
-    if chan == -1:
-        LOG.error("unset_switch_vlan ssh channel create failed chan == -1")
-        return -1
-    
-    # send the cli to switch
-    
-    try:
-        chan.settimeout(5.0)
-        # get switch cli mode info via ssh
-        switch_mode_info = ''
-        switch_mode_info = switch_api.get_switchinfo_climode(chan, switch_mode_info)
-        
-        switch_api.send_switch_cli(chan, cli_confmode)
-        switch_cli_return = ''
-        switch_mode_info = switch_api.get_switchinfo_climode(chan, switch_cli_return)
-        LOG.debug("set_switch_vlan cli_confmode return = %s ", switch_mode_info)
-        
-        # Check interface mode
-        cli_show_ifx_mode = 'show interfaces ' + switch_ifx + ' switchport \r\n'
-        switch_api.send_switch_cli(chan, cli_show_ifx_mode)
-        # Get the interface mode info
-        return_switchport_info = switch_api.get_switchinfo_cliexecut(chan,switch_mode_info)
-        LOG.debug("set_switch_vlan cli_confmode return_switchport_info = \r\n%s \r\n", return_switchport_info)
-        # Parse the interface mode info
-        switch_port_mode = switch_api.get_switchport_mode(return_switchport_info, switch_ifx)
-        LOG.debug("set_switch_vlan cli_confmode switch_port_mode = %s ", switch_port_mode)
-        
-        if switch_port_mode == 'ACCESS':
-            # send cli command into vlan mode
-            switch_api.send_switch_cli(chan, cli_vlanmode)
-            # send cli command to switch via ssh
-            switch_api.send_switch_cli(chan, cli_vlan_noaddifx)
-            # send cli command exit vlan mode and config mode
-            switch_api.send_switch_cli(chan, cli_exit)
-            switch_api.send_switch_cli(chan, cli_conf_exit)
-        elif switch_port_mode == 'TRUNK':
-            #into interface mode
-            cli_ifx_mode = 'interface ' + switch_ifx +  '\r\n'
-            switch_api.send_switch_cli(chan, cli_ifx_mode)
-
-            # remova vlan from vlan list
-            cli_ifx_remove_vlan = 'switchport trunk allowed vlan rem '+ switch_vlan + '\r\n'
-            switch_api.send_switch_cli(chan, cli_ifx_remove_vlan)
-            # send cli command exit vlan mode and config mode
-            switch_api.send_switch_cli(chan, cli_exit)
-            switch_api.send_switch_cli(chan, cli_conf_exit)
-        elif switch_port_mode == 'UPLINK':
-            #into interface mode
-            cli_ifx_mode = 'interface ' + switch_ifx +  '\r\n'
-            switch_api.send_switch_cli(chan, cli_ifx_mode)
-
-            # remova vlan from vlan list
-            cli_ifx_remove_vlan = 'switchport trunk allowed vlan rem '+ switch_vlan + '\r\n'
-
-            switch_api.send_switch_cli(chan, cli_ifx_remove_vlan)
-            # send cli command exit vlan mode and config mode
-            switch_api.send_switch_cli(chan, cli_exit)
-            switch_api.send_switch_cli(chan, cli_conf_exit)
-        else:
-            LOG.error("unset_switch_vlan switch_port_mode is error!")
-        LOG.debug("unset_switch_vlan send_switch_cli SUCCESS! ")
-
-    finally:
-        LOG.debug("unset_switch_vlan end !")
-
-    # close the ssh conect with switch
-    sshclient.ssh_close(chan, t)
-    
-    return 0
+def get_lldp_scan_stats():
+    """Count of lldp scans synced to the db and skipped as unchanged"""
 
+    return dict(_LLDP_STATS)
 
 def update_lldp_neighbor(host, new_neighbor_list):
+    """Sync the host's switch_eth bindings with its lldp neighbors.
 
-    if new_neighbor_list == []:
-        return
-    LOG.debug('old lldp neighbor host: %s', host)
-    LOG.debug('old lldp neighbor new_neighbor_list: %s', new_neighbor_list)
-    old_bindings = rgos_db.get_ruijie_switch_eth_binding_byhost(host)
-    
-    new_bindings = []
+    new_neighbor_list may be any iterable of neighbor tuples, e.g. a
+    generator still reading the switch output. When the neighbors have
+    the same fingerprint as the last synced scan of the host, the db is
+    not touched. Returns the number of neighbors seen.
+    """
+
+    LOG.debug('lldp neighbor host: %s', host)
+    new_bindings_set = set()
     for x in new_neighbor_list:
         ethmac = switch_db.mac_converter(x[3])
         ifx = x[0]
-        new_bindings.append((host, ethmac.decode("utf8"), ifx.decode("utf8")))
-    
-    LOG.debug('old lldp neighbor bindings: %s', old_bindings)
-    LOG.debug('new lldp neighbor bindings: %s', new_bindings)
-    old_bindings_set = set(old_bindings)
-    new_bindings_set = set(new_bindings)
-    add_bindings_set = new_bindings_set - old_bindings_set
-    del_bindings_set = old_bindings_set - new_bindings_set
-    add_bindings = list(add_bindings_set)
-    del_bindings = list(del_bindings_set)
+        new_bindings_set.add((host, ethmac.decode("utf8"), ifx.decode("utf8")))
+
+    # an empty scan must not wipe the bindings of the host
+    if len(new_bindings_set) == 0:
+        return 0
+
+    fingerprint = get_lldp_fingerprint(new_bindings_set)
+    if host not in _LLDP_FINGERPRINTS:
+        _LLDP_FINGERPRINTS[host] = rgos_db.get_ruijie_lldp_fingerprint(host)
+    if _LLDP_FINGERPRINTS[host] == fingerprint:
+        _LLDP_STATS['unchanged'] = _LLDP_STATS['unchanged'] + 1
+        LOG.debug('lldp neighbors of %s unchanged, skip db sync', host)
+        return len(new_bindings_set)
+
+    old_bindings_set = set(get_switch_eth_bindings().get(host, []))
+    if old_bindings_set - new_bindings_set:
+        # the cache may lag behind the db, read it before removing
+        old_bindings_set = set(
+            rgos_db.get_ruijie_switch_eth_binding_byhost(host))
+    add_bindings = list(new_bindings_set - old_bindings_set)
+    del_bindings = list(old_bindings_set - new_bindings_set)
+    LOG.debug('old lldp neighbor bindings: %s', old_bindings_set)
+    LOG.debug('new lldp neighbor bindings: %s', new_bindings_set)
     LOG.debug('add lldp neighbor bindings: %s', add_bindings)
     LOG.debug('del lldp neighbor bindings: %s', del_bindings)
     
     # save lldp neighbors info to db
+    # remove old lldp info first, a mac moved to another port is re-added
+    switch_db.remove_port_neighbors(del_bindings)
+
     # new create lldp info into db
-    switch_db.add_port_neighbors(add_bindings)
+    added = switch_db.add_port_neighbors(add_bindings)
 
-    # remove old lldp info into db
-    switch_db.remove_port_neighbors(del_bindings)
+    # a mac still bound to another switch is retried by the next scan
+    if len(added) == len(add_bindings):
+        rgos_db.set_ruijie_lldp_fingerprint(host, fingerprint)
+        _LLDP_FINGERPRINTS[host] = fingerprint
+    _LLDP_STATS['synced'] = _LLDP_STATS['synced'] + 1
+    return len(new_bindings_set)
 
 
 def get_lldp_neighbor_details(recv_str, host_info):
@@ -442,158 +672,80 @@ def get_lldp_neighbor(recv_str, host_info):
 
     return 0
 
+def iter_lldp_neighbor_details(lines):
+    """Parse 'show lldp neighbors detail' output in a single pass.
+
+    lines is any iterable of output lines. Yields one dict per neighbor
+    with the local port 'ifx' and the LLDP_DETAIL_FIELDS values, as soon
+    as the neighbor block ends with its maximum frame size line.
+    """
+
+    ifx = ''
+    record = None
+    for line in lines:
+        key, sep, val = line.partition(':')
+        if sep == '':
+            line = line.strip()
+            if line.startswith(LLDP_PORT_HEAD):
+                ifx = line[len(LLDP_PORT_HEAD):line.rfind(']')]
+            continue
+        key = key.strip()
+        if key == LLDP_NEIGHBOR_HEAD:
+            record = {'ifx': ifx, 'index': val.strip()}
+        elif record is None:
+            continue
+        elif key in LLDP_DETAIL_FIELDS:
+            record[LLDP_DETAIL_FIELDS[key]] = val.strip()
+        elif key == LLDP_UNIT_END:
+            yield record
+            record = None
+
+def iter_neighbor_tuples(records):
+    """Turn neighbor records into (ifx, index, port id type, port id)"""
+
+    for record in records:
+        yield (record['ifx'], record['index'],
+               record.get('port_id_type', ''), record.get('port_id', ''))
+
 def get_neighbor_list_details( recv_str ):
 
     # save the data to local array
-    neighbor_list = []
-    recv_tmp = ''
-    tuple_count = 0
-    recv_str_tail = 0
-
-    # parse the recive message by cli type
-    # init the data
-    Local_ifx = 'LLDP neighbor-information of port ['
-    Local_ifx_val = ''
-    Local_ifx_tail = ']\r\n'
-    
-    Neighbor_index = 'Neighbor index                    : '
-    Neighbor_index_val = ''
-
-    Device_type = '  Device type                       : '
-    
-    ChassisID_type = '  Chassis ID type                   : '
-    ChassisID_type_val = ''
-    
-    ChassisID = '  Chassis ID                        : '
-    ChassisID_val = ''
-    
-    SystemName = '  System name                       : '
-    SystemName_val = ''
-    
-    System_des = '  System description                : '
-    
-    PortID_type = '  Port ID type                      : '
-    PortID_type_val = ''
-    
-    PortID = 'Port ID                           : '
-    PortID_val = ''
-    
-    Port_des = '  Port description                  :'
-    
-    Port_VLANID = 'Port VLAN ID                      : '
-    Port_VLANID_val = ''
-    
-    PPVID = '  Port and protocol VLAN ID(PPVID)  : '
-    UnitEnd = '  Maximum frame Size                :'
-
-    while True:
-
-        ret = recv_str.find(UnitEnd)
-        if ret == -1:
-            break;
-        recv_str_tail = ret + len(UnitEnd)
-        recv_tmp = recv_str[0:recv_str_tail]
-        # get val message by search string in revice message
-        Local_ifx_val = switch_api.get_val_by_str(Local_ifx, Local_ifx_tail, recv_tmp)
-        if len(Local_ifx_val) == 0:
-            LOG.debug("get_lldp_neighbor can not find Local_ifx_val !")
-
-        Neighbor_index_val = switch_api.get_val_by_str(Neighbor_index, Device_type, recv_tmp)
-        if len(Neighbor_index_val) == 0:
-            LOG.error("get_lldp_neighbor Neighbor_index_val not find = %s ",Neighbor_index_val)
-            break
-        Neighbor_index_val = Neighbor_index_val[:-2] 
-    
-        ChassisID_type_val = switch_api.get_val_by_str(ChassisID_type, ChassisID, recv_tmp)
-        ChassisID_type_val = ChassisID_type_val[:-2]
-    
-        ChassisID_val = switch_api.get_val_by_str(ChassisID, SystemName, recv_tmp)
-        ChassisID_val = ChassisID_val[:ChassisID_val.find('\r\n')]
-    
-        SystemName_val = switch_api.get_val_by_str(SystemName, System_des, recv_tmp)
-        SystemName_val = SystemName_val[:-2]
-    
-        PortID_type_val = switch_api.get_val_by_str(PortID_type, PortID, recv_tmp)
-        PortID_type_val = PortID_type_val[:PortID_type_val.find('\r\n')]
-    
-        PortID_val = switch_api.get_val_by_str(PortID, Port_des, recv_tmp)
-        PortID_val = PortID_val[:PortID_val.find('\r\n')]
-    
-        Port_VLANID_val = switch_api.get_val_by_str(Port_VLANID, PPVID, recv_tmp)
-        Port_VLANID_val = Port_VLANID_val[:-2]
-
-        recv_str = recv_str[recv_str_tail:-1]
-        LOG.debug("get_lldp_neighbor recv_str 3 = %s \r\n ",recv_str)
-
-        if len(Local_ifx_val) > 0:
-            ifx = Local_ifx_val
-        neighbor_tuple = (ifx, Neighbor_index_val, PortID_type_val, PortID_val)
-        neighbor_list.insert( tuple_count, neighbor_tuple )
-        tuple_count = tuple_count +1
-        LOG.debug("get_lldp_neighbor serach = %d times\r\n ",tuple_count)
-        continue
+    neighbor_list = list(iter_neighbor_tuples(
+        iter_lldp_neighbor_details(recv_str.splitlines())))
+    LOG.debug("get_neighbor_list_details found %d neighbors", len(neighbor_list))
 
     return neighbor_list
 
+def iter_lldp_neighbor_summary(lines):
+    """Parse the 'show lldp neighbors' table in a single pass.
+
+    The column offsets come from the table header. Yields one dict per
+    row with the LLDP_SUMMARY_COLUMNS values.
+    """
+
+    starts = None
+    for line in lines:
+        if starts is None:
+            starts = [line.find(title) for title, key in LLDP_SUMMARY_COLUMNS]
+            if -1 in starts:
+                starts = None
+            continue
+        cells = switch_api.split_table_row(line, starts)
+        row = dict((key, cells[i])
+                   for i, (title, key) in enumerate(LLDP_SUMMARY_COLUMNS))
+        # skip blank and trailing lines, a row always has a local port
+        if switch_api.get_ifx_key(row['ifx']) is None:
+            continue
+        yield row
+
 def get_neighbor_list( recv_str ):
 
     # save the data to local array
     neighbor_list = []
-    recv_tmp = ''
-    tuple_count = 0
-    recv_str_tail = 0
-
-    # parse the recive message by cli type
-    # init the data
-
-    SystemName = 'System Name'
-    SystemName_val = ''
-    System_des = '  System description                : ' 
-    Local_ifx = 'Local Intf'
-    Local_ifx_val = ''
-    Local_ifx_tail = ']\r\n'
-    PortID = 'Port ID'
-    PortID_val = ''
-    Port_des = '  Port description                  :'
-    Capability = 'Capability'
-    Capability_val = ''
-    
-    Agingtime = 'Aging-time'
-    Agingtime_val = ''
-    Neighbor_index_val = ''
-    ChassisID_type_val = ''
-    ChassisID_val = ''
-    
-    while True:
-
-        SystemName_val = switch_api.get_val_by_str(SystemName, System_des, recv_tmp)
-        SystemName_val = SystemName_val[:-2]
-        #print 'get_lldp_neighbor SystemName_val = %s \r\n' % SystemName_val,
-
-        # get val message by search string in revice message
-        Local_ifx_val = switch_api.get_val_by_str(Local_ifx, Local_ifx_tail, recv_tmp)
-        if len(Local_ifx_val) == 0:
-            print'get_lldp_neighbor can not find Local_ifx_val !\r\n'
-        #print 'get_lldp_neighbor Local_ifx_val = %s \r\n' % Local_ifx_val,
-    
-        PortID_val = switch_api.get_val_by_str(PortID, Port_des, recv_tmp)
-        PortID_val = PortID_val[:-2]
-        #print 'get_lldp_neighbor PortID_val = %s \r\n' % PortID_val,
-
-        recv_str = recv_str[recv_str_tail:-1]
-        #print '\r\n#################################################### \r\n'
-        #print 'get_lldp_neighbor recv_str 3 = %s \r\n' % recv_str,
-        #print '\r\n#################################################### \r\n'
-        #print 'get_lldp_neighbor recv_str_head = %d \r\n' % recv_str_tail,
-
-        if len(Local_ifx_val) > 0:
-            ifx = Local_ifx_val
-        #print 'get_lldp_neighbor ifx = %s \r\n' % ifx,
-        neighbor_tuple = (ifx, Neighbor_index_val, ChassisID_type_val, ChassisID_val)
-        neighbor_list.insert( tuple_count, neighbor_tuple )
-        tuple_count = tuple_count +1
-
-        continue
+    for row in iter_lldp_neighbor_summary(recv_str.splitlines()):
+        neighbor_tuple = (row['ifx'], '', '', row['port_id'])
+        neighbor_list.append(neighbor_tuple)
+    LOG.debug("get_neighbor_list found %d neighbors", len(neighbor_list))
 
     return neighbor_list
 
@@ -609,6 +761,7 @@ def set_sshserver_hostinfo(index, sshhost, sshport, retry, reconnect):
     else:
         # find old hostinfo ,Update it 
         switch_db.update_hostinfo(index, sshhost, sshport, retry, reconnect)
+    get_inventory().invalidate()
     return 0
 
 def get_sshserver_hostinfo():
@@ -620,16 +773,11 @@ def get_sshserver_hostinfo():
 
 def get_sshserver_hostinfo_byhost( sshhost ):
 
-    # There Should get hostinfo from db
-    hostinfo = switch_db.get_hostinfo_byhost(sshhost)
-    if hostinfo != []:
-        h_host = hostinfo[0].ip_address
-        h_port = hostinfo[0].port_id
-        h_retry = hostinfo[0].retry_times
-        h_recont = hostinfo[0].reconnect_time
-        hostinfo_t = (h_host, h_port, h_retry, h_recont)
-
-    return hostinfo_t
+    # (host, port, retry, reconnect) of the switch, None if unknown
+    switch = get_inventory().get_switch(sshhost)
+    if switch is None:
+        return None
+    return switch[:4]
 
 def set_sshserver_userinfo(index, username, passwd):
     # parameter check
@@ -644,113 +792,89 @@ def set_sshserver_userinfo(index, username, passwd):
     else:
         # find old user info ,Update it 
         switch_db.update_userinfo(index, username, passwd)
+    get_inventory().invalidate()
 
     return 0
 
 
 def get_sshserver_username( sshhost ):
     
-    # get server id from db by host
-    index =  switch_db.get_sshserver_id(sshhost)
-
-    # get username from db by host id
-    usercfg = switch_db.get_userinfo(index)
-    LOG.debug("get_sshserver_username usercfg = %s ",usercfg)
-    username = usercfg[0].username
-    LOG.debug("get_sshserver_username username = %s",username)
-    return username
+    switch = get_inventory().get_switch(sshhost)
+    if switch is None:
+        return None
+    LOG.debug("get_sshserver_username username = %s",switch[4])
+    return switch[4]
 
 def get_sshserver_password( sshhost):
     
-    # get server id from db by host
-    index =  switch_db.get_sshserver_id(sshhost)
-    # get username from db by host id
-    usercfg = switch_db.get_userinfo(index)
-    passwd = usercfg[0].password
-    LOG.debug("get_sshserver_password passwd = %s ",passwd)
-    return passwd
+    switch = get_inventory().get_switch(sshhost)
+    if switch is None:
+        return None
+    return switch[5]
+
 
+def set_ruijie_vlan(vif_id, net_id, txn=None):
+    """Allow the vlan of the network on the switch port of the vif.
 
-def set_ruijie_vlan(vif_id, net_id):
+    With a SwitchVlanTransaction the switch change is only queued and
+    applied by its commit().
+    """
     LOG.debug("set_ruijie_vlan, vif id is %s, net id is %s",vif_id, net_id)
-    vm_eth_binding = rgos_db.get_ruijie_vm_eth_binding(vif_id)
-    if vm_eth_binding == []:
+    port = rgos_db.resolve_ruijie_vif_port(vif_id, net_id)
+    if port is None:
         return
-    mac_address = vm_eth_binding[0].mac_address
-    LOG.debug("interface id %s has been connected to mac %s",vif_id, mac_address)
-    switch_binding = rgos_db.get_ruijie_switch_eth_binding(mac_address)
-    if switch_binding == []:
-        return;
-    ip = switch_binding[0].ip_address
-    ifx = switch_binding[0].port_id
-    ovs_binding = vlan_mgr.get_network_binding(None, net_id)
-    if ovs_binding == None:
+    ip, ifx, vlan, refcount = port
+    LOG.debug("the switch ip is %s, ifx is %s, vlan is %s, refs %s",
+              ip, ifx, vlan, refcount)
+    # only the first user of the vlan on the port sets it on the switch
+    if rgos_db.add_ruijie_vlan_binding(ip, ifx, vlan, vif_id) != 1:
         return
-    vlan = ovs_binding.segmentation_id
-    LOG.debug("the switch ip is %s, ifx is %s, vlan is %s",ip, ifx, vlan)
-    ruijie_vlan_binding = rgos_db.get_ruijie_vlan_binding(ip, ifx, vlan)
-    if ruijie_vlan_binding == []:
-        LOG.debug("to set the vlan of ruijie switch now")
-        set_switch_vlan(ip, ifx, vlan)
-    rgos_db.add_ruijie_vlan_binding(ip, ifx, vlan, vif_id)
+    LOG.debug("to set the vlan of ruijie switch now")
+    if txn is None:
+        txn = SwitchVlanTransaction()
+        txn.add_vlan(ip, ifx, vlan, vif_id)
+        txn.commit()
+    else:
+        txn.add_vlan(ip, ifx, vlan, vif_id)
     return
     
-def unset_ruijie_vlan(vif_id, net_id):
+def unset_ruijie_vlan(vif_id, net_id, txn=None):
 
     LOG.debug("unset_ruijie_vlan, net id is %s, vif id is %s",net_id, vif_id)
-    vm_eth_binding = rgos_db.get_ruijie_vm_eth_binding(vif_id)
-    if vm_eth_binding == []:
-        return
-    mac_address = vm_eth_binding[0].mac_address
-    LOG.debug("vif id %s has been connected to mac %s",vif_id, mac_address)
-    switch_binding = rgos_db.get_ruijie_switch_eth_binding(mac_address)
-    if switch_binding == []:
-        return;
-    ip = switch_binding[0].ip_address
-    ifx = switch_binding[0].port_id
-    ovs_binding = vlan_mgr.get_network_binding(None, net_id)
-    if ovs_binding == None:
+    port = rgos_db.resolve_ruijie_vif_port(vif_id, net_id)
+    if port is None:
         return
-    vlan = ovs_binding.segmentation_id
-    LOG.debug("the switch ip is %s, ifx is %s, vlan is %s",ip, ifx, vlan)
-    uuid = 0
-    rgos_db.remove_ruijie_vlan_binding(ip, ifx, vlan, uuid)
-    ruijie_vlan_binding = rgos_db.get_ruijie_vlan_binding(ip, ifx, vlan)
-    if ruijie_vlan_binding == []:
+    ip, ifx, vlan, refcount = port
+    LOG.debug("the switch ip is %s, ifx is %s, vlan is %s, refs %s",
+              ip, ifx, vlan, refcount)
+    # only the last user of the vlan on the port unsets it on the switch
+    if rgos_db.remove_ruijie_vlan_binding(ip, ifx, vlan, vif_id) == 0:
         LOG.debug("to unset the vlan of ruijie switch now")
-        unset_switch_vlan(ip, ifx, vlan)
+        if txn is None:
+            unset_switch_vlan(ip, ifx, vlan)
+        else:
+            txn.remove_vlan(ip, ifx, vlan, vif_id)
     return 
 
 def update_ruijie_vlan(vif_id, net_id, old_seg_id):
     
     LOG.debug("update_ruijie_vlan, net id is %s, vif id is %s, old vid %s",net_id, vif_id, old_seg_id)
-    vm_eth_binding = rgos_db.get_ruijie_vm_eth_binding(vif_id)
-    if vm_eth_binding == []:
-        return
-    mac_address = vm_eth_binding[0].mac_address
-    LOG.debug("interface id %s has been connected to mac %s",vif_id, mac_address)
-    switch_binding = rgos_db.get_ruijie_switch_eth_binding(mac_address)
-    if switch_binding == []:
-        return;
-    ip = switch_binding[0].ip_address
-    ifx = switch_binding[0].port_id
-    ovs_binding = vlan_mgr.get_network_binding(None, net_id)
-    if ovs_binding == None:
+    port = rgos_db.resolve_ruijie_vif_port(vif_id, net_id)
+    if port is None:
         return
-    vlan = ovs_binding.segmentation_id
+    ip, ifx, vlan, refcount = port
+    LOG.debug("the switch ip is %s, ifx is %s, vlan is %s, refs %s",
+              ip, ifx, vlan, refcount)
     
-    # del old ruijie switch vlan
-    rgos_db.remove_ruijie_vlan_binding(ip, ifx, old_seg_id, vif_id)
-    ruijie_vlan_binding = rgos_db.get_ruijie_vlan_binding(ip, ifx, old_seg_id)
-    if ruijie_vlan_binding == []:
+    # del old and set new ruijie switch vlan in one switch session
+    txn = SwitchVlanTransaction()
+    if rgos_db.remove_ruijie_vlan_binding(ip, ifx, old_seg_id, vif_id) == 0:
         LOG.debug("to unset the vlan of ruijie switch now")
-        unset_switch_vlan(ip, ifx, old_seg_id)
+        txn.remove_vlan(ip, ifx, old_seg_id, vif_id)
     
-    ruijie_vlan_binding = rgos_db.get_ruijie_vlan_binding(ip, ifx, vlan)
-    if ruijie_vlan_binding == []:
+    if rgos_db.add_ruijie_vlan_binding(ip, ifx, vlan, vif_id) == 1:
         LOG.debug("to set the vlan of ruijie switch now")
-        set_switch_vlan(ip, ifx, vlan)
-    rgos_db.add_ruijie_vlan_binding(ip, ifx, vlan, vif_id)
+        txn.add_vlan(ip, ifx, vlan, vif_id)
+    txn.commit()
     
-    return 
-
+    return
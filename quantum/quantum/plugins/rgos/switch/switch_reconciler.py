@@ -0,0 +1,187 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+
+from quantum.plugins.rgos.common import constants
+from quantum.plugins.rgos.db import rgos_db
+from quantum.plugins.rgos.switch import switch_api
+from quantum.plugins.rgos.switch import switch_driver
+from quantum.plugins.rgos.vlan import vlan_mgr
+
+LOG = logging.getLogger(__name__)
+
+MODE_OFF = 'off'
+MODE_DRY_RUN = 'dry_run'
+MODE_ENFORCE = 'enforce'
+
+
+def load_host_vlan_bindings(ip):
+    return rgos_db.get_ruijie_vlan_bindings_byhost(ip) or None
+
+
+def load_managed_vlans():
+    bindings = vlan_mgr.get_network_bindings() or {}
+    return dict((net_id, int(b.segmentation_id))
+                for net_id, b in bindings.iteritems()
+                if b.segmentation_id is not None)
+
+
+def load_managed_vlan(net_id):
+    binding = vlan_mgr.get_network_binding(None, net_id)
+    if binding is None or binding.segmentation_id is None:
+        return None
+    return int(binding.segmentation_id)
+
+
+# the bindings read by the reconciler, refreshed from the change log
+_VLAN_BINDINGS = rgos_db.ChangeLogCache(
+    constants.CHANGE_VLAN_BINDINGS,
+    lambda: switch_driver.group_by_host(rgos_db.get_ruijie_vlan_bindings()),
+    load_host_vlan_bindings)
+_MANAGED_VLANS = rgos_db.ChangeLogCache(
+    constants.CHANGE_NETWORK_BINDINGS, load_managed_vlans,
+    load_managed_vlan)
+
+
+def get_port_vlans(bindings):
+    """Get {port: set(vlans)} of the vlan bindings of one switch"""
+
+    ports = {}
+    for ip, port, vlan, uuid in bindings:
+        ports.setdefault(port, set()).add(int(vlan))
+    return ports
+
+
+def get_desired_port_vlans():
+    """Get {switch ip: {port: set(vlans)}} from ruijie_vlan_bindings"""
+
+    return dict((ip, get_port_vlans(bindings))
+                for ip, bindings in _VLAN_BINDINGS.refresh().iteritems())
+
+
+def get_managed_vlans():
+    """Get the vlans of all vlan networks, only those are ever removed"""
+
+    return set(_MANAGED_VLANS.refresh().values())
+
+
+def fetch_switchport_table(ssh_host):
+    """Read the mode and allowed vlans of every port with one show"""
+
+    session = switch_driver.open_switch_session(ssh_host)
+    if session == -1:
+        LOG.error("fetch_switchport_table %s ssh session open failed",
+                  ssh_host)
+        return None
+    reuse = False
+    try:
+        prompt_re = switch_driver.get_switch_prompt(session)
+        output = switch_api.exec_switch_cli(session.chan,
+                                            'show interfaces switchport\r\n',
+                                            prompt_re)
+        reuse = True
+    finally:
+        switch_driver.close_switch_session(session, reuse)
+    return switch_api.get_switchport_table(output)
+
+
+def diff_switch_vlans(desired_ports, server_ports, switchport_table,
+                      managed_vlans):
+    """Diff the desired vlans of a switch's ports against the switch.
+
+    desired_ports is {port: set(vlans)}, server_ports the ports with a
+    server behind them that carry no vlan yet. Returns a list of
+    (port, missing vlans, extra vlans). Only managed vlans are ever
+    extra, and only on ports with an explicit allowed list.
+    """
+
+    drift = []
+    ports = set(desired_ports.keys()) | set(server_ports)
+    for ifx in sorted(ports):
+        wanted = desired_ports.get(ifx, set())
+        port = switchport_table.get(switch_api.get_ifx_key(ifx))
+        if port is None:
+            LOG.warning("reconcile port %s not found on switch", ifx)
+            continue
+        if port['mode'] == 'ACCESS':
+            # an access port carries none of the tenant vlans yet
+            if wanted:
+                drift.append((ifx, wanted, set()))
+            continue
+        current = switch_api.parse_vlan_list(port['vlans'])
+        if current is None:
+            LOG.warning("reconcile port %s vlan list %s unknown",
+                        ifx, port['vlans'])
+            continue
+        missing = wanted - current
+        extra = set()
+        if port['vlans'].upper() != 'ALL':
+            extra = (current & managed_vlans) - wanted
+        if missing or extra:
+            drift.append((ifx, missing, extra))
+    return drift
+
+
+def reconcile_switch_vlans(mode=MODE_DRY_RUN):
+    """Make the switch trunk vlans match ruijie_vlan_bindings.
+
+    In dry_run mode the drift is only logged. In enforce mode the vlan
+    bindings of a switch are read from the db again after its ports were
+    shown, the corrections are applied in one vlan transaction per
+    switch, and a vlan is only removed from a port no vif uses: the
+    transaction checks that with the port refs locked until the switch
+    was changed.
+    Returns (number of drifted ports, number of ports fixed).
+    """
+
+    if mode == MODE_OFF:
+        return (0, 0)
+    desired = get_desired_port_vlans()
+    managed_vlans = get_managed_vlans()
+    eth_bindings = switch_driver.get_switch_eth_bindings()
+    drifted = 0
+    fixed = set()
+    for ssh_host in sorted(switch_driver.get_inventory().get_switches()):
+        switchport_table = fetch_switchport_table(ssh_host)
+        if switchport_table is None:
+            continue
+        desired_ports = desired.get(ssh_host, {})
+        if mode == MODE_ENFORCE:
+            # vifs bound while the switch was read must not lose a vlan
+            desired_ports = get_port_vlans(
+                rgos_db.get_ruijie_vlan_bindings_byhost(ssh_host))
+        server_ports = set(b[2] for b in eth_bindings.get(ssh_host, []))
+        drift = diff_switch_vlans(desired_ports, server_ports,
+                                  switchport_table, managed_vlans)
+        txn = switch_driver.SwitchVlanTransaction()
+        for ifx, missing, extra in drift:
+            drifted = drifted + 1
+            LOG.warning("reconcile %s %s missing vlans %s extra vlans %s",
+                        ssh_host, ifx,
+                        ','.join(switch_api.compress_vlan_list(missing)),
+                        ','.join(switch_api.compress_vlan_list(extra)))
+            if mode != MODE_ENFORCE:
+                continue
+            for vlan in missing:
+                txn.add_vlan(ssh_host, ifx, vlan)
+            for vlan in extra:
+                txn.remove_vlan(ssh_host, ifx, vlan)
+        for intent, ok in txn.commit():
+            if ok:
+                fixed.add((intent[0], intent[1]))
+    LOG.info("reconcile switch vlans (%s): %d ports drifted, %d fixed",
+             mode, drifted, len(fixed))
+    return (drifted, len(fixed))
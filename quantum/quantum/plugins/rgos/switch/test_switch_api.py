@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import re
+import socket
+
+from quantum.plugins.rgos.switch import switch_api
+
+SWITCHPORT_OUTPUT = '''show interfaces switchport
+Interface                        Switchport Mode      Access Native Protected VLAN lists
+-------------------------------- ---------- --------- ------ ------ --------- ----------
+GigabitEthernet 0/1              enabled    TRUNK     1      1      Disabled  1-10,20,30,
+                                                                              40-50,60
+GigabitEthernet 0/2              enabled    ACCESS    1      1      Disabled  ALL
+GigabitEthernet 0/3              enabled    TRUNK     1      1      Disabled  100,2
+                                                                              00-205
+GigabitEthernet 0/4              enabled    UPLINK    1      1      Disabled  ALL
+Ruijie#'''
+
+PROMPT_RE = re.compile(r'^Ruijie#$')
+
+
+class FakeChan(object):
+    """Channel returning the given chunks, then a timeout or EOF"""
+
+    def __init__(self, chunks, eof=False):
+        self.chunks = list(chunks)
+        self.eof = eof
+        self.timeouts = []
+
+    def send(self, data):
+        pass
+
+    def settimeout(self, timeout):
+        self.timeouts.append(timeout)
+
+    def recv(self, size):
+        if self.chunks:
+            return self.chunks.pop(0)
+        if self.eof:
+            return ''
+        raise socket.timeout()
+
+
+def test_parse_vlan_list():
+    assert switch_api.parse_vlan_list('1,10-12') == set([1, 10, 11, 12])
+    assert switch_api.parse_vlan_list('1,10-12,') == set([1, 10, 11, 12])
+    assert switch_api.parse_vlan_list('') == set()
+    assert len(switch_api.parse_vlan_list('all')) == 4094
+    assert switch_api.parse_vlan_list('1,x') is None
+
+
+def test_compress_vlan_list():
+    assert switch_api.compress_vlan_list([]) == []
+    assert (switch_api.compress_vlan_list([100, 10, 12, 13, 14, 13]) ==
+            ['10', '12-14', '100'])
+    assert switch_api.compress_vlan_list(xrange(1, 4095)) == ['1-4094']
+
+
+def test_compress_vlan_list_round_trip():
+    vlans = set([1, 2, 3, 7, 9, 10, 4000, 4094])
+    vlan_list = ','.join(switch_api.compress_vlan_list(vlans))
+    assert switch_api.parse_vlan_list(vlan_list) == vlans
+
+
+def test_get_vlan_list_lines():
+    vlans = range(1, 200, 2)
+    lines = switch_api.get_vlan_list_lines(vlans, 40)
+    assert max(len(line) for line in lines) <= 40
+    assert switch_api.parse_vlan_list(','.join(lines)) == set(vlans)
+
+
+def test_get_switchport_table():
+    table = switch_api.get_switchport_table(SWITCHPORT_OUTPUT)
+    assert sorted(table.keys()) == [switch_api.get_ifx_key('Gi0/%d' % i)
+                                    for i in range(1, 5)]
+    assert table[switch_api.get_ifx_key('Gi0/2')] == {
+        'ifx': 'GigabitEthernet 0/2', 'mode': 'ACCESS', 'vlans': 'ALL'}
+    assert table[switch_api.get_ifx_key('GigabitEthernet 0/4')]['mode'] == \
+        'UPLINK'
+
+
+def test_get_switchport_table_wrapped_vlans():
+    table = switch_api.get_switchport_table(SWITCHPORT_OUTPUT)
+    assert table[('gi', '0/1')]['vlans'] == '1-10,20,30,40-50,60'
+    assert table[('gi', '0/3')]['vlans'] == '100,200-205'
+
+
+def test_get_ifx_key():
+    assert (switch_api.get_ifx_key('Gi0/1') ==
+            switch_api.get_ifx_key('GigabitEthernet 0/1'))
+    assert switch_api.get_ifx_key('Ruijie#') is None
+
+
+def test_iter_cli_lines():
+    chan = FakeChan(['show vlan\r\nline 1\r\nli', 'ne 2\r\n', 'Ruijie#'])
+    lines = list(switch_api.iter_cli_lines(chan, 'show vlan\n', PROMPT_RE, 5))
+    assert lines == ['line 1', 'line 2']
+    # idle timeout, set again before every read
+    assert chan.timeouts == [5, 5, 5]
+
+
+def test_iter_cli_lines_incomplete():
+    for eof in (False, True):
+        chan = FakeChan(['show vlan\r\nline 1\r\n'], eof)
+        lines = []
+        try:
+            for line in switch_api.iter_cli_lines(chan, 'show vlan\n',
+                                                  PROMPT_RE, 5):
+                lines.append(line)
+        except switch_api.CliIncomplete:
+            pass
+        else:
+            assert False, 'CliIncomplete not raised'
+        assert lines == ['line 1']
+
+
+def test_read_until_prompt_incomplete():
+    chan = FakeChan(['line 1\r\n'])
+    try:
+        switch_api.read_until_prompt(chan, PROMPT_RE, 5)
+    except socket.timeout:
+        pass
+    else:
+        assert False, 'timeout not raised'
+    chan = FakeChan(['line 1\r\n', 'Ruijie#'])
+    assert switch_api.read_until_prompt(chan, PROMPT_RE, 5).endswith('Ruijie#')
@@ -0,0 +1,221 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import socket
+
+from quantum.plugins.rgos.switch import switch_api
+from quantum.plugins.rgos.switch import switch_driver
+
+
+def get_lldp_detail_block(i):
+    """'show lldp neighbors detail' output of the i-th neighbor"""
+
+    mac = '0050.56bc.%04x' % i
+    return (
+        "LLDP neighbor-information of port [GigabitEthernet %d/%d]\r\n"
+        "-------------------------------------------------------------\r\n"
+        "  Neighbor index                    : 1\r\n"
+        "  Device type                       : LLDP\r\n"
+        "  Update time                       : 0 days, 0 hours, 1 minutes\r\n"
+        "  Aging time                        : 1 minutes, 58 seconds\r\n"
+        "\r\n"
+        "  Chassis ID type                   : MAC address\r\n"
+        "  Chassis ID                        : %s\r\n"
+        "  System name                       : host%d\r\n"
+        "  System description                : Linux 3.2.0-29-generic\r\n"
+        "  Management address                : 192.168.1.%d\r\n"
+        "\r\n"
+        "  Port ID type                      : MAC address\r\n"
+        "  Port ID                           : %s\r\n"
+        "  Port description                  : eth0\r\n"
+        "  Port VLAN ID                      : 1\r\n"
+        "\r\n"
+        "  Auto-negotiation supported        : YES\r\n"
+        "  Maximum frame Size                : 1500\r\n"
+        "\r\n") % (i // 48, i % 48, mac, i, i % 250, mac)
+
+
+def get_lldp_detail_output(count):
+    return ''.join(get_lldp_detail_block(i) for i in xrange(count)) + 'Ruijie#'
+
+
+LLDP_SUMMARY_OUTPUT = '''show lldp neighbors
+Capability codes:
+    (R) Router, (B) Bridge, (T) Telephone, (C) DOCSIS Cable Device
+    (W) WLAN Access Point, (P) Repeater, (S) Station, (O) Other
+System Name          Local Intf      Port ID              Capability Aging-time
+host0                Gi0/1           0050.56bc.0000       S          1m 58s
+a-very-long-host-name Gi0/2          0050.56bc.0001       S          1m 40s
+
+Total entries displayed: 2
+Ruijie#'''
+
+
+class FakeSession(object):
+    """Session whose channel returns the given outputs, then times out"""
+
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+        self.chan = self
+
+    def send(self, data):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self, size):
+        if self.outputs:
+            return self.outputs.pop(0)
+        raise socket.timeout()
+
+
+def test_iter_lldp_neighbor_details():
+    records = list(switch_driver.iter_lldp_neighbor_details(
+        get_lldp_detail_output(2).splitlines()))
+    assert len(records) == 2
+    assert records[1] == {'ifx': 'GigabitEthernet 0/1',
+                          'index': '1',
+                          'chassis_id_type': 'MAC address',
+                          'chassis_id': '0050.56bc.0001',
+                          'system_name': 'host1',
+                          'port_id_type': 'MAC address',
+                          'port_id': '0050.56bc.0001',
+                          'port_vlan_id': '1'}
+
+
+def test_iter_lldp_neighbor_details_unfinished_block():
+    # a neighbor without its maximum frame size line is not complete
+    output = get_lldp_detail_output(1) + get_lldp_detail_block(1)[:300]
+    records = list(switch_driver.iter_lldp_neighbor_details(
+        output.splitlines()))
+    assert [r['port_id'] for r in records] == ['0050.56bc.0000']
+
+
+def test_get_neighbor_list_details():
+    neighbors = switch_driver.get_neighbor_list_details(
+        get_lldp_detail_output(96))
+    assert len(neighbors) == 96
+    assert neighbors[0] == ('GigabitEthernet 0/0', '1', 'MAC address',
+                            '0050.56bc.0000')
+    assert neighbors[95][0] == 'GigabitEthernet 1/47'
+
+
+def test_iter_lldp_neighbor_summary():
+    rows = list(switch_driver.iter_lldp_neighbor_summary(
+        LLDP_SUMMARY_OUTPUT.splitlines()))
+    assert [(r['ifx'], r['port_id']) for r in rows] == [
+        ('Gi0/1', '0050.56bc.0000'), ('Gi0/2', '0050.56bc.0001')]
+    assert rows[1]['system_name'] == 'a-very-long-host-name'
+
+
+def test_get_neighbor_list():
+    assert switch_driver.get_neighbor_list(LLDP_SUMMARY_OUTPUT) == [
+        ('Gi0/1', '', '', '0050.56bc.0000'),
+        ('Gi0/2', '', '', '0050.56bc.0001')]
+
+
+def test_scan_lldp_changes_incomplete():
+    host = '10.0.0.1'
+    prompt_re = switch_api.get_prompt_pattern('Ruijie')
+    # gi0/1 changed, its detail output stops in the middle
+    switch_driver._LLDP_SUMMARY[host] = {}
+    switch_driver._LLDP_DETAILS[host] = {}
+    session = FakeSession([LLDP_SUMMARY_OUTPUT,
+                           'show lldp neighbors interface Gi0/1 detail\r\n' +
+                           get_lldp_detail_block(0)[:300]])
+    try:
+        switch_driver.scan_lldp_changes(session, host, prompt_re)
+    except switch_api.CliIncomplete:
+        pass
+    else:
+        assert False, 'CliIncomplete not raised'
+    assert switch_driver._LLDP_SUMMARY[host] == {}
+    assert switch_driver._LLDP_DETAILS[host] == {}
+    switch_driver._LLDP_SUMMARY.pop(host)
+    switch_driver._LLDP_DETAILS.pop(host)
+
+
+def test_vlan_transaction_retries_failed_changes():
+    sent = []
+    users = {}
+    failing = set(['Gi0/1'])
+
+    def apply_switch_vlans(ssh_host, intents):
+        sent.append([intent[:4] for intent in intents])
+        return set(intent[1] for intent in intents) & failing
+
+    def get_ruijie_vlan_port_users(ip, port, vlan):
+        return users.get((ip, port, vlan), 0)
+
+    def claim_ruijie_vlan_ports(ports, func):
+        return func(set(p for p in ports if not users.get(p)))
+
+    saved = (switch_driver.apply_switch_vlans,
+             switch_driver.rgos_db.get_ruijie_vlan_port_users,
+             switch_driver.rgos_db.claim_ruijie_vlan_ports)
+    switch_driver.apply_switch_vlans = apply_switch_vlans
+    switch_driver.rgos_db.get_ruijie_vlan_port_users = \
+        get_ruijie_vlan_port_users
+    switch_driver.rgos_db.claim_ruijie_vlan_ports = claim_ruijie_vlan_ports
+    try:
+        users[('10.0.0.1', 'Gi0/1', 100)] = 2
+        txn = switch_driver.SwitchVlanTransaction()
+        txn.add_vlan('10.0.0.1', 'Gi0/1', 100, 'vif-1')
+        txn.remove_vlan('10.0.0.1', 'Gi0/1', 200, 'vif-2')
+        assert [ok for intent, ok in txn.commit()] == [False, False]
+
+        # the add still has users, the remove got one meanwhile
+        users[('10.0.0.1', 'Gi0/1', 200)] = 1
+        failing.clear()
+        results = switch_driver.SwitchVlanTransaction().commit()
+        assert sent[-1] == [('10.0.0.1', 'Gi0/1', 100,
+                             switch_driver.VLAN_ADD)]
+        assert [ok for intent, ok in results] == [True]
+        assert switch_driver.SwitchVlanTransaction().commit() == []
+    finally:
+        (switch_driver.apply_switch_vlans,
+         switch_driver.rgos_db.get_ruijie_vlan_port_users,
+         switch_driver.rgos_db.claim_ruijie_vlan_ports) = saved
+        switch_driver._FAILED_VLANS.clear()
+
+
+def test_vlan_transaction_keeps_used_vlans():
+    sent = []
+
+    def apply_switch_vlans(ssh_host, intents):
+        sent.append([intent[:4] for intent in intents])
+        return set()
+
+    def claim_ruijie_vlan_ports(ports, func):
+        # a vif was bound to vlan 100 on the port since it was queued
+        return func(set(p for p in ports if p[2] != 100))
+
+    saved = (switch_driver.apply_switch_vlans,
+             switch_driver.rgos_db.claim_ruijie_vlan_ports)
+    switch_driver.apply_switch_vlans = apply_switch_vlans
+    switch_driver.rgos_db.claim_ruijie_vlan_ports = claim_ruijie_vlan_ports
+    try:
+        txn = switch_driver.SwitchVlanTransaction()
+        txn.remove_vlan('10.0.0.1', 'Gi0/1', 100)
+        txn.remove_vlan('10.0.0.1', 'Gi0/1', 200)
+        results = txn.commit()
+        assert sent == [[('10.0.0.1', 'Gi0/1', 200,
+                          switch_driver.VLAN_REMOVE)]]
+        assert [intent[2] for intent, ok in results] == [200]
+    finally:
+        (switch_driver.apply_switch_vlans,
+         switch_driver.rgos_db.claim_ruijie_vlan_ports) = saved
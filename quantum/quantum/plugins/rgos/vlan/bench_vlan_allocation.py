@@ -0,0 +1,83 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time the vlan pool of the free ranges layout.
+
+Runs vlan_mgr.sync_vlan_allocations and reserve_vlan on the tables of
+the models, created on an in-memory sqlite database, so it needs no
+database server. sync is the first sync of an empty pool, resync the
+one of a plugin restart after the reserves.
+
+python -m quantum.plugins.rgos.vlan.bench_vlan_allocation [physnets ...]
+"""
+
+import sys
+import time
+
+import quantum.db.api as db
+from quantum.db import models_v2
+from quantum.plugins.rgos.db import rgos_models
+from quantum.plugins.rgos.vlan import vlan_mgr
+
+VLAN_MIN = 1
+VLAN_MAX = 4094
+MAX_RESERVES = 20000
+
+
+def clear_pool():
+    session = db.get_session()
+    with session.begin():
+        session.query(rgos_models.RuijieVlanAllocation).delete()
+        session.query(rgos_models.RuijieVlanFreeRange).delete()
+
+
+def time_sync(network_vlan_ranges):
+    start = time.time()
+    vlan_mgr.sync_vlan_allocations(network_vlan_ranges)
+    return time.time() - start
+
+
+def time_reserves(reserves):
+    """Mean time of one reserve_vlan in microseconds"""
+
+    session = db.get_session()
+    start = time.time()
+    for i in xrange(reserves):
+        vlan_mgr.reserve_vlan(session)
+    return (time.time() - start) / reserves * 1e6
+
+
+def main(argv):
+    counts = [int(x) for x in argv[1:]] or (1, 16, 64)
+    db.configure_db({'sql_connection': 'sqlite://',
+                     'base': models_v2.model_base.BASEV2})
+    print '%8s %8s %10s %10s %10s' % ('physnets', 'reserves', 'sync',
+                                      'resync', 'reserve')
+    for physnets in counts:
+        clear_pool()
+        network_vlan_ranges = dict(('physnet%d' % i, [(VLAN_MIN, VLAN_MAX)])
+                                   for i in xrange(physnets))
+        reserves = min(physnets * (VLAN_MAX - VLAN_MIN + 1), MAX_RESERVES)
+        sync = time_sync(network_vlan_ranges)
+        reserve = time_reserves(reserves)
+        resync = time_sync(network_vlan_ranges)
+        print '%8d %8d %9.4fs %9.4fs %8.1fus' % (physnets, reserves, sync,
+                                                 resync, reserve)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
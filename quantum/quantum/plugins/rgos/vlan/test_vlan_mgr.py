@@ -0,0 +1,58 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Ruijie network, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from quantum.plugins.rgos.vlan import vlan_mgr
+
+
+def test_merge_vlan_ranges():
+    assert vlan_mgr.merge_vlan_ranges([]) == []
+    assert (vlan_mgr.merge_vlan_ranges([(100, 200), (1, 10)]) ==
+            [(1, 10), (100, 200)])
+
+
+def test_merge_vlan_ranges_overlapping():
+    assert (vlan_mgr.merge_vlan_ranges([(1, 10), (5, 20), (8, 9)]) ==
+            [(1, 20)])
+
+
+def test_merge_vlan_ranges_adjacent():
+    assert (vlan_mgr.merge_vlan_ranges([(11, 20), (1, 10), (22, 30)]) ==
+            [(1, 20), (22, 30)])
+
+
+def test_subtract_vlans():
+    assert vlan_mgr.subtract_vlans([(1, 10)], []) == [(1, 10)]
+    assert (vlan_mgr.subtract_vlans([(1, 10)], [5, 3]) ==
+            [(1, 2), (4, 4), (6, 10)])
+
+
+def test_subtract_vlans_range_ends():
+    assert (vlan_mgr.subtract_vlans([(1, 10), (20, 30)], [1, 10, 20, 30]) ==
+            [(2, 9), (21, 29)])
+    assert vlan_mgr.subtract_vlans([(5, 5)], [5]) == []
+
+
+def test_subtract_vlans_outside():
+    assert (vlan_mgr.subtract_vlans([(10, 20)], [1, 15, 15, 4094]) ==
+            [(10, 14), (16, 20)])
+
+
+def test_subtract_vlans_all():
+    ranges = [(1, 4094)]
+    assert vlan_mgr.subtract_vlans(ranges, xrange(1, 4095)) == []
+    free = vlan_mgr.subtract_vlans(ranges, xrange(2, 4095, 2))
+    assert len(free) == 2047
+    assert free[0] == (1, 1) and free[-1] == (4093, 4093)
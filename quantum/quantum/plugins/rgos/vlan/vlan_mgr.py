@@ -25,6 +25,7 @@ from quantum.db import models_v2
 import quantum.db.api as db
 from quantum.openstack.common import cfg
 from quantum.plugins.rgos.common import constants
+from quantum.plugins.rgos.db import rgos_db
 from quantum.plugins.rgos.db import rgos_models
 
 LOG = logging.getLogger(__name__)
@@ -65,46 +66,106 @@ def add_network_binding(session, network_id, network_type,
                                                physical_network,
                                                segmentation_id)
         session.add(binding)
+        rgos_db.log_change(session, constants.CHANGE_NETWORK_BINDINGS,
+                           network_id, constants.OP_ADD)
+
+
+def merge_vlan_ranges(vlan_ranges):
+    """Sort (vlan_min, vlan_max) ranges and join overlapping or adjacent ones"""
+
+    merged = []
+    for vlan_min, vlan_max in sorted(vlan_ranges):
+        if merged and vlan_min <= merged[-1][1] + 1:
+            if vlan_max > merged[-1][1]:
+                merged[-1] = (merged[-1][0], vlan_max)
+        else:
+            merged.append((vlan_min, vlan_max))
+    return merged
+
+
+def subtract_vlans(vlan_ranges, vlan_ids):
+    """Cut vlan_ids out of sorted, merged ranges, returns the ranges left"""
+
+    free = []
+    vlan_ids = sorted(vlan_ids)
+    i = 0
+    for vlan_min, vlan_max in vlan_ranges:
+        while i < len(vlan_ids) and vlan_ids[i] < vlan_min:
+            i += 1
+        start = vlan_min
+        while i < len(vlan_ids) and vlan_ids[i] <= vlan_max:
+            if vlan_ids[i] > start:
+                free.append((start, vlan_ids[i] - 1))
+            start = vlan_ids[i] + 1
+            i += 1
+        if start <= vlan_max:
+            free.append((start, vlan_max))
+    return free
 
 
 def sync_vlan_allocations(network_vlan_ranges):
-    """Synchronize vlan_allocations table with configured VLAN ranges"""
+    """Synchronize vlan_free_ranges table with configured VLAN ranges.
 
+    Runs a fixed number of set based statements plus one per physical
+    network whose free ranges changed, however wide the ranges are.
+    """
+
+    alloc_model = rgos_models.RuijieVlanAllocation
+    range_model = rgos_models.RuijieVlanFreeRange
     session = db.get_session()
     with session.begin():
-        # process vlan ranges for each physical network separately
-        for physical_network, vlan_ranges in network_vlan_ranges.iteritems():
+        # unallocated rows are left over from the one row per vlan pool
+        (session.query(alloc_model).
+         filter_by(allocated=False).
+         delete(synchronize_session=False))
 
-            # determine current configured allocatable vlans for this
-            # physical network
-            vlan_ids = set()
-            for vlan_range in vlan_ranges:
-                vlan_ids |= set(xrange(vlan_range[0], vlan_range[1] + 1))
-
-            # remove from table unallocated vlans not currently allocatable
-            try:
-                allocs = (session.query(rgos_models.RuijieVlanAllocation).
-                          filter_by(physical_network=physical_network).
-                          all())
-                for alloc in allocs:
-                    try:
-                        # see if vlan is allocatable
-                        vlan_ids.remove(alloc.vlan_id)
-                    except KeyError:
-                        # it's not allocatable, so check if its allocated
-                        if not alloc.allocated:
-                            # it's not, so remove it from table
-                            LOG.debug("removing vlan %s on physical network "
-                                      "%s from pool" %
-                                      (alloc.vlan_id, physical_network))
-                            session.delete(alloc)
-            except exc.NoResultFound:
-                pass
-
-            # add missing allocatable vlans to table
-            for vlan_id in sorted(vlan_ids):
-                alloc = rgos_models.RuijieVlanAllocation(physical_network, vlan_id)
-                session.add(alloc)
+        allocated = {}
+        for physical_network, vlan_id in (
+                session.query(alloc_model.physical_network,
+                              alloc_model.vlan_id).all()):
+            allocated.setdefault(physical_network, set()).add(vlan_id)
+
+        current = {}
+        for physical_network, vlan_min, vlan_max in (
+                session.query(range_model.physical_network,
+                              range_model.vlan_min,
+                              range_model.vlan_max).all()):
+            current.setdefault(physical_network,
+                               set()).add((vlan_min, vlan_max))
+
+        # physical networks no longer configured lose their free vlans
+        stale = set(current) - set(network_vlan_ranges)
+        changed = set(stale)
+        if stale:
+            LOG.debug("removing physical networks %s from pool" %
+                      ', '.join(sorted(stale)))
+            (session.query(range_model).
+             filter(range_model.physical_network.in_(stale)).
+             delete(synchronize_session=False))
+
+        # free ranges of each physical network are its configured
+        # ranges without the allocated vlans
+        new_ranges = []
+        for physical_network, vlan_ranges in network_vlan_ranges.iteritems():
+            free = subtract_vlans(merge_vlan_ranges(vlan_ranges),
+                                  allocated.get(physical_network, ()))
+            if set(free) == current.get(physical_network, set()):
+                continue
+            LOG.debug("syncing pool of physical network %s to vlans %s" %
+                      (physical_network,
+                       ','.join('%s-%s' % r for r in free)))
+            (session.query(range_model).
+             filter_by(physical_network=physical_network).
+             delete(synchronize_session=False))
+            changed.add(physical_network)
+            new_ranges.extend({'physical_network': physical_network,
+                               'vlan_min': vlan_min,
+                               'vlan_max': vlan_max}
+                              for vlan_min, vlan_max in free)
+        if new_ranges:
+            session.execute(range_model.__table__.insert(), new_ranges)
+        rgos_db.log_changes(session, constants.CHANGE_VLAN_RANGES, changed,
+                            constants.OP_UPDATE)
 
 
 def get_vlan_allocation(physical_network, vlan_id):
@@ -119,42 +180,109 @@ def get_vlan_allocation(physical_network, vlan_id):
         return
 
 
+def get_free_range(session, physical_network, vlan_id):
+    """Get and lock the free range holding vlan_id, None if it is not free"""
+
+    free_range = (session.query(rgos_models.RuijieVlanFreeRange).
+                  filter_by(physical_network=physical_network).
+                  filter(rgos_models.RuijieVlanFreeRange.vlan_max >= vlan_id).
+                  order_by(rgos_models.RuijieVlanFreeRange.vlan_max).
+                  with_lockmode('update').
+                  first())
+    if free_range and free_range.vlan_min <= vlan_id:
+        return free_range
+    return None
+
+
+def add_allocation(session, physical_network, vlan_id):
+    alloc = rgos_models.RuijieVlanAllocation(physical_network, vlan_id)
+    alloc.allocated = True
+    session.add(alloc)
+    rgos_db.log_change(session, constants.CHANGE_VLAN_ALLOCATIONS,
+                       '%s:%s' % (physical_network, vlan_id),
+                       constants.OP_ADD)
+
+
 def reserve_vlan(session):
     with session.begin(subtransactions=True):
-        alloc = (session.query(rgos_models.RuijieVlanAllocation).
-                 filter_by(allocated=False).
-                 first())
-        if alloc:
+        free_range = (session.query(rgos_models.RuijieVlanFreeRange).
+                      order_by(rgos_models.RuijieVlanFreeRange.physical_network,
+                               rgos_models.RuijieVlanFreeRange.vlan_max).
+                      with_lockmode('update').
+                      first())
+        if free_range:
+            physical_network = free_range.physical_network
+            vlan_id = free_range.vlan_min
             LOG.debug("reserving vlan %s on physical network %s from pool" %
-                      (alloc.vlan_id, alloc.physical_network))
-            alloc.allocated = True
-            return (alloc.physical_network, alloc.vlan_id)
+                      (vlan_id, physical_network))
+            if free_range.vlan_min == free_range.vlan_max:
+                session.delete(free_range)
+            else:
+                free_range.vlan_min = vlan_id + 1
+            add_allocation(session, physical_network, vlan_id)
+            return (physical_network, vlan_id)
     raise q_exc.NoNetworkAvailable()
 
 
 def reserve_specific_vlan(session, physical_network, vlan_id):
     with session.begin(subtransactions=True):
-        try:
+        free_range = get_free_range(session, physical_network, vlan_id)
+        if free_range is None:
             alloc = (session.query(rgos_models.RuijieVlanAllocation).
                      filter_by(physical_network=physical_network,
                                vlan_id=vlan_id).
-                     one())
-            if alloc.allocated:
+                     with_lockmode('update').
+                     first())
+            if alloc:
                 if vlan_id == constants.FLAT_VLAN_ID:
                     raise q_exc.FlatNetworkInUse(physical_network=
                                                  physical_network)
                 else:
                     raise q_exc.VlanIdInUse(vlan_id=vlan_id,
                                             physical_network=physical_network)
-            LOG.debug("reserving specific vlan %s on physical network %s "
-                      "from pool" % (vlan_id, physical_network))
-            alloc.allocated = True
-        except exc.NoResultFound:
             LOG.debug("reserving specific vlan %s on physical network %s "
                       "outside pool" % (vlan_id, physical_network))
-            alloc = rgos_models.RuijieVlanAllocation(physical_network, vlan_id)
-            alloc.allocated = True
-            session.add(alloc)
+        else:
+            LOG.debug("reserving specific vlan %s on physical network %s "
+                      "from pool" % (vlan_id, physical_network))
+            # split the free range around vlan_id
+            vlan_min = free_range.vlan_min
+            if vlan_id == free_range.vlan_max:
+                session.delete(free_range)
+            else:
+                free_range.vlan_min = vlan_id + 1
+            if vlan_min < vlan_id:
+                session.add(rgos_models.RuijieVlanFreeRange(physical_network,
+                                                            vlan_min,
+                                                            vlan_id - 1))
+        add_allocation(session, physical_network, vlan_id)
+
+
+def add_free_vlan(session, physical_network, vlan_id):
+    """Give vlan_id back to the pool, merged with its neighbor ranges"""
+
+    if get_free_range(session, physical_network, vlan_id):
+        LOG.warning("vlan_id %s on physical network %s already free" %
+                    (vlan_id, physical_network))
+        return
+    left = (session.query(rgos_models.RuijieVlanFreeRange).
+            filter_by(physical_network=physical_network,
+                      vlan_max=vlan_id - 1).
+            with_lockmode('update').
+            first())
+    right = get_free_range(session, physical_network, vlan_id + 1)
+    if left and right:
+        right.vlan_min = left.vlan_min
+        session.delete(left)
+    elif right:
+        right.vlan_min = vlan_id
+    elif left:
+        session.delete(left)
+        session.add(rgos_models.RuijieVlanFreeRange(physical_network,
+                                                    left.vlan_min, vlan_id))
+    else:
+        session.add(rgos_models.RuijieVlanFreeRange(physical_network,
+                                                    vlan_id, vlan_id))
 
 
 def release_vlan(session, physical_network, vlan_id, network_vlan_ranges):
@@ -163,20 +291,22 @@ def release_vlan(session, physical_network, vlan_id, network_vlan_ranges):
             alloc = (session.query(rgos_models.RuijieVlanAllocation).
                      filter_by(physical_network=physical_network,
                                vlan_id=vlan_id).
+                     with_lockmode('update').
                      one())
-            alloc.allocated = False
+            session.delete(alloc)
+            rgos_db.log_change(session, constants.CHANGE_VLAN_ALLOCATIONS,
+                               '%s:%s' % (physical_network, vlan_id),
+                               constants.OP_REMOVE)
             inside = False
             for vlan_range in network_vlan_ranges.get(physical_network, []):
                 if vlan_id >= vlan_range[0] and vlan_id <= vlan_range[1]:
                     inside = True
                     break
-            if not inside:
-                session.delete(alloc)
+            if inside:
+                add_free_vlan(session, physical_network, vlan_id)
             LOG.debug("releasing vlan %s on physical network %s %s pool" %
                       (vlan_id, physical_network,
                        inside and "to" or "outside"))
         except exc.NoResultFound:
             LOG.warning("vlan_id %s on physical network %s not found" %
                         (vlan_id, physical_network))
-
-